@@ -1,12 +1,32 @@
-from fastapi import FastAPI, HTTPException
-from fastapi.responses import RedirectResponse
-from pydantic import BaseModel, validator
-from shared_code import weatherforecast, solar, ml
+from fastapi import FastAPI, HTTPException, Request, BackgroundTasks, Depends
+from fastapi.responses import (
+    RedirectResponse,
+    StreamingResponse,
+    Response,
+    JSONResponse,
+)
+from fastapi.responses import PlainTextResponse
+from pydantic import BaseModel, ValidationError, validator
+from shared_code import startup, server, metrics
+
+# pvlib, scikit-learn and the model are loaded later by the warm-up or on first use
+with startup.timed("import"):
+    from shared_code import weatherforecast, solar, ml, forecast, encoding, providers
+    from shared_code import (
+        registry,
+        scheduler,
+        models,
+        compute,
+        responsecache,
+        clearsky_table,
+    )
+from typing import List, Optional
 import pandas as pd
+import os
 import json
+import time
 import pytz
 from datetime import datetime
-import uvicorn
 
 description = """
 This API helps you optimizing your Solar energy by predicting. 🚀
@@ -14,11 +34,35 @@ This API helps you optimizing your Solar energy by predicting. 🚀
 ### How ?
 
 * **clearsky** -> returns 15min Power(Watts) of the day for maximal condition - clear sky.
+* **clearsky/range** -> same as clearsky from start_date upto end_date, streamed as NDJSON or CSV.
+* **solar_position** (query param of clearsky): `nrel_numpy` (NREL SPA, default), `nrel_numba`, `ephemeris`
+  or `analytical` (fastest, +/- 0.5 deg)
 * **forecast** -> returns 15min Power(Watts)  + weather for next 7 days.
+* **forecast/batch** -> same as forecast for a list of installations (eg. a fleet) in one request.
+* **models** -> model versions: activate a version without restart, shadow score a candidate version.
+* **installations** -> register an installation: its forecast is precomputed after every weather model update,
+  **forecast** for that installation is then read from memory.
+
+**Forecast window:** query params, only these rows are calculated
+
+* **start**, **end** (epoch sec) or **horizon_hours** (from start, default now): eg. `?horizon_hours=24`
+* **resolution**: `15min` (default), `30min` or `60min`
+* **daylight_only**: `true` = only the rows with clear sky power
+
+**Response format:** query param `format` or `Accept` header
+
+* **json** (default, `application/json`): list of records
+* **columns** (`application/vnd.solar-forecast.columns+json`): one array per field
+* **arrow** (`application/vnd.apache.arrow.stream`): Apache Arrow IPC stream (needs pyarrow)
+* **csv** (`text/csv`)
 
 **Remark:** 
 
 * **clearsky**: works for any date or location on the planet.
+* **GET forecast / clearsky**: the installation (one plane) in query params, eg.
+  `?lat=51.0&lng=3.11&tilt=35&azimuth=170`: cacheable by a reverse proxy. Responses have an `ETag`,
+  `If-None-Match` with that ETag returns 304.
+* **503** (`Retry-After` header): the compute pool is busy, retry later (see `COMPUTE_QUEUE_SIZE`).
 * **forecast**: will only return data for the next 7d (or 48h). Obviously not for a "date" in the past or further in the future.
 
 ### Format of your solar Installation
@@ -38,6 +82,14 @@ This API helps you optimizing your Solar energy by predicting. 🚀
   "wattInvertor": 5040,
   "timezone": "Europe/Brussels"
 }
+
+**Multi-array installation** (eg. east/west): add `planes`, a list of {tilt, azimuth, wattPeak}.
+They replace tilt/azimuth/totalWattPeak, **clearsky** then also returns `clear_sky_<nr>` per plane.
+
+  "planes": [
+    {"tilt": 15, "azimuth": 90, "wattPeak": 3700},
+    {"tilt": 15, "azimuth": 270, "wattPeak": 3700}
+  ]
 """
 
 
@@ -58,6 +110,36 @@ class Location(BaseModel):
         return value
 
 
+# max number of installations in one POST /forecast/batch
+MAX_BATCH_SIZE = int(os.environ.get("MAX_BATCH_SIZE", "1000"))
+# max number of days in one POST /clearsky/range
+CLEARSKY_MAX_DAYS = int(os.environ.get("CLEARSKY_MAX_DAYS", "366"))
+
+
+class Plane(BaseModel):
+    tilt: int = 35
+    azimuth: int = 90
+    wattPeak: int = 3700
+
+    @validator("tilt")
+    def validate_tilt(cls, value):
+        if not (0 <= value < 90):
+            raise ValueError("tilt must be between 0 and 90")
+        return value
+
+    @validator("azimuth")
+    def validate_azimuth(cls, value):
+        if not (0 <= value < 360):
+            raise ValueError("azimuth must be between 0 and 360")
+        return value
+
+    @validator("wattPeak")
+    def validate_wattPeak(cls, value):
+        if not (0 <= value < 20000):
+            raise ValueError("wattPeak must be between 0 and 20000")
+        return value
+
+
 now = datetime.now()
 now_string = now.strftime("%d-%m-%Y")
 
@@ -71,6 +153,7 @@ class Installation(BaseModel):
     totalWattPeak: int = 7400
     wattInvertor: int = 5040
     timezone: str = "Europe/Brussels"
+    planes: Optional[List[Plane]] = None
 
     @validator("date")
     def validate_date(cls, value):
@@ -116,6 +199,46 @@ class Installation(BaseModel):
             raise ValueError("the provided timezone seems not correct.")
         return value
 
+    @validator("planes")
+    def validate_planes(cls, value):
+        if value is not None and not (1 <= len(value) <= 10):
+            raise ValueError("planes must contain between 1 and 10 planes")
+        return value
+
+
+class ClearSkyRange(Installation):
+    start_date: str = now_string
+    end_date: str = now_string
+    freq: str = "15min"
+
+    @validator("start_date")
+    def validate_start_date(cls, value):
+        try:
+            d = datetime.strptime(value, "%d-%m-%Y")
+        except:
+            raise ValueError("start_date must be format: dd-MM-YYYY")
+        return value
+
+    @validator("end_date")
+    def validate_end_date(cls, value, values):
+        try:
+            d = datetime.strptime(value, "%d-%m-%Y")
+        except:
+            raise ValueError("end_date must be format: dd-MM-YYYY")
+        if "start_date" in values:
+            days = (d - datetime.strptime(values["start_date"], "%d-%m-%Y")).days + 1
+            if not (1 <= days <= CLEARSKY_MAX_DAYS):
+                raise ValueError(
+                    f"end_date must be between start_date and {CLEARSKY_MAX_DAYS} days later"
+                )
+        return value
+
+    @validator("freq")
+    def validate_freq(cls, value):
+        if not (value in ["5min", "10min", "15min", "30min", "60min"]):
+            raise ValueError("freq must be 5min, 10min, 15min, 30min or 60min")
+        return value
+
 
 app = FastAPI(
     title="solar-forecast-api",
@@ -131,6 +254,43 @@ app = FastAPI(
     },
 )
 
+# request duration per endpoint, Server-Timing header (SERVER_TIMING)
+app.add_middleware(metrics.MetricsMiddleware)
+
+
+@app.on_event("startup")
+async def warmup():
+    # load the model in the background (default), see SOLAR_WARMUP
+    startup.start()
+    # precompute the forecasts of the registered installations, see SCHEDULER
+    scheduler.start()
+    # worker processes load the model before the first request, see COMPUTE_POOL
+    compute.start()
+
+
+@app.on_event("shutdown")
+async def shutdown():
+    await scheduler.stop()
+    compute.stop()
+
+
+@app.exception_handler(compute.Overloaded)
+async def overloaded(request: Request, e: compute.Overloaded):
+    # admission control: the client retries later, see COMPUTE_QUEUE_SIZE
+    return JSONResponse(
+        {"detail": str(e)},
+        status_code=503,
+        headers={"Retry-After": str(compute.COMPUTE_RETRY_AFTER)},
+    )
+
+
+@app.exception_handler(weatherforecast.ProviderNotConfigured)
+async def provider_not_configured(
+    request: Request, e: weatherforecast.ProviderNotConfigured
+):
+    # a setting of the server is missing, not an error of the request
+    return JSONResponse({"detail": str(e)}, status_code=503)
+
 
 @app.get("/")
 async def root():
@@ -139,58 +299,386 @@ async def root():
     return RedirectResponse(redirect_url, status_code=303)
 
 
+@app.get("/health")
+async def health():
+    # readiness: 503 until the model is loaded
+    status = startup.status()
+    return JSONResponse(status, status_code=200 if status["ready"] else 503)
+
+
+@app.get("/metrics", response_class=PlainTextResponse)
+async def get_metrics():
+    # Prometheus text format, per worker process
+    return PlainTextResponse(metrics.render(), media_type="text/plain; version=0.0.4")
+
+
+def response_format(request, format):
+    # format of the 'format' query param or Accept header: json (records, default), columns, arrow or csv
+    try:
+        return encoding.negotiate(format, request.headers.get("accept"))
+    except encoding.UnsupportedFormat as e:
+        raise HTTPException(status_code=406, detail=str(e))
+
+
+def encode_content(fmt, df=None, dfs=None):
+    # the bytes are encoded by pandas/pyarrow, not by FastAPI
+    try:
+        with metrics.stage("encode"):
+            if dfs is not None:
+                return encoding.encode_many(dfs, fmt)
+            return encoding.encode(df, fmt)
+    except encoding.UnsupportedFormat as e:
+        raise HTTPException(status_code=406, detail=str(e))
+
+
+def encoded_response(request, format, df=None, dfs=None):
+    """Returns the DataFrame (or list of DataFrames) in the format of the 'format' query param or Accept header"""
+    fmt = response_format(request, format)
+    return Response(
+        content=encode_content(fmt, df, dfs),
+        media_type=encoding.MEDIA_TYPES[fmt],
+        headers={"Vary": "Accept"},
+    )
+
+
+async def forecast_response(request, inst, format, provider, window):
+    """Returns the encoded forecast of an installation from the response cache, else precomputed (registered
+    installation) or calculated. Cached until the next weather model update, see responsecache.
+    """
+    fmt = response_format(request, format)
+    now = time.time()
+    run = weatherforecast.model_run(now)
+    version = models.serving_version()
+    # the forecast changes with the weather model run and the model version
+    key = responsecache.request_key(
+        "forecast", inst, provider, window, fmt, run, version
+    )
+    cached = responsecache.lookup(key)
+    if cached is not None:
+        return responsecache.respond(request, cached, now)
+
+    # registered installation: precomputed by the scheduler
+    Final = scheduler.lookup(inst, provider)
+    if Final is not None and not forecast.coversWindow(Final, window):
+        # the window goes past the precomputed forecast (WEATHER_FORECAST_DAYS): calculated
+        Final = None
+    if Final is not None:
+        # precomputed before the last model update: not cached, the scheduler replaces it soon
+        fresh = Final.attrs.get("model_run") == run
+        Final = forecast.windowForecast(Final, window)
+    else:
+        # Get weather, ClearSky and ML prediction, only for the rows of the window
+        fresh = True
+        Final = await forecast.calcForecastAsync(inst, provider, window)
+    # predicted by the previous version (this worker did not switch yet): not cached
+    fresh = fresh and Final.attrs.get("model_version") == version
+
+    cached = responsecache.create(
+        encode_content(fmt, df=Final),
+        encoding.MEDIA_TYPES[fmt],
+        expires=weatherforecast.next_model_update(now) if fresh else now,
+    )
+    if fresh:
+        responsecache.store(key, cached)
+    return responsecache.respond(request, cached, now)
+
+
+async def clearsky_response(request, inst, format, solar_position):
+    """Returns the encoded clear sky of an installation, cached (it only depends on the installation)"""
+    fmt = response_format(request, format)
+    solar_position = check_solar_position(solar_position)
+    key = responsecache.request_key(
+        "clearsky",
+        inst,
+        fmt,
+        solar_position or solar.SOLAR_POSITION,
+        clearsky_table.CLEARSKY_ENGINE,
+    )
+    cached = responsecache.lookup(key)
+    if cached is None:
+        clear_sky_df = await compute.run(
+            solar.getClearSky, inst, solar_position, stage="clear_sky"
+        )
+        cached = responsecache.store(
+            key,
+            responsecache.create(
+                encode_content(fmt, df=clear_sky_df), encoding.MEDIA_TYPES[fmt]
+            ),
+        )
+    return responsecache.respond(request, cached)
+
+
+def query_installation(
+    lat: float,
+    lng: float,
+    date: Optional[str] = None,
+    altitude: Optional[int] = None,
+    tilt: Optional[int] = None,
+    azimuth: Optional[int] = None,
+    totalWattPeak: Optional[int] = None,
+    wattInvertor: Optional[int] = None,
+    timezone: Optional[str] = None,
+):
+    # installation of a GET (one plane): the url is the key of a reverse proxy cache
+    fields = dict(
+        date=date,
+        altitude=altitude,
+        tilt=tilt,
+        azimuth=azimuth,
+        totalWattPeak=totalWattPeak,
+        wattInvertor=wattInvertor,
+        timezone=timezone,
+    )
+    try:
+        return Installation(
+            location={"lat": lat, "lng": lng},
+            **{name: value for name, value in fields.items() if value is not None},
+        )
+    except ValidationError as e:
+        raise HTTPException(status_code=422, detail=e.errors())
+
+
+def forecast_window(
+    start: Optional[int] = None,
+    end: Optional[int] = None,
+    horizon_hours: Optional[int] = None,
+    resolution: str = "15min",
+    daylight_only: bool = False,
+):
+    # rows of the forecast to calculate: start/end (epoch sec) or horizon_hours, resolution, daylight_only
+    try:
+        return forecast.forecastWindow(
+            start, end, horizon_hours, resolution, daylight_only
+        )
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+
+
+def check_provider(provider):
+    # ?provider=... must be a registered weather provider
+    try:
+        return providers.get_provider(provider).name
+    except KeyError as e:
+        raise HTTPException(status_code=400, detail=str(e.args[0]))
+
+
+def check_solar_position(solar_position):
+    # ?solar_position=... must be an algorithm this process can use, None: the default (or the clear sky table)
+    if solar_position is None:
+        return None
+    try:
+        return solar.check_solar_position(solar_position)
+    except solar.UnsupportedSolarPosition as e:
+        raise HTTPException(status_code=400, detail=str(e))
+
+
 @app.post("/forecast")
-async def calc_forecast(installation: Installation):
+async def calc_forecast(
+    installation: Installation,
+    request: Request,
+    format: Optional[str] = None,
+    provider: Optional[str] = None,
+    window: dict = Depends(forecast_window),
+):
     inst = installation.dict()
 
     # list of dicts : get weather forecast + day_of_year => After this we only need the clearSky power
     # OpnemweatherMap: dt : (date= epoch in sec-10digits)
 
-    # depending on query param: ?provider='...' in POST
-    # We only support openmeteo anymore since openweathermap is not free anymore
-    provider = "openmeteo"
+    # depending on query param: ?provider='...' in POST (default openmeteo, openweathermap is not free anymore)
+    provider = check_provider(provider)
+
+    return await forecast_response(request, inst, format, provider, window)
 
-    if provider == "openweathermap":
-        forecast_15min_df = weatherforecast.getOpenWeatherData(inst)
-    elif provider == "openmeteo":
-        forecast_15min_df = weatherforecast.getOpenMeteoData(inst)
 
-    # Determine startHour and stopHour
-    startEpochHour, stopEpochHour = (
-        forecast_15min_df["dt"].iloc[0],
-        forecast_15min_df["dt"].iloc[-1],
+@app.get("/forecast")
+async def get_forecast(
+    request: Request,
+    installation: Installation = Depends(query_installation),
+    format: Optional[str] = None,
+    provider: Optional[str] = None,
+    window: dict = Depends(forecast_window),
+):
+    # same as POST /forecast, the installation in query params
+    provider = check_provider(provider)
+    return await forecast_response(
+        request, installation.dict(), format, provider, window
     )
 
-    # Calculate ClearSky and return dataFrame (date= epoch in sec-10digits)
-    clear_sky_df = pd.DataFrame()
-    clear_sky_df = solar.getClearSky(
-        inst, startEpochHour=startEpochHour, stopEpochHour=stopEpochHour
+
+@app.post("/forecast/batch")
+async def calc_forecast_batch(
+    installations: List[Installation],
+    request: Request,
+    format: Optional[str] = None,
+    provider: Optional[str] = None,
+    window: dict = Depends(forecast_window),
+):
+    if len(installations) > MAX_BATCH_SIZE:
+        raise HTTPException(
+            status_code=413,
+            detail=f"a batch can contain at most {MAX_BATCH_SIZE} installations",
+        )
+    insts = [installation.dict() for installation in installations]
+    provider = check_provider(provider)
+
+    # one weather call per grid cell and one ML prediction for the whole batch
+    Finals = await forecast.calcForecastBatchAsync(insts, provider, window)
+
+    return encoded_response(request, format, dfs=Finals)
+
+
+@app.post("/installations", status_code=201)
+async def register_installation(
+    installation: Installation,
+    background_tasks: BackgroundTasks,
+    provider: Optional[str] = None,
+):
+    provider = check_provider(provider)
+    site = registry.get_registry().add(installation.dict(), provider)
+    # first forecast now, then after every weather model update
+    background_tasks.add_task(scheduler.refresh, [site])
+    return site
+
+
+@app.get("/installations")
+async def list_installations():
+    return registry.get_registry().list()
+
+
+def get_site(id):
+    site = registry.get_registry().get(id)
+    if site is None:
+        raise HTTPException(
+            status_code=404, detail=f"installation '{id}' is not registered"
+        )
+    return site
+
+
+@app.get("/installations/{id}")
+async def get_installation(id: str):
+    return get_site(id)
+
+
+@app.delete("/installations/{id}", status_code=204)
+async def delete_installation(id: str):
+    site = get_site(id)
+    registry.get_registry().remove(id)
+    scheduler.forget(site)
+    return Response(status_code=204)
+
+
+@app.get("/installations/{id}/forecast")
+async def get_installation_forecast(
+    id: str,
+    request: Request,
+    format: Optional[str] = None,
+    window: dict = Depends(forecast_window),
+):
+    site = get_site(id)
+    return await forecast_response(
+        request, site["installation"], format, site["provider"], window
     )
 
-    # fill in 'clearSky' in the provided col (default val=0)
-    forecast_15min_df["clear_sky"] = clear_sky_df["clear_sky"]
-    # logging.info(f"Succesfull combined dataSet:{dataSet.info()}")
 
-    # Get ML prediction
-    Final = pd.DataFrame()
-    Final = ml.enrichDataFrameWithPrediction(forecast_15min_df)
+@app.get("/scheduler")
+async def scheduler_status():
+    # metrics of the precomputation: cycles, duration and size of the last cycle, forecast store
+    return scheduler.status()
 
-    msg_dict = Final.to_dict("records")
 
-    return msg_dict
+def model_error(e):
+    # unknown version: 404, artifact that cannot be loaded or does not fit the features: 422
+    if isinstance(e, KeyError):
+        return HTTPException(status_code=404, detail=str(e.args[0]))
+    return HTTPException(status_code=422, detail=str(e))
 
 
-@app.post("/clearsky")
-async def calc_clearsky(installation: Installation):
-    inst = installation.dict()
+@app.get("/models")
+async def list_models():
+    return models.status()
 
-    clear_sky_df = pd.DataFrame()
-    clear_sky_df = solar.getClearSky(inst)
-    # convert to dict and than to string
-    msg_dict = clear_sky_df.to_dict("records")
 
-    return msg_dict
+@app.post("/models/{version}/activate")
+async def activate_model(version: str):
+    # hot swap: loaded and validated first, the running predictions finish with the previous version
+    try:
+        models.activate(version)
+    except (KeyError, models.InvalidModel) as e:
+        raise model_error(e)
+    return models.status()
+
+
+@app.post("/models/{version}/shadow")
+async def shadow_model(version: str, sample_rate: Optional[float] = None):
+    if sample_rate is not None and not (0 <= sample_rate <= 1):
+        raise HTTPException(
+            status_code=400, detail="sample_rate must be between 0 and 1"
+        )
+    try:
+        models.set_shadow(version, sample_rate)
+    except (KeyError, models.InvalidModel) as e:
+        raise model_error(e)
+    return models.status()
+
+
+@app.delete("/models/shadow", status_code=204)
+async def stop_shadow_model():
+    models.clear_shadow()
+    return Response(status_code=204)
+
+
+@app.post("/clearsky")
+async def calc_clearsky(
+    installation: Installation,
+    request: Request,
+    format: Optional[str] = None,
+    solar_position: Optional[str] = None,
+):
+    return await clearsky_response(request, installation.dict(), format, solar_position)
+
+
+@app.get("/clearsky")
+async def get_clearsky(
+    request: Request,
+    installation: Installation = Depends(query_installation),
+    format: Optional[str] = None,
+    solar_position: Optional[str] = None,
+):
+    # same as POST /clearsky, the installation in query params
+    return await clearsky_response(request, installation.dict(), format, solar_position)
+
+
+@app.post("/clearsky/range")
+async def calc_clearsky_range(
+    clear_sky_range: ClearSkyRange,
+    format: str = "ndjson",
+    solar_position: Optional[str] = None,
+):
+    # checked before the (up to a year) clear sky calculation
+    if format not in ("ndjson", "csv"):
+        raise HTTPException(status_code=400, detail="format must be ndjson or csv")
+    inst = clear_sky_range.dict()
+    solar_position = check_solar_position(solar_position)
+
+    # all days in one pvlib pass
+    clear_sky_df = await compute.run(
+        solar.getClearSky,
+        inst,
+        solar_position,
+        stage="clear_sky",
+        start_date=inst["start_date"],
+        end_date=inst["end_date"],
+        freq=inst["freq"],
+    )
+
+    if format == "csv":
+        return StreamingResponse(encoding.iter_csv(clear_sky_df), media_type="text/csv")
+    return StreamingResponse(
+        encoding.iter_ndjson(clear_sky_df), media_type="application/x-ndjson"
+    )
 
 
 if __name__ == "__main__":
-    uvicorn.run(app, port=8080, host="0.0.0.0")
+    # WEB_CONCURRENCY > 1: pre-fork workers sharing the loaded model
+    server.serve(app, port=8080, host="0.0.0.0")
@@ -0,0 +1,60 @@
+"""Throughput of the open-meteo weather fetch for many locations against a local stub with latency:
+one request per location (getOpenMeteoData) vs bulk requests (getOpenMeteoDataBulk).
+
+Usage:
+    python benchmarks/bench_bulk_fetch.py [locations] [latency sec]
+"""
+import sys
+import time
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+from shared_code import weatherforecast  # noqa: E402
+from stub_server import OpenMeteoStub  # noqa: E402
+
+
+def sites(n):
+    """n installations, every one in another weather grid cell"""
+    return [
+        {
+            "location": {"lat": 50.0 + nr // 100 * 0.05, "lng": 3.0 + nr % 100 * 0.05},
+            "altitude": 10,
+            "timezone": "Europe/Brussels",
+            "tilt": 30,
+            "azimuth": 180,
+            "totalWattPeak": 3000,
+            "wattInvertor": 3000,
+        }
+        for nr in range(n)
+    ]
+
+
+def run(stub, func, installations):
+    """Returns (duration sec, upstream requests) of fetching all installations with an empty cache"""
+    weatherforecast.weather_cache.clear()
+    requests = stub.requests
+    start = time.perf_counter()
+    func(installations)
+    return time.perf_counter() - start, stub.requests - requests
+
+
+if __name__ == "__main__":
+    n = int(sys.argv[1]) if len(sys.argv) > 1 else 500
+    latency = float(sys.argv[2]) if len(sys.argv) > 2 else 0.05
+    installations = sites(n)
+    with OpenMeteoStub(delay=latency) as stub:
+        weatherforecast.OPEN_METEO_URL = stub.url
+        single = run(
+            stub,
+            lambda insts: [weatherforecast.getOpenMeteoData(i) for i in insts],
+            installations,
+        )
+        bulk = run(stub, weatherforecast.getOpenMeteoDataBulk, installations)
+    print(
+        f"locations: {n}, upstream latency: {latency * 1000:.0f} ms, bulk size: {weatherforecast.OPEN_METEO_BULK_SIZE}"
+    )
+    for name, (duration, requests) in (("single", single), ("bulk", bulk)):
+        print(
+            f"{name:7s} {requests:5d} requests {duration:7.2f} s {n / duration:9.1f} locations/s"
+        )
+    print(f"speedup: {single[0] / bulk[0]:.1f}x")
@@ -0,0 +1,135 @@
+"""HTTP load driver: latency p50/p99 and requests/sec of POST /forecast at several concurrencies.
+
+Starts the API (server.serve, WEB_CONCURRENCY workers) on a free port with the open-meteo
+stub as upstream, unless --url points to a running server.
+
+Usage:
+    python benchmarks/bench_load.py [--concurrency 1,4,16] [--requests 200] [--sites 1]
+                                    [--workers 1] [--latency 0.05] [--url http://host:port]
+Results: benchmarks/results/load-<commit>.json, see compare.py
+"""
+import os
+import sys
+import time
+import socket
+import argparse
+import threading
+import subprocess
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+
+from common import ROOT, sites, summary, save_results
+from stub_server import OpenMeteoStub
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def start_server(port, workers, upstream):
+    """Starts the API in a subprocess, returns it when /health is ready"""
+    env = dict(
+        os.environ,
+        OPEN_METEO_URL=upstream,
+        WEB_CONCURRENCY=str(workers),
+        SOLAR_WARMUP="blocking",
+        SCHEDULER="off",
+        # every request is calculated, comparable with the commits before the response cache
+        RESPONSE_CACHE="off",
+    )
+    process = subprocess.Popen(
+        [
+            sys.executable,
+            "-c",
+            f"import app; from shared_code import server; server.serve(app.app, '127.0.0.1', {port})",
+        ],
+        cwd=ROOT,
+        env=env,
+        stdout=subprocess.DEVNULL,
+        stderr=subprocess.DEVNULL,
+    )
+    for _ in range(300):
+        try:
+            if requests.get(f"http://127.0.0.1:{port}/health", timeout=1).ok:
+                return process
+        except requests.ConnectionError:
+            pass
+        time.sleep(0.1)
+    process.terminate()
+    raise RuntimeError("the server did not start")
+
+
+def load(url, concurrency, number, installations):
+    """Sends 'number' POST /forecast with 'concurrency' clients, returns latency summary, rps and errors"""
+    local = threading.local()
+
+    def post(nr):
+        if not hasattr(local, "session"):
+            local.session = requests.Session()
+        start = time.perf_counter()
+        response = local.session.post(
+            f"{url}/forecast", json=installations[nr % len(installations)]
+        )
+        return time.perf_counter() - start, response.status_code
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as pool:
+        results = list(pool.map(post, range(number)))
+    duration = time.perf_counter() - start
+    result = summary([latency for latency, status in results])
+    result["rps"] = round(number / duration, 1)
+    result["errors"] = sum(status != 200 for latency, status in results)
+    return result
+
+
+def run(args):
+    installations = sites(args.sites)
+    with OpenMeteoStub(delay=args.latency) as stub:
+        process = None
+        url = args.url
+        if url is None:
+            port = free_port()
+            process = start_server(port, args.workers, stub.url)
+            url = f"http://127.0.0.1:{port}"
+        try:
+            results = {}
+            for concurrency in args.concurrency:
+                results[f"c{concurrency}"] = dict(
+                    load(url, concurrency, args.requests, installations),
+                    concurrency=concurrency,
+                )
+                print(f"concurrency {concurrency:3d}: {results[f'c{concurrency}']}")
+        finally:
+            if process is not None:
+                process.terminate()
+                process.wait(timeout=30)
+    return results
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument(
+        "--concurrency", default="1,4,16", type=lambda v: [int(c) for c in v.split(",")]
+    )
+    parser.add_argument(
+        "--requests", default=200, type=int, help="requests per concurrency"
+    )
+    parser.add_argument(
+        "--sites",
+        default=1,
+        type=int,
+        help="distinct installations (weather grid cells)",
+    )
+    parser.add_argument(
+        "--workers", default=1, type=int, help="WEB_CONCURRENCY of the started server"
+    )
+    parser.add_argument(
+        "--latency", default=0.05, type=float, help="latency (sec) of the upstream stub"
+    )
+    parser.add_argument("--url", help="benchmark a running server instead")
+    args = parser.parse_args()
+    results = run(args)
+    print(save_results("load", dict(results, settings=dict(vars(args), url=args.url))))
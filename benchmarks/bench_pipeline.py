@@ -0,0 +1,86 @@
+"""Timings of every stage of POST /forecast on the open-meteo fixture, served by a local stub.
+
+Stages: fetch (HTTP + json decode), parse (ingestOpenMeteoData), interpolation
+(create_15min_by_interpolation), clear sky (solar.getClearSky, cold and cached), predict
+(ml.enrichDataFramesWithPrediction), serialisation (encoding.encode per format) and the
+whole forecast (forecast.calcForecast, weather cached).
+
+Usage:
+    python benchmarks/bench_pipeline.py [number]
+Results: benchmarks/results/pipeline-<commit>.json, see compare.py
+"""
+import sys
+
+from common import SITE, timeit, save_results
+from shared_code import (
+    weatherforecast,
+    httpclient,
+    solar,
+    ml,
+    forecast,
+    encoding,
+    startup,
+)
+from stub_server import OpenMeteoStub
+
+
+def run(number=100):
+    startup.warmup()
+    results = {}
+    with OpenMeteoStub() as stub:
+        params = weatherforecast.open_meteo_params(SITE)
+        results["fetch"] = timeit(lambda: httpclient.get_json(stub.url, params), number)
+        resp = httpclient.get_json(stub.url, params)
+        weatherforecast.OPEN_METEO_URL = stub.url
+
+        timezone = SITE["timezone"]
+        results["parse"] = timeit(
+            lambda: weatherforecast.ingestOpenMeteoData(resp, timezone), number
+        )
+        hourly = weatherforecast.ingestOpenMeteoData(resp, timezone)
+        results["interpolation"] = timeit(
+            lambda: weatherforecast.create_15min_by_interpolation(
+                hourly, weatherforecast.interp_cols
+            ),
+            number,
+        )
+        weather = weatherforecast.parseOpenMeteoData(resp, SITE)
+
+        window = dict(
+            startEpochHour=weather["dt"].iloc[0], stopEpochHour=weather["dt"].iloc[-1]
+        )
+
+        def cold_clear_sky():
+            solar.clear_sky_cache.clear()
+            solar.getClearSky(SITE, **window)
+
+        results["clear_sky_cold"] = timeit(cold_clear_sky, number)
+        results["clear_sky_cached"] = timeit(
+            lambda: solar.getClearSky(SITE, **window), number
+        )
+
+        dataSet = weather.copy()
+        dataSet["clear_sky"] = solar.getClearSky(SITE, **window)["clear_sky"]
+        results["predict"] = timeit(
+            lambda: ml.enrichDataFramesWithPrediction([dataSet]), number
+        )
+
+        final = forecast.calcForecast(SITE, "openmeteo")
+        for fmt in ("json", "columns", "csv"):
+            results[f"serialise_{fmt}"] = timeit(
+                lambda: encoding.encode(final, fmt), number
+            )
+
+        results["forecast_cached_weather"] = timeit(
+            lambda: forecast.calcForecast(SITE, "openmeteo"), number
+        )
+    return results
+
+
+if __name__ == "__main__":
+    results = run(int(sys.argv[1]) if len(sys.argv) > 1 else 100)
+    for stage, stats in results.items():
+        print(
+            f"{stage:24s} mean {stats['mean_ms']:8.3f} ms  p50 {stats['p50_ms']:8.3f}  p99 {stats['p99_ms']:8.3f}"
+        )
+    print(save_results("pipeline", results))
@@ -0,0 +1,128 @@
+"""Speed and accuracy of the solar position algorithms (solar.SOLAR_POSITIONS) on the clear sky power.
+The clear sky table (CLEARSKY_ENGINE=table) is included as 'table' when CLEARSKY_TABLE has been built.
+
+Speed: getClearSky of one day and of a 7 day window at 15min, cold (clear sky cache cleared).
+Accuracy: clear_sky watts of every algorithm versus NREL SPA (nrel_numpy) for sites from 60S to 60N,
+4 orientations and 5 days (solstices, equinoxes and a DST change): max, p99 and mean absolute error (W)
+and the error on the daily energy (%). nrel_numba is skipped when numba is not installed.
+
+Usage:
+    python benchmarks/bench_solar_position.py [number]
+Results: benchmarks/results/solar_position-<commit>.json, see compare.py
+"""
+import sys
+import importlib.util
+from pathlib import Path
+
+import numpy as np
+
+from common import SITE, timeit, save_results
+from shared_code import solar, clearsky_table
+
+DAYS = ["20-03-2023", "26-03-2023", "21-06-2023", "23-09-2023", "21-12-2023"]
+ORIENTATIONS = [(35, 180), (35, 90), (35, 270), (10, 0)]
+LOCATIONS = [
+    (lat, lng, timezone)
+    for lat in range(-60, 61, 15)
+    for lng, timezone in [
+        (3.11, "Europe/Brussels"),
+        (-74.0, "America/New_York"),
+        (151.2, "Australia/Sydney"),
+    ]
+]
+
+
+def bodies():
+    """The sites of the accuracy report"""
+    return [
+        dict(
+            SITE,
+            date=date,
+            location={"lat": lat, "lng": lng},
+            timezone=timezone,
+            tilt=tilt,
+            azimuth=azimuth,
+        )
+        for lat, lng, timezone in LOCATIONS
+        for tilt, azimuth in ORIENTATIONS
+        for date in DAYS
+    ]
+
+
+def engine(method):
+    """Selects the algorithm, returns the solar_position of getClearSky"""
+    # a process only uses one nrel variant, see solar.check_solar_position
+    solar.SOLAR_POSITION = "nrel_numpy" if method == "table" else method
+    clearsky_table.CLEARSKY_ENGINE = "table" if method == "table" else "pvlib"
+    return None if method == "table" else method
+
+
+def clear_sky(method, sites):
+    """clear_sky watts of all sites, one row per site"""
+    solar_position = engine(method)
+    solar.clear_sky_cache.clear()
+    return np.array(
+        [
+            solar.getClearSky(body, solar_position)["clear_sky"].to_numpy(np.float64)
+            for body in sites
+        ]
+    )
+
+
+def accuracy(power, reference):
+    error = np.abs(power - reference)
+    energy = reference.sum(axis=1)
+    energy_error = np.abs(power.sum(axis=1) - energy) / np.maximum(energy, 1) * 100
+    return {
+        "max_error_w": round(float(error.max()), 1),
+        "p99_error_w": round(float(np.percentile(error[reference > 0], 99)), 1),
+        "mean_error_w": round(float(error[reference > 0].mean()), 2),
+        "max_energy_error_pct": round(float(energy_error.max()), 3),
+        "mean_energy_error_pct": round(float(energy_error.mean()), 3),
+    }
+
+
+def run(number=20):
+    methods = [
+        method
+        for method in solar.SOLAR_POSITIONS
+        if method != "nrel_numba" or importlib.util.find_spec("numba") is not None
+    ]
+    if Path(clearsky_table.CLEARSKY_TABLE).exists():
+        methods.append("table")
+    sites = bodies()
+    reference = clear_sky("nrel_numpy", sites)
+    week = dict(startEpochHour=1674169200, stopEpochHour=1674169200 + 7 * 86400 - 900)
+    results = {}
+    for method in methods:
+        power = clear_sky(method, sites)
+        solar_position = engine(method)
+
+        def cold_day():
+            solar.clear_sky_cache.clear()
+            solar.getClearSky(SITE, solar_position)
+
+        def cold_week():
+            solar.clear_sky_cache.clear()
+            solar.getClearSky(SITE, solar_position, **week)
+
+        results[f"{method}_day"] = timeit(cold_day, number)
+        results[f"{method}_week"] = timeit(cold_week, number)
+        results[f"{method}_accuracy"] = accuracy(power, reference)
+    engine("nrel_numpy")
+    return results
+
+
+if __name__ == "__main__":
+    results = run(int(sys.argv[1]) if len(sys.argv) > 1 else 20)
+    for name, stats in results.items():
+        if "mean_ms" in stats:
+            print(
+                f"{name:24s} mean {stats['mean_ms']:8.3f} ms  p50 {stats['p50_ms']:8.3f}  p99 {stats['p99_ms']:8.3f}"
+            )
+        else:
+            print(
+                f"{name:24s} "
+                + "  ".join(f"{key} {value}" for key, value in stats.items())
+            )
+    print(save_results("solar_position", results))
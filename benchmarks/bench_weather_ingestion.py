@@ -0,0 +1,77 @@
+"""Micro-benchmark: open-meteo ingestion of a 16-day hourly payload, row-wise (legacy) vs columnar.
+
+Usage:
+    python benchmarks/bench_weather_ingestion.py
+"""
+import sys
+import json
+import timeit
+from pathlib import Path
+from datetime import datetime, timedelta
+
+import pytz
+import pandas as pd
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+from shared_code import weatherforecast  # noqa: E402
+
+FIXTURE = (
+    Path(__file__).resolve().parent.parent
+    / "shared_code"
+    / "fixtures"
+    / "openmeteo_forecast.json"
+)
+
+
+def payload(days=16):
+    """Repeats the 7 day fixture upto 'days' days of hourly data"""
+    resp = json.loads(FIXTURE.read_text())
+    hourly = resp["hourly"]
+    n = 24 * days
+    start = datetime.strptime(hourly["time"][0], "%Y-%m-%dT%H:%M")
+    resp["hourly"] = {
+        key: [values[i % len(values)] for i in range(n)]
+        for key, values in hourly.items()
+    }
+    resp["hourly"]["time"] = [
+        (start + timedelta(hours=h)).strftime("%Y-%m-%dT%H:%M") for h in range(n)
+    ]
+    return resp
+
+
+def legacy_ingest(resp, timezone):
+    """The row-wise ingestion as it was before the columnar pipeline"""
+    tz = pytz.timezone(timezone)
+    df_OM = pd.DataFrame.from_dict(resp["hourly"])
+    df_OM["temperature_2m"] = df_OM["temperature_2m"].apply(
+        lambda t: round(t + 273.15, 1)
+    )
+    df_OM["time"] = df_OM["time"].apply(
+        lambda t: tz.localize(datetime.strptime(t, "%Y-%m-%dT%H:%M"))
+    )
+    df_OM["dt"] = df_OM["time"].apply(lambda t: int(t.timestamp()))
+    df_OM.drop(["time"], inplace=True, axis=1)
+    df_OM["clear_sky"] = 0
+    df_OM["day_of_year"] = df_OM["dt"].apply(
+        lambda ts: datetime.fromtimestamp(ts).timetuple().tm_yday
+    )
+    df_OM["weathercode"] = df_OM["weathercode"].apply(
+        lambda id: weatherforecast.map_open_meteo_to_openweathermap_code(id)
+    )
+    return df_OM
+
+
+def bench(func, number=200):
+    """Returns the mean duration of func in ms"""
+    return timeit.timeit(func, number=number) / number * 1000
+
+
+if __name__ == "__main__":
+    resp = payload(16)
+    timezone = "Europe/Brussels"
+    legacy = bench(lambda: legacy_ingest(resp, timezone))
+    columnar = bench(lambda: weatherforecast.ingestOpenMeteoData(resp, timezone))
+    print(f"rows: {len(resp['hourly']['time'])} hourly")
+    print(f"legacy (row-wise):  {legacy:8.3f} ms")
+    print(f"columnar:           {columnar:8.3f} ms")
+    print(f"speedup:            {legacy / columnar:8.1f}x")
@@ -0,0 +1,94 @@
+"""Helpers of the benchmarks: timing statistics and the JSON results per commit."""
+import sys
+import json
+import time
+import platform
+import subprocess
+from pathlib import Path
+
+import numpy as np
+
+ROOT = Path(__file__).resolve().parent.parent
+RESULTS_DIR = Path(__file__).resolve().parent / "results"
+
+sys.path.insert(0, str(ROOT))
+
+SITE = {
+    "date": "20-01-2023",
+    "location": {"lat": 51.0, "lng": 3.11},
+    "altitude": 70,
+    "tilt": 35,
+    "azimuth": 170,
+    "totalWattPeak": 7400,
+    "wattInvertor": 5040,
+    "timezone": "Europe/Brussels",
+}
+
+
+def sites(n):
+    """n installations, every one in another weather grid cell"""
+    return [
+        dict(
+            SITE,
+            location={"lat": 50.0 + nr // 100 * 0.05, "lng": 3.0 + nr % 100 * 0.05},
+        )
+        for nr in range(n)
+    ]
+
+
+def summary(durations):
+    """Returns count, mean, p50, p99 and max in ms of durations in sec"""
+    ms = np.asarray(durations, dtype=np.float64) * 1000
+    return {
+        "count": len(ms),
+        "mean_ms": round(float(ms.mean()), 3),
+        "p50_ms": round(float(np.percentile(ms, 50)), 3),
+        "p99_ms": round(float(np.percentile(ms, 99)), 3),
+        "max_ms": round(float(ms.max()), 3),
+    }
+
+
+def timeit(func, number=100, warmup=3):
+    """Returns the summary of 'number' calls of func after 'warmup' calls"""
+    for _ in range(warmup):
+        func()
+    durations = []
+    for _ in range(number):
+        start = time.perf_counter()
+        func()
+        durations.append(time.perf_counter() - start)
+    return summary(durations)
+
+
+def git_commit():
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"],
+            cwd=ROOT,
+            capture_output=True,
+            text=True,
+            check=True,
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return "unknown"
+
+
+def save_results(name, results):
+    """Writes results to results/<name>-<commit>.json (+ machine info), returns the path"""
+    commit = git_commit()
+    RESULTS_DIR.mkdir(exist_ok=True)
+    path = RESULTS_DIR / f"{name}-{commit}.json"
+    path.write_text(
+        json.dumps(
+            {
+                "benchmark": name,
+                "commit": commit,
+                "time": time.strftime("%Y-%m-%dT%H:%M:%S"),
+                "python": platform.python_version(),
+                "machine": platform.machine(),
+                "results": results,
+            },
+            indent=2,
+        )
+    )
+    return path
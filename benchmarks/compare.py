@@ -0,0 +1,57 @@
+"""Compares two result files of the same benchmark (eg. two commits) and flags the regressions.
+
+Usage:
+    python benchmarks/compare.py results/pipeline-<old>.json results/pipeline-<new>.json [--threshold 10]
+Exit code 1 when a p50 got slower (or rps lower) by more than threshold %.
+"""
+import sys
+import json
+import argparse
+
+METRICS = ["p50_ms", "p99_ms", "rps"]
+
+
+def compare(old, new, threshold):
+    """Returns the rows (name, metric, old, new, change %, regression) of the common results"""
+    rows = []
+    for name, stats in new["results"].items():
+        if name not in old["results"] or not isinstance(stats, dict):
+            continue
+        for metric in METRICS:
+            if metric not in stats or metric not in old["results"][name]:
+                continue
+            before, after = old["results"][name][metric], stats[metric]
+            change = (after - before) / before * 100 if before else 0.0
+            # more ms is worse, fewer rps is worse
+            worse = -change if metric == "rps" else change
+            rows.append(
+                (
+                    name,
+                    metric,
+                    before,
+                    after,
+                    change,
+                    metric != "p99_ms" and worse > threshold,
+                )
+            )
+    return rows
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("old")
+    parser.add_argument("new")
+    parser.add_argument(
+        "--threshold", default=10.0, type=float, help="regression threshold (%%)"
+    )
+    args = parser.parse_args()
+    with open(args.old) as old_file, open(args.new) as new_file:
+        old, new = json.load(old_file), json.load(new_file)
+    print(f"{old['benchmark']}: {old['commit']} -> {new['commit']}")
+    rows = compare(old, new, args.threshold)
+    for name, metric, before, after, change, regression in rows:
+        flag = "  REGRESSION" if regression else ""
+        print(
+            f"{name:24s} {metric:7s} {before:10.3f} -> {after:10.3f} {change:+7.1f}%{flag}"
+        )
+    sys.exit(1 if any(row[-1] for row in rows) else 0)
@@ -0,0 +1,97 @@
+import sys
+import time
+import threading
+from collections import OrderedDict
+
+import pandas as pd
+import numpy as np
+
+
+def size_of(value):
+    """Returns the (approximate) memory size in bytes of a cached value"""
+    if isinstance(value, pd.DataFrame):
+        return int(value.memory_usage(index=True, deep=True).sum())
+    if isinstance(value, np.ndarray):
+        return value.nbytes
+    if isinstance(value, (tuple, list)):
+        return sys.getsizeof(value) + sum(size_of(v) for v in value)
+    return sys.getsizeof(value)
+
+
+class LRUCache:
+    """Thread safe LRU cache with an expiry time per entry and a memory cap
+
+    Args:
+        max_entries (int): max number of entries, 0 disables the cache
+        max_bytes (int): max total size of the entries (see size_of)
+        ttl (float): default time to live in sec, None = no expiry
+    """
+
+    def __init__(self, max_entries=1024, max_bytes=64 * 2**20, ttl=None):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.nbytes = 0
+        self._entries = OrderedDict()  # key -> (value, expires, size)
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get(self, key, default=None):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and entry[1] is not None and entry[1] <= time.time():
+                self._remove(key)
+                entry = None
+            if entry is None:
+                self.misses += 1
+                return default
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry[0]
+
+    def put(self, key, value, expires=None):
+        """Stores value under key until the epoch time 'expires' (default now + ttl)"""
+        if self.max_entries <= 0:
+            return
+        if expires is None and self.ttl is not None:
+            expires = time.time() + self.ttl
+        size = size_of(value)
+        if size > self.max_bytes:
+            return
+        with self._lock:
+            if key in self._entries:
+                self._remove(key)
+            self._entries[key] = (value, expires, size)
+            self.nbytes += size
+            # evict least recently used entries
+            while len(self._entries) > self.max_entries or self.nbytes > self.max_bytes:
+                self._remove(next(iter(self._entries)))
+                self.evictions += 1
+
+    def remove(self, key):
+        """Removes the entry of key (if any)"""
+        with self._lock:
+            if key in self._entries:
+                self._remove(key)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self.nbytes = 0
+
+    def stats(self):
+        return {
+            "entries": len(self._entries),
+            "bytes": self.nbytes,
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+        }
+
+    def _remove(self, key):
+        self.nbytes -= self._entries.pop(key)[2]
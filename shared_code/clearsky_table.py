@@ -0,0 +1,451 @@
+"""Clear sky lookup table: the clear sky of pvlib tabulated offline, answered by multilinear interpolation.
+
+The clear sky of pvlib (NREL SPA + Ineichen) is split in smooth parts, every one tabulated on its own grid:
+    - geometry: unit vector of the sun (east, north, up) per latitude, day of the year and local mean solar time.
+      At the same solar time the sun of every longitude is the same (the day is shifted by the longitude).
+      The refraction (pressure of the altitude) is applied after the interpolation, as SPA does
+    - irradiance: Ineichen ghi, dni and dhi (per W/m2 extraterrestrial) per apparent zenith, Linke turbidity
+      and altitude
+    - turbidity: the monthly Linke turbidity map of pvlib (1/12 deg), interpolated per day as pvlib does
+The plane of array irradiance of any tilt/azimuth follows from the interpolated sky with the isotropic
+transposition of pvlib (exact): no solar position at runtime.
+
+The table is a directory of .npy files + meta.json (axes and the error against pvlib measured by the build).
+The arrays are memory mapped: the workers share them through the page cache.
+
+    python -m shared_code.clearsky_table [--lat-step 1] [--day-step 4] [--minutes 5] [--samples 100] [path]
+"""
+import os
+import json
+import time
+import argparse
+import calendar
+import itertools
+import threading
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+
+# pvlib: clear sky from pvlib (solar position per SOLAR_POSITION), table: interpolated from CLEARSKY_TABLE
+CLEARSKY_ENGINE = os.environ.get("CLEARSKY_ENGINE", "pvlib")
+CLEARSKY_TABLE = os.environ.get("CLEARSKY_TABLE", "clearsky_table")
+
+# fields of the sky of a site, see ClearSkyTable.sky
+FIELDS = ("beam_east", "beam_north", "beam_up", "dhi", "ghi")
+# ground reflection of pvlib's get_total_irradiance
+ALBEDO = 0.25
+# first day of the geometry, the seasons repeat every tropical year
+EPOCH_DAY = int(np.datetime64("2023-01-01", "D").astype(np.int64))
+TROPICAL_YEAR = 365.2422
+ZENITH_MAX = 92.0
+MAX_ALTITUDE = 5000
+
+
+class ClearSkyTable:
+    """Clear sky of any site from the tabulated geometry, irradiance and turbidity, see the module doc
+
+    Args:
+        geometry (ndarray): float32, lat x day x time x (east, north, up)
+        irradiance (ndarray): float32, zenith x turbidity x altitude x (ghi, dni, dhi)
+        turbidity (ndarray): uint8, 20 x Linke turbidity, lat (90N first) x lng (180W first) x month
+        meta (dict): axes (start, step) of the grids + error, see validate
+    """
+
+    def __init__(self, geometry, irradiance, turbidity, meta):
+        self.geometry = geometry
+        self.irradiance = irradiance
+        self.turbidity = turbidity
+        self.meta = meta
+
+    @classmethod
+    def load(cls, path):
+        """Memory maps a table written by build"""
+        path = Path(path)
+        return cls(
+            *(
+                np.load(path / f"{name}.npy", mmap_mode="r")
+                for name in ("geometry", "irradiance", "turbidity")
+            ),
+            json.loads((path / "meta.json").read_text()),
+        )
+
+    def covers(self, lat, lng, altitude):
+        """True when the site is inside the grids"""
+        return (
+            -90 <= lat <= 90
+            and -180 <= lng <= 180
+            and 0 <= altitude <= self.meta["altitude"][2]
+        )
+
+    def axis(self, name, x, size):
+        start, step = self.meta[name][:2]
+        return grid_weights(x, start, step, size)
+
+    def sky(self, lat, lng, altitude, times):
+        """Returns the clear sky of a site by multilinear interpolation
+
+        Args:
+            lat, lng, altitude (float): the site
+            times (pandas DatetimeIndex): tz aware, see solar.get_times
+
+        Returns:
+            pandas dataframe: index(times) + FIELDS: beam (dni x unit vector of the sun), dhi, ghi (W/m2)
+        """
+        # the day and time of the day in local mean solar time
+        solar_time = times.asi8 / 10**9 + lng * 240
+        days = np.floor(solar_time / 86400)
+        time_of_day = solar_time - days * 86400
+        # the day of the geometry (at longitude 0) with the same position of the earth
+        day = (days - lng / 360 - EPOCH_DAY) % TROPICAL_YEAR
+        sun = interpolate(
+            self.geometry,
+            [
+                self.axis("lat", lat, self.geometry.shape[0]),
+                self.axis("day", day, self.geometry.shape[1]),
+                self.axis("minutes", time_of_day / 60, self.geometry.shape[2]),
+            ],
+        )
+        sun /= np.linalg.norm(sun, axis=1)[:, None]
+        zenith = apparent_zenith(
+            np.degrees(np.arccos(np.clip(sun[:, 2], -1, 1))), altitude
+        )
+        # the unit vector of the apparent position
+        horizontal = np.hypot(sun[:, 0], sun[:, 1])
+        scale = np.divide(
+            np.sin(np.radians(zenith)),
+            horizontal,
+            out=np.zeros_like(horizontal),
+            where=horizontal > 0,
+        )
+        sun = np.stack(
+            [sun[:, 0] * scale, sun[:, 1] * scale, np.cos(np.radians(zenith))], axis=-1
+        )
+
+        from pvlib import irradiance
+
+        shape = self.irradiance.shape
+        ghi, dni, dhi = (
+            interpolate(
+                self.irradiance,
+                [
+                    self.axis("zenith", zenith, shape[0]),
+                    self.axis(
+                        "turbidity", self.linke_turbidity(lat, lng, times), shape[1]
+                    ),
+                    self.axis("altitude", altitude, shape[2]),
+                ],
+            )
+            * irradiance.get_extra_radiation(times).to_numpy()[:, None]
+        ).T
+        return pd.DataFrame(
+            {
+                "beam_east": dni * sun[:, 0],
+                "beam_north": dni * sun[:, 1],
+                "beam_up": dni * sun[:, 2],
+                "dhi": dhi,
+                "ghi": ghi,
+            },
+            index=times,
+        )
+
+    def linke_turbidity(self, lat, lng, times):
+        """Linke turbidity of pvlib's lookup_linke_turbidity: the cell of the site, interpolated between
+        the middles of the months"""
+        row = min(
+            max(int(np.around((90 - 1 / 24 - lat) * 12)), 0),
+            self.turbidity.shape[0] - 1,
+        )
+        col = min(
+            max(int(np.around((lng + 180 - 1 / 24) * 12)), 0),
+            self.turbidity.shape[1] - 1,
+        )
+        monthly = np.asarray(self.turbidity[row, col], dtype=np.float64)
+        monthly = np.concatenate([monthly[-1:], monthly, monthly[:1]])
+        day = times.dayofyear.to_numpy()
+        turbidity = np.where(
+            times.is_leap_year,
+            np.interp(day, month_middles(2016), monthly),
+            np.interp(day, month_middles(2015), monthly),
+        )
+        return turbidity / 20
+
+
+def apparent_zenith(zenith, altitude, temperature=12):
+    """Corrects the zenith (deg) for the atmospheric refraction as NREL SPA does (pvlib, pressure of the
+    altitude), the correction stops below the horizon: tabulated it would be smoothed by the interpolation
+    """
+    from pvlib import atmosphere
+
+    pressure = atmosphere.alt2pres(altitude) / 100
+    elevation = 90 - zenith
+    # 0.26667: radius of the sun, 0.5667: refraction at the horizon (deg)
+    visible = elevation >= -(0.26667 + 0.5667)
+    elevation = np.maximum(elevation, -(0.26667 + 0.5667))
+    refraction = (
+        (pressure / 1010.0)
+        * (283.0 / (273 + temperature))
+        * 1.02
+        / (60 * np.tan(np.radians(elevation + 10.3 / (elevation + 5.11))))
+    )
+    return zenith - refraction * visible
+
+
+def month_middles(year):
+    """The middle day of every month, Dec of the year before and Jan of the next year (see pvlib)"""
+    days = np.array(calendar.mdays[1:], dtype=np.float64)
+    if calendar.isleap(year):
+        days[1] += 1
+    return np.concatenate([[-15.5], np.cumsum(days) - days / 2, [days.sum() + 15.5]])
+
+
+def grid_weights(x, start, step, size):
+    """Returns the index of the grid point before x (array or scalar) and the weight of the next one"""
+    position = (np.asarray(x, dtype=np.float64) - start) / step
+    index = np.clip(np.floor(position), 0, size - 2).astype(np.int64)
+    return index, np.clip(position - index, 0, 1)
+
+
+def interpolate(values, axes):
+    """Multilinear interpolation of the leading axes of values
+
+    Args:
+        values (ndarray): grid x fields
+        axes (list of tuple): per leading axis: index of the grid point before and weight of the next one,
+            see grid_weights (arrays of the points or scalars)
+
+    Returns:
+        ndarray (float64): points x fields
+    """
+    result = 0
+    for offsets in itertools.product((0, 1), repeat=len(axes)):
+        weight = 1.0
+        index = []
+        for (start, next_weight), offset in zip(axes, offsets):
+            index.append(start + offset)
+            weight = weight * (next_weight if offset else 1 - next_weight)
+        result = result + np.asarray(weight)[..., None] * values[tuple(index)]
+    return np.atleast_2d(result)
+
+
+def plane_irradiance(sky, tilt, surface_azimuth):
+    """Transposes the clear sky of the table to the plane of a PV array, the isotropic model of
+    solar.get_plane_irradiance (pvlib get_total_irradiance)
+
+    Args:
+        sky (pandas dataframe): see ClearSkyTable.sky
+        tilt (integer): Inclination of the installation (deg °)
+        surface_azimuth (integer): Orientation of solar installation (deg °) eg 180°=south
+
+    Returns:
+        pandas dataframe: {'POA'}
+    """
+    tilt, surface_azimuth = np.radians(tilt), np.radians(surface_azimuth)
+    # unit vector perpendicular to the plane (east, north, up)
+    beam = np.maximum(
+        sky["beam_east"].to_numpy() * np.sin(tilt) * np.sin(surface_azimuth)
+        + sky["beam_north"].to_numpy() * np.sin(tilt) * np.cos(surface_azimuth)
+        + sky["beam_up"].to_numpy() * np.cos(tilt),
+        0,
+    )
+    diffuse = sky["dhi"].to_numpy() * (1 + np.cos(tilt)) / 2
+    ground = sky["ghi"].to_numpy() * ALBEDO * (1 - np.cos(tilt)) / 2
+    return pd.DataFrame({"POA": beam + diffuse + ground}, index=sky.index)
+
+
+def build_geometry(lat_step, day_step, minutes):
+    """Unit vector of the sun (NREL SPA, without refraction) at longitude 0, lat x day x time x 3"""
+    from pvlib.location import Location
+
+    days = np.arange(0, TROPICAL_YEAR + day_step, day_step)
+    time_of_day = np.arange(0, 24 * 60 + minutes, minutes)
+    epoch = (EPOCH_DAY + days[:, None]) * 86400 + time_of_day[None, :] * 60
+    times = pd.DatetimeIndex(pd.to_datetime(epoch.ravel(), unit="s", utc=True))
+    lats = np.arange(-90, 90 + lat_step / 2, lat_step)
+
+    geometry = np.empty((len(lats), len(days), len(time_of_day), 3), dtype=np.float32)
+    for nr, lat in enumerate(lats):
+        position = Location(float(lat), 0, "UTC", 0).get_solarposition(times)
+        zenith = np.radians(position["zenith"].to_numpy())
+        azimuth = np.radians(position["azimuth"].to_numpy())
+        geometry[nr] = np.stack(
+            [
+                np.sin(zenith) * np.sin(azimuth),
+                np.sin(zenith) * np.cos(azimuth),
+                np.cos(zenith),
+            ],
+            axis=-1,
+        ).reshape(len(days), len(time_of_day), 3)
+    return geometry
+
+
+def build_irradiance(zenith_step, turbidity_step, altitude_step):
+    """Ineichen clear sky for 1 W/m2 extraterrestrial, zenith x turbidity x altitude x (ghi, dni, dhi)"""
+    from pvlib import atmosphere, clearsky
+
+    zeniths = np.arange(0, ZENITH_MAX + zenith_step / 2, zenith_step)
+    turbidities = np.arange(0.5, 8 + turbidity_step / 2, turbidity_step)
+    altitudes = np.arange(0, MAX_ALTITUDE + altitude_step / 2, altitude_step)
+    airmass = atmosphere.get_relative_airmass(zeniths)
+
+    irradiance = np.zeros(
+        (len(zeniths), len(turbidities), len(altitudes), 3), dtype=np.float32
+    )
+    for turbidity_nr, turbidity in enumerate(turbidities):
+        for altitude_nr, altitude in enumerate(altitudes):
+            # below the horizon: nan (airmass) -> 0
+            with np.errstate(divide="ignore", invalid="ignore"):
+                sky = clearsky.ineichen(
+                    zeniths,
+                    atmosphere.get_absolute_airmass(
+                        airmass, atmosphere.alt2pres(altitude)
+                    ),
+                    turbidity,
+                    altitude=altitude,
+                    dni_extra=1.0,
+                )
+            irradiance[:, turbidity_nr, altitude_nr] = np.nan_to_num(
+                np.stack([sky["ghi"], sky["dni"], sky["dhi"]], axis=-1)
+            )
+    return irradiance
+
+
+def build(
+    path,
+    lat_step=1,
+    day_step=4,
+    minutes=5,
+    zenith_step=0.05,
+    turbidity_step=0.25,
+    altitude_step=250,
+):
+    """Tabulates the clear sky of pvlib into the directory path, returns the (memory mapped) table
+
+    Args:
+        path (string): directory of the table
+        lat_step (float): deg between the latitudes of the geometry
+        day_step (float): days between the days of the geometry
+        minutes (int): minutes between the solar times of the geometry
+        zenith_step, turbidity_step, altitude_step (float): grid of the irradiance (deg, -, m)
+    """
+    import h5py
+    import pvlib
+
+    path = Path(path)
+    path.mkdir(parents=True, exist_ok=True)
+    np.save(path / "geometry.npy", build_geometry(lat_step, day_step, minutes))
+    np.save(
+        path / "irradiance.npy",
+        build_irradiance(zenith_step, turbidity_step, altitude_step),
+    )
+    with h5py.File(
+        Path(pvlib.__file__).parent / "data" / "LinkeTurbidities.h5", "r"
+    ) as h5:
+        np.save(path / "turbidity.npy", h5["LinkeTurbidity"][...])
+    meta = {
+        "lat": [-90.0, lat_step],
+        "day": [0.0, day_step],
+        "minutes": [0.0, minutes],
+        "zenith": [0.0, zenith_step],
+        "turbidity": [0.5, turbidity_step],
+        "altitude": [0.0, altitude_step, MAX_ALTITUDE],
+        "pvlib": pvlib.__version__,
+        "built": time.strftime("%Y-%m-%dT%H:%M:%S"),
+    }
+    (path / "meta.json").write_text(json.dumps(meta, indent=2))
+    return ClearSkyTable.load(path)
+
+
+def validate(table, samples=100, seed=0):
+    """Measures the error of the table against pvlib: the POA irradiance (W/m2, 15min) of a day of random
+    sites (altitude upto 3000m), days (2023-2030) and orientations
+
+    Returns:
+        dict: max, p99 and mean (sun up) absolute error of the POA irradiance (W/m2), samples
+    """
+    from pvlib.location import Location
+    from shared_code import solar
+
+    rng = np.random.default_rng(seed)
+    errors = []
+    for _ in range(samples):
+        lat, lng = rng.uniform(-66, 66), rng.uniform(-180, 180)
+        altitude = rng.uniform(0, 3000)
+        tilt, azimuth = rng.uniform(0, 90), rng.uniform(0, 360)
+        times = pd.date_range(
+            pd.Timestamp("2023-01-01", tz="UTC")
+            + pd.Timedelta(days=int(rng.integers(0, 8 * 365))),
+            periods=96,
+            freq="15min",
+        )
+        sky = solar.get_sky(Location(lat, lng, "UTC", altitude), times)
+        expected = solar.get_plane_irradiance(sky, tilt, azimuth)["POA"].to_numpy()
+        actual = plane_irradiance(table.sky(lat, lng, altitude, times), tilt, azimuth)[
+            "POA"
+        ].to_numpy()
+        errors.append(np.abs(actual - expected)[expected > 0])
+    errors = np.concatenate(errors)
+    return {
+        "max_poa_error": round(float(errors.max()), 2),
+        "p99_poa_error": round(float(np.percentile(errors, 99)), 2),
+        "mean_poa_error": round(float(errors.mean()), 3),
+        "samples": samples,
+    }
+
+
+# the table of CLEARSKY_TABLE, loaded on first use
+_table = None
+_table_lock = threading.Lock()
+
+
+def get_table():
+    """Returns the (memory mapped) table of CLEARSKY_TABLE"""
+    global _table
+    if _table is None:
+        with _table_lock:
+            if _table is None:
+                _table = ClearSkyTable.load(CLEARSKY_TABLE)
+    return _table
+
+
+def set_table(table):
+    """Replaces the table (None = load CLEARSKY_TABLE on next use), eg. for tests"""
+    global _table
+    _table = table
+
+
+def use_table(location, altitude):
+    """True when the clear sky of a site is answered from the table, see CLEARSKY_ENGINE"""
+    return CLEARSKY_ENGINE == "table" and get_table().covers(
+        location["lat"], location["lng"], altitude
+    )
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("path", nargs="?", default=CLEARSKY_TABLE)
+    parser.add_argument(
+        "--lat-step", default=1.0, type=float, help="deg between the latitudes"
+    )
+    parser.add_argument(
+        "--day-step", default=4.0, type=float, help="days between the days"
+    )
+    parser.add_argument(
+        "--minutes", default=5, type=int, help="minutes between the solar times"
+    )
+    parser.add_argument(
+        "--samples", default=100, type=int, help="random site days of the error report"
+    )
+    args = parser.parse_args()
+
+    started = time.perf_counter()
+    table = build(args.path, args.lat_step, args.day_step, args.minutes)
+    table.meta["error"] = validate(table, args.samples)
+    (Path(args.path) / "meta.json").write_text(json.dumps(table.meta, indent=2))
+    size = sum(
+        array.nbytes for array in (table.geometry, table.irradiance, table.turbidity)
+    )
+    print(
+        f"{args.path}: {size / 2**20:.0f} MB in {time.perf_counter() - started:.0f} s"
+    )
+    print(json.dumps(table.meta["error"]))
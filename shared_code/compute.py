@@ -0,0 +1,157 @@
+"""The clear sky and prediction work of the requests runs on a pool, not on the event loop.
+
+A bounded queue (admission control): when COMPUTE_QUEUE_SIZE jobs are waiting or running, a request is
+rejected (Overloaded -> 503 with Retry-After) instead of waiting longer and longer.
+"""
+import os
+import time
+import asyncio
+import threading
+import multiprocessing
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+
+from shared_code import metrics
+
+# thread: the jobs run on threads of this process, process: on worker processes with the model preloaded
+COMPUTE_POOL = os.environ.get("COMPUTE_POOL", "thread")
+# threads or processes of the pool
+COMPUTE_WORKERS = int(os.environ.get("COMPUTE_WORKERS", "4"))
+# max jobs waiting or running, the next request gets a 503
+COMPUTE_QUEUE_SIZE = int(os.environ.get("COMPUTE_QUEUE_SIZE", "64"))
+# Retry-After (sec) of a 503
+COMPUTE_RETRY_AFTER = int(os.environ.get("COMPUTE_RETRY_AFTER", "1"))
+
+
+class Overloaded(Exception):
+    """The compute queue is full: the request is rejected instead of queued"""
+
+
+_executor = None
+_lock = threading.Lock()
+# jobs submitted and not finished (waiting + running)
+_jobs = 0
+
+metrics.register(
+    metrics.Gauge(
+        "compute_queue_depth",
+        "jobs waiting or running on the compute pool",
+        [],
+        lambda: {(): _jobs},
+    )
+)
+queue_wait_seconds = metrics.register(
+    metrics.Histogram(
+        "compute_queue_wait_seconds", "time a job waited for a free worker"
+    )
+)
+rejected_total = metrics.register(
+    metrics.Counter(
+        "compute_rejected_total", "requests rejected (503) by a full compute queue"
+    )
+)
+
+
+def init_worker():
+    """Initializer of a worker process: loads the model and pvlib before the first job"""
+    from shared_code import server, startup
+
+    server.limit_blas_threads()
+    startup.warmup()
+
+
+def get_executor():
+    """Returns the pool of COMPUTE_POOL, created on first use"""
+    global _executor
+    if _executor is None:
+        with _lock:
+            if _executor is None:
+                if COMPUTE_POOL == "process":
+                    # spawn: forking a process with threads (event loop, executors) is not safe
+                    _executor = ProcessPoolExecutor(
+                        COMPUTE_WORKERS,
+                        mp_context=multiprocessing.get_context("spawn"),
+                        initializer=init_worker,
+                    )
+                else:
+                    _executor = ThreadPoolExecutor(
+                        COMPUTE_WORKERS, thread_name_prefix="compute"
+                    )
+    return _executor
+
+
+def start():
+    """Starts the worker processes (they load the model) before the first request"""
+    if COMPUTE_POOL == "process":
+        executor = get_executor()
+        for _ in range(COMPUTE_WORKERS):
+            executor.submit(time.sleep, 0)
+
+
+def stop():
+    global _executor
+    with _lock:
+        executor, _executor = _executor, None
+    if executor is not None:
+        executor.shutdown(wait=False, cancel_futures=True)
+
+
+def execute(func, args, kwargs, stage, submitted):
+    """Runs a job on a worker
+
+    Returns:
+        tuple: wait (sec) before the job started, its stages (see metrics.collect_timings), result
+    """
+    wait = time.time() - submitted
+    with metrics.collect_timings() as timings:
+        if stage is None:
+            result = func(*args, **kwargs)
+        else:
+            with metrics.stage(stage):
+                result = func(*args, **kwargs)
+    return wait, timings, result
+
+
+def release(future):
+    global _jobs
+    with _lock:
+        _jobs -= 1
+
+
+async def run(func, *args, stage=None, **kwargs):
+    """Returns func(*args, **kwargs) computed on the pool (func and the arguments are pickled for a process)
+
+    Args:
+        func (function): a module level function
+        stage (string): records the duration of the job as this stage, see metrics.stage
+
+    Raises:
+        Overloaded: COMPUTE_QUEUE_SIZE jobs are waiting or running
+    """
+    global _jobs
+    with _lock:
+        if _jobs >= COMPUTE_QUEUE_SIZE:
+            rejected_total.inc()
+            raise Overloaded(
+                f"compute queue is full ({COMPUTE_QUEUE_SIZE} jobs), retry later"
+            )
+        _jobs += 1
+    try:
+        future = get_executor().submit(execute, func, args, kwargs, stage, time.time())
+    except BaseException:
+        release(None)
+        raise
+    # the job leaves the queue when it is done, also when the request is cancelled
+    future.add_done_callback(release)
+    try:
+        wait, timings, result = await asyncio.wrap_future(future)
+    except BrokenProcessPool:
+        # a worker died (eg. out of memory): the next job starts a new pool
+        stop()
+        raise
+
+    queue_wait_seconds.observe(wait)
+    # a worker process has its own metrics: its stages are recorded here
+    for name, duration in timings:
+        metrics.record(name, duration, observe=COMPUTE_POOL == "process")
+    return result
@@ -0,0 +1,159 @@
+import os
+
+import pandas as pd
+
+# number of rows encoded per streamed chunk
+STREAM_CHUNK_ROWS = int(os.environ.get("STREAM_CHUNK_ROWS", "2000"))
+
+
+def iter_ndjson(df, chunk_rows=STREAM_CHUNK_ROWS):
+    """Encodes a DataFrame as newline delimited json (one record per line), chunk by chunk
+
+    Args:
+        df (pandas dataframe): rows to encode
+        chunk_rows (int): rows per chunk
+
+    Yields:
+        bytes: encoded chunk
+    """
+    for start in range(0, len(df), chunk_rows):
+        chunk = df.iloc[start : start + chunk_rows]
+        yield (chunk.to_json(orient="records", lines=True).rstrip("\n") + "\n").encode()
+
+
+def iter_csv(df, chunk_rows=STREAM_CHUNK_ROWS):
+    """Encodes a DataFrame as csv (header + rows), chunk by chunk
+
+    Args:
+        df (pandas dataframe): rows to encode
+        chunk_rows (int): rows per chunk
+
+    Yields:
+        bytes: encoded chunk
+    """
+    for start in range(0, max(len(df), 1), chunk_rows):
+        chunk = df.iloc[start : start + chunk_rows]
+        yield chunk.to_csv(index=False, header=start == 0).encode()
+
+
+# supported response formats: format name -> media type
+MEDIA_TYPES = {
+    "json": "application/json",
+    "columns": "application/vnd.solar-forecast.columns+json",
+    "arrow": "application/vnd.apache.arrow.stream",
+    "csv": "text/csv",
+}
+
+
+class UnsupportedFormat(Exception):
+    """The requested format is unknown or its library (pyarrow) is not installed"""
+
+
+def negotiate(format=None, accept=None):
+    """Returns the response format: the 'format' query param, else the supported media type of the Accept header
+    with the highest q (q=0: not acceptable), else "json"
+
+    Args:
+        format (string): json, columns, arrow or csv
+        accept (string): Accept header
+
+    Returns:
+        string: format name, see MEDIA_TYPES
+    """
+    if format:
+        if format not in MEDIA_TYPES:
+            raise UnsupportedFormat(f"format must be one of: {', '.join(MEDIA_TYPES)}")
+        return format
+    if accept:
+        for media_type in accepted_media_types(accept):
+            for name, known in MEDIA_TYPES.items():
+                if media_type == known:
+                    return name
+    return "json"
+
+
+def accepted_media_types(accept):
+    """Returns the media types of an Accept header, highest q first (same q: header order), without q=0"""
+    preferences = []
+    for part in accept.split(","):
+        media_type, *params = [item.strip() for item in part.split(";")]
+        q = 1.0
+        for param in params:
+            name, _, value = param.partition("=")
+            if name.strip() == "q":
+                try:
+                    q = float(value)
+                except ValueError:
+                    q = 0.0
+        if q > 0:
+            preferences.append((q, media_type))
+    return [
+        media_type for q, media_type in sorted(preferences, key=lambda item: -item[0])
+    ]
+
+
+def encode(df, format="json"):
+    """Encodes a DataFrame without boxing every cell into a Python object
+
+    Args:
+        df (pandas dataframe): rows to encode
+        format (string):
+            json: list of records [{col: value}]
+            columns: one array per column {col: [values]}
+            arrow: Apache Arrow IPC stream
+            csv: header + rows
+
+    Returns:
+        bytes: encoded DataFrame
+    """
+    if format == "json":
+        return df.to_json(orient="records").encode()
+    if format == "columns":
+        return (
+            "{"
+            + ",".join(
+                f'"{col}":' + df[col].to_json(orient="values") for col in df.columns
+            )
+            + "}"
+        ).encode()
+    if format == "arrow":
+        return encode_arrow(df)
+    if format == "csv":
+        return df.to_csv(index=False).encode()
+    raise UnsupportedFormat(f"format must be one of: {', '.join(MEDIA_TYPES)}")
+
+
+def encode_arrow(df):
+    """Encodes a DataFrame as Apache Arrow IPC stream, the dtypes (eg. int32 dt, int16 clear_sky) are kept"""
+    try:
+        import pyarrow as pa
+    except ImportError:
+        raise UnsupportedFormat("arrow format needs pyarrow: pip install pyarrow")
+
+    table = pa.Table.from_pandas(df, preserve_index=False)
+    sink = pa.BufferOutputStream()
+    with pa.ipc.new_stream(sink, table.schema) as writer:
+        writer.write_table(table)
+    return sink.getvalue().to_pybytes()
+
+
+def encode_many(dfs, format="json"):
+    """Encodes a list of DataFrames (eg. one per installation of a batch)
+
+    Args:
+        dfs (list of pandas dataframe): rows to encode
+        format (string): see encode
+            json, columns: json array with one item per DataFrame
+            arrow, csv: one table, the column 'installation' is the position of the DataFrame in the list
+
+    Returns:
+        bytes: encoded DataFrames
+    """
+    if format in ("json", "columns"):
+        return b"[" + b",".join(encode(df, format) for df in dfs) + b"]"
+    if not dfs:
+        return encode(pd.DataFrame({"installation": []}), format)
+    df = pd.concat(
+        [df.assign(installation=nr) for nr, df in enumerate(dfs)], ignore_index=True
+    )
+    return encode(df[["installation"] + list(dfs[0].columns)], format)
@@ -0,0 +1,363 @@
+import math
+import time
+import asyncio
+import logging
+import numpy as np
+from shared_code import weatherforecast, solar, ml, providers, metrics, compute
+
+
+def getWeather(installation, provider=None):
+    """Returns the 15min weather forecast of an installation for the given provider
+
+    Args:
+        installation (_type_ dict): see Installation
+        provider (_type_ string): name of the provider, see providers.PROVIDERS
+
+    Returns:
+        _type_ DataFrame: dt	temp	pressure	humidity	wind_speed	wind_deg	clouds_all	weather_id	clear_sky	day_of_year
+    """
+    return providers.get_provider(provider).getData(installation)
+
+
+async def getWeatherAsync(installation, provider=None):
+    """Async version of getWeather"""
+    return await providers.get_provider(provider).getDataAsync(installation)
+
+
+def groupByGridCell(installations):
+    """Groups installations by weather grid cell
+
+    Returns:
+        _type_ list of lists: the indexes of the installations of every grid cell
+    """
+    groups = {}
+    for nr, installation in enumerate(installations):
+        groups.setdefault(weatherforecast.grid_key(installation), []).append(nr)
+    return list(groups.values())
+
+
+# resolutions of a forecast: rows of the 15min weather
+RESOLUTIONS = {"15min": 900, "30min": 1800, "60min": 3600}
+
+
+def forecastWindow(
+    start=None,
+    end=None,
+    horizon_hours=None,
+    resolution="15min",
+    daylight_only=False,
+    now=None,
+):
+    """Returns the part of the forecast a request needs, only these rows are calculated.
+    Default: the whole forecast (WEATHER_FORECAST_DAYS from today 00:00) at 15min.
+
+    Args:
+        start (int): epoch sec of the first row, default the start of the forecast (now with horizon_hours)
+        end (int): epoch sec, rows before end
+        horizon_hours (int): instead of end: hours after start
+        resolution (string): 15min, 30min or 60min
+        daylight_only (bool): only the rows with clear sky power (sun above the horizon)
+        now (float): epoch sec, for tests
+
+    Returns:
+        _type_ dict: start, end, step (sec), freq, daylight_only, forecast_days (to fetch)
+    """
+    now = time.time() if now is None else now
+    if resolution not in RESOLUTIONS:
+        raise ValueError(f"resolution must be one of {', '.join(RESOLUTIONS)}")
+    step = RESOLUTIONS[resolution]
+    if horizon_hours is not None:
+        if end is not None:
+            raise ValueError("use end or horizon_hours, not both")
+        if horizon_hours <= 0:
+            raise ValueError("horizon_hours must be positive")
+        if start is None:
+            start = int(now // step * step)
+        end = start + horizon_hours * 3600
+    if start is not None and end is not None and start >= end:
+        raise ValueError("start must be before end")
+
+    days = None
+    if end is not None:
+        # the forecast starts today 00:00 (local time)
+        days = math.ceil((end - now) / 86400) + 1
+        if days > weatherforecast.MAX_FORECAST_DAYS:
+            raise ValueError(
+                f"end must be within {weatherforecast.MAX_FORECAST_DAYS - 1} days from now"
+            )
+        days = max(days, 1)
+    return {
+        "start": start,
+        "end": end,
+        "step": step,
+        "freq": resolution,
+        "daylight_only": daylight_only,
+        "forecast_days": days,
+    }
+
+
+def selectWindow(df, window):
+    """Returns the rows (dt) of a 15min frame in the window at its resolution: a coarser resolution
+    takes every n-th row, from the first row of the forecast (local midnight)
+    """
+    if window is None or df.empty:
+        return df
+    dt = df["dt"].to_numpy()
+    rows = np.ones(len(dt), dtype=bool)
+    if window["start"] is not None:
+        rows &= dt >= window["start"]
+    if window["end"] is not None:
+        rows &= dt < window["end"]
+    if window["step"] != 900:
+        rows &= (dt - dt[0]) % window["step"] == 0
+    if rows.all():
+        return df
+    return df[rows].reset_index(drop=True)
+
+
+def daylightRows(df):
+    """Returns the rows with clear sky power (sun above the horizon)"""
+    rows = df["clear_sky"].to_numpy() > 0
+    if rows.all():
+        return df
+    return df[rows].reset_index(drop=True)
+
+
+def windowForecast(df, window):
+    """Returns the rows of a calculated (eg. precomputed) forecast in the window, see forecastWindow"""
+    df = selectWindow(df, window)
+    if window is not None and window["daylight_only"]:
+        df = daylightRows(df)
+    return df
+
+
+def coversWindow(df, window):
+    """True if a calculated (eg. precomputed) 15min forecast has the rows upto the end of the window"""
+    if window is None or window["end"] is None:
+        return True
+    return not df.empty and df["dt"].iloc[-1] + 900 >= window["end"]
+
+
+def weatherRequests(installations, groups, window):
+    """One installation per grid cell, with the days of forecast the window needs"""
+    if window is None or window["forecast_days"] is None:
+        return [installations[members[0]] for members in groups]
+    return [
+        dict(installations[members[0]], forecast_days=window["forecast_days"])
+        for members in groups
+    ]
+
+
+def calcForecast(installation, provider=None, window=None):
+    """Calculates the 15min power prediction + weather of one installation
+
+    Args:
+        installation (_type_ dict): see Installation
+        provider (_type_ string): weather provider
+        window (_type_ dict): rows to calculate, see forecastWindow (default all)
+
+    Returns:
+        _type_ DataFrame: dt/clear_sky/P_predicted/temp/pressure/humidity/wind_speed/wind_deg/clouds_all/weather_id/day_of_year
+    """
+    return calcForecastBatch([installation], provider, window)[0]
+
+
+async def calcForecastAsync(installation, provider=None, window=None):
+    """Async version of calcForecast"""
+    return (await calcForecastBatchAsync([installation], provider, window))[0]
+
+
+def calcForecastBatch(installations, provider=None, window=None):
+    """Calculates the 15min power prediction + weather for a list of installations.
+    The work scales with the number of distinct locations, not the number of installations:
+        - one weather forecast per weather grid cell + timezone, fetched in bulk when the provider can
+        - one clear sky calculation per distinct site geometry
+        - one mlp.predict for all installations together
+
+    Args:
+        installations (_type_ list of dict): see Installation
+        provider (_type_ string): weather provider
+        window (_type_ dict): rows to calculate, see forecastWindow (default all)
+
+    Returns:
+        _type_ list of DataFrame: one per installation, same order, see calcForecast
+    """
+    groups = groupByGridCell(installations)
+    with metrics.stage("weather"):
+        weathers = providers.get_provider(provider).getDataBulk(
+            weatherRequests(installations, groups, window)
+        )
+    return predictGroups(installations, groups, weathers, window)
+
+
+async def calcForecastBatchAsync(installations, provider=None, window=None):
+    """Async version of calcForecastBatch: the weather of all grid cells is fetched concurrently,
+    the clear sky and the prediction run on the compute pool (raises compute.Overloaded when it is full)
+    """
+    groups = groupByGridCell(installations)
+    with metrics.stage("weather"):
+        weathers = await providers.get_provider(provider).getDataBulkAsync(
+            weatherRequests(installations, groups, window)
+        )
+    return await compute.run(predictGroups, installations, groups, weathers, window)
+
+
+def predictGroups(installations, groups, weathers, window=None):
+    """Adds the clear sky power to the weather of every installation and predicts the power
+
+    Args:
+        installations (_type_ list of dict): see Installation
+        groups (_type_ list of lists): see groupByGridCell
+        weathers (_type_ list of DataFrame): 15min weather forecast per group
+        window (_type_ dict): rows to calculate, see forecastWindow (default all)
+
+    Returns:
+        _type_ list of DataFrame: one per installation, same order, see calcForecast
+    """
+    dataSets = [None] * len(installations)
+    with metrics.stage("clear_sky"):
+        for members, weather in zip(groups, weathers):
+            # only the rows of the window get a clear sky and a prediction
+            weather = selectWindow(weather, window)
+            freq = window["freq"] if window else "15min"
+            for nr, clear_sky in zip(
+                members, clearSkyGroup(installations, members, weather, freq)
+            ):
+                # fill in 'clearSky' in the provided col (default val=0)
+                dataSet = weather.copy()
+                dataSet["clear_sky"] = clear_sky
+                if window and window["daylight_only"]:
+                    dataSet = daylightRows(dataSet)
+                dataSets[nr] = dataSet
+
+    logging.info(
+        f"Forecast batch: {len(installations)} installations in {len(groups)} grid cells"
+    )
+
+    # Get ML prediction: one matrix for all installations
+    with metrics.stage("predict"):
+        return ml.enrichDataFramesWithPrediction(dataSets)
+
+
+def clearSkyGroup(installations, members, weather, freq="15min"):
+    """Returns the clear sky power (Series) of the members of a grid cell for the timestamps of its weather
+    (every freq from the first upto the last timestamp)
+    """
+    if not members:
+        return []
+    if weather.empty:
+        return [weather["dt"].astype("int16") for nr in members]
+    # Determine startHour and stopHour
+    startEpochHour, stopEpochHour = (
+        weather["dt"].iloc[0],
+        weather["dt"].iloc[-1],
+    )
+
+    # Calculate ClearSky for every member (date= epoch in sec-10digits)
+    clear_sky_dfs = solar.getClearSkyBatch(
+        [installations[nr] for nr in members],
+        startEpochHour=startEpochHour,
+        stopEpochHour=stopEpochHour,
+        freq=freq,
+    )
+    return [clear_sky_df["clear_sky"] for clear_sky_df in clear_sky_dfs]
+
+
+# weather fields of a forecast, compared by diffForecast
+WEATHER_COLUMNS = [col for col in ml.FEATURE_COLUMNS if col != "clear_sky"]
+
+
+def diffForecast(weather, previous):
+    """Aligns a new 15min weather forecast on the previous forecast of the same installation
+
+    Args:
+        weather (_type_ DataFrame): new weather, see getWeather
+        previous (_type_ DataFrame): previous forecast, see calcForecast
+
+    Returns:
+        _type_ tuple of ndarrays: previous clear_sky and P_predicted per row of weather (NaN for new timestamps),
+        changed (bool): rows with a new timestamp or another weather, the prediction of the others is still valid
+    """
+    old = previous.set_index("dt").reindex(weather["dt"].to_numpy())
+    new_values = weather[WEATHER_COLUMNS].to_numpy(dtype=np.float64)
+    old_values = old[WEATHER_COLUMNS].to_numpy(dtype=np.float64)
+    same = (new_values == old_values) | (np.isnan(new_values) & np.isnan(old_values))
+    clear_sky = old["clear_sky"].to_numpy(dtype=np.float64)
+    changed = ~same.all(axis=1) | np.isnan(clear_sky)
+    return clear_sky, old["P_predicted"].to_numpy(dtype=np.float64), changed
+
+
+def updateForecastBatch(installations, previous, provider=None):
+    """Incremental calcForecastBatch: only the rows of which the weather changed since the previous forecast
+    (or with a new timestamp) are predicted again, the clear sky of the previous forecast is reused.
+    The prediction of a row only depends on the features of that row, so the result equals calcForecastBatch.
+    A previous forecast of another model version is recalculated completely.
+
+    Args:
+        installations (_type_ list of dict): see Installation
+        previous (_type_ list of DataFrame): previous forecast per installation (None = calculate all rows)
+        provider (_type_ string): weather provider
+
+    Returns:
+        _type_ tuple: list of DataFrame (see calcForecast), number of recomputed rows
+    """
+    # predicted by the active model (activated by another worker?)
+    ml.get_model()
+    previous = [
+        None if df is None or df.attrs.get("model_version") != ml.model_version else df
+        for df in previous
+    ]
+    groups = groupByGridCell(installations)
+    with metrics.stage("weather"):
+        weathers = providers.get_provider(provider).getDataBulk(
+            [installations[members[0]] for members in groups]
+        )
+
+    dataSets = [None] * len(installations)
+    powers = [None] * len(installations)
+    changes = [None] * len(installations)
+    for members, weather in zip(groups, weathers):
+        missing = []
+        for nr in members:
+            dataSet = weather.copy()
+            if previous[nr] is None:
+                changes[nr] = np.ones(len(dataSet), dtype=bool)
+                powers[nr] = np.zeros(len(dataSet), dtype=np.int64)
+                missing.append(nr)
+            else:
+                clear_sky, power, changes[nr] = diffForecast(weather, previous[nr])
+                powers[nr] = np.nan_to_num(power).astype(np.int64)
+                # timestamps beyond the previous horizon: new clear sky
+                if np.isnan(clear_sky).any():
+                    missing.append(nr)
+                else:
+                    dataSet["clear_sky"] = clear_sky.astype(
+                        previous[nr]["clear_sky"].dtype
+                    )
+            dataSets[nr] = dataSet
+        for nr, clear_sky in zip(
+            missing, clearSkyGroup(installations, missing, weather)
+        ):
+            dataSets[nr]["clear_sky"] = clear_sky
+
+    # one prediction for the changed rows of all installations
+    X = np.concatenate(
+        [
+            ml.featureMatrix(dataSet)[changed]
+            for dataSet, changed in zip(dataSets, changes)
+        ]
+    )
+    with metrics.stage("predict"):
+        power = ml.predictPower(X) if len(X) else np.zeros(0, dtype=np.int64)
+    start = 0
+    for nr, changed in enumerate(changes):
+        stop = start + int(changed.sum())
+        powers[nr][changed] = power[start:stop]
+        start = stop
+
+    logging.info(
+        f"Forecast update: {len(X)} of {sum(len(d) for d in dataSets)} rows recomputed"
+    )
+    return [
+        ml.combinePrediction(dataSet, power) for dataSet, power in zip(dataSets, powers)
+    ], len(X)
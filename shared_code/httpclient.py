@@ -0,0 +1,71 @@
+import os
+import time
+import asyncio
+import logging
+from urllib.parse import urlparse
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+from shared_code import metrics
+
+# timeout (sec) for connecting and reading an upstream response
+HTTP_TIMEOUT = float(os.environ.get("HTTP_TIMEOUT", "10"))
+# max number of simultaneous upstream requests (= size of the keep-alive connection pool)
+HTTP_MAX_CONCURRENCY = int(os.environ.get("HTTP_MAX_CONCURRENCY", "16"))
+# retries on connection errors and 429/5xx, waiting backoff * 2^(retry-1) sec in between
+HTTP_RETRIES = int(os.environ.get("HTTP_RETRIES", "3"))
+HTTP_BACKOFF = float(os.environ.get("HTTP_BACKOFF", "0.5"))
+
+
+def create_session():
+    """Creates a requests Session with a keep-alive connection pool and retry with backoff"""
+    retry = Retry(
+        total=HTTP_RETRIES,
+        backoff_factor=HTTP_BACKOFF,
+        status_forcelist=[429, 500, 502, 503, 504],
+        allowed_methods=["GET"],
+    )
+    adapter = HTTPAdapter(
+        pool_connections=HTTP_MAX_CONCURRENCY,
+        pool_maxsize=HTTP_MAX_CONCURRENCY,
+        max_retries=retry,
+    )
+    session = requests.Session()
+    session.mount("http://", adapter)
+    session.mount("https://", adapter)
+    return session
+
+
+# Shared by all weather providers
+session = create_session()
+
+# The blocking requests run in this pool: it bounds the concurrency and keeps the event loop free
+executor = ThreadPoolExecutor(
+    max_workers=HTTP_MAX_CONCURRENCY, thread_name_prefix="http"
+)
+
+
+def get_json(url, params=None):
+    """GET url and return the decoded json body, raises requests.HTTPError on a bad status"""
+    host = urlparse(url).netloc
+    start = time.perf_counter()
+    try:
+        resp = session.get(url, params=params, timeout=HTTP_TIMEOUT)
+        resp.raise_for_status()
+    except Exception:
+        metrics.upstream_requests_total.inc(host=host, outcome="error")
+        raise
+    finally:
+        metrics.upstream_seconds.observe(time.perf_counter() - start, host=host)
+    metrics.upstream_requests_total.inc(host=host, outcome="ok")
+    logging.debug(f"GET {resp.url} {resp.status_code}")
+    return resp.json()
+
+
+async def get_json_async(url, params=None):
+    """Async version of get_json: awaits the request without blocking the event loop"""
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(executor, get_json, url, params)
@@ -0,0 +1,195 @@
+"""Compact inference of the MLP model: the forward pass of the fitted MLPRegressor in NumPy (float32).
+
+The weights are exported once to a small .npz (no scikit-learn needed to load it):
+    python -m shared_code.inference [model.pkl] [model.npz]
+"""
+import logging
+import argparse
+import hashlib
+import pickle
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+
+# rows per forward pass: bounds the memory of the hidden layers (rows x 100 float32)
+CHUNK_ROWS = 65536
+
+ACTIVATIONS = {
+    "identity": lambda x: x,
+    "relu": lambda x: np.maximum(x, 0, out=x),
+    "tanh": lambda x: np.tanh(x, out=x),
+    "logistic": lambda x: np.divide(1, 1 + np.exp(-x, out=x), out=x),
+}
+
+
+def file_digest(path):
+    """Returns the sha256 of a file: links an exported .npz to its pickle"""
+    return hashlib.sha256(Path(path).read_bytes()).hexdigest()
+
+
+class NumpyMLP:
+    """Forward pass of a fitted scikit-learn MLPRegressor with contiguous float32 weights.
+    Same activations as scikit-learn, predict(X) equals MLPRegressor.predict within float32 precision.
+    Thread safe: the weights are read-only, every call has its own buffers.
+
+    Args:
+        coefs (list of ndarray): weights per layer (inputs x outputs)
+        intercepts (list of ndarray): bias per layer
+        activation (str): activation of the hidden layers: relu, tanh, logistic or identity
+        out_activation (str): activation of the output layer
+        feature_names (list of str): input features in order
+        source (str): sha256 of the pickle the weights come from
+    """
+
+    def __init__(
+        self,
+        coefs,
+        intercepts,
+        activation="relu",
+        out_activation="identity",
+        feature_names=None,
+        source=None,
+    ):
+        self.coefs = [self._readonly(coef) for coef in coefs]
+        self.intercepts = [self._readonly(intercept) for intercept in intercepts]
+        self.activation = activation
+        self.out_activation = out_activation
+        self.feature_names = list(feature_names) if feature_names is not None else None
+        self.source = source
+        self.n_features_in_ = self.coefs[0].shape[0]
+
+    @staticmethod
+    def _readonly(array):
+        array = np.ascontiguousarray(array, dtype=np.float32)
+        array.flags.writeable = False
+        return array
+
+    @classmethod
+    def from_sklearn(cls, mlp, source=None):
+        """Extracts the weights of a fitted MLPRegressor"""
+        return cls(
+            mlp.coefs_,
+            mlp.intercepts_,
+            activation=mlp.activation,
+            out_activation=mlp.out_activation_,
+            feature_names=getattr(mlp, "feature_names_in_", None),
+            source=source,
+        )
+
+    @classmethod
+    def load(cls, path):
+        """Loads the weights exported by save"""
+        with np.load(path, allow_pickle=False) as npz:
+            layers = int(npz["layers"])
+            return cls(
+                [npz[f"coef_{nr}"] for nr in range(layers)],
+                [npz[f"intercept_{nr}"] for nr in range(layers)],
+                activation=str(npz["activation"]),
+                out_activation=str(npz["out_activation"]),
+                feature_names=npz["feature_names"].tolist()
+                if "feature_names" in npz
+                else None,
+                source=str(npz["source"]) if "source" in npz else None,
+            )
+
+    def save(self, path):
+        """Exports the weights to a .npz"""
+        arrays = {f"coef_{nr}": coef for nr, coef in enumerate(self.coefs)}
+        arrays.update({f"intercept_{nr}": b for nr, b in enumerate(self.intercepts)})
+        if self.feature_names is not None:
+            arrays["feature_names"] = np.array(self.feature_names)
+        if self.source is not None:
+            arrays["source"] = np.array(self.source)
+        np.savez(
+            path,
+            layers=np.array(len(self.coefs)),
+            activation=np.array(self.activation),
+            out_activation=np.array(self.out_activation),
+            **arrays,
+        )
+
+    def predict(self, X):
+        """Predicts the output of every row of X (rows x features), batched per CHUNK_ROWS
+
+        Returns:
+            ndarray (float64): one value per row (single output) or rows x outputs
+        """
+        X = np.asarray(X, dtype=np.float32)
+        if X.ndim != 2 or X.shape[1] != self.n_features_in_:
+            raise ValueError(
+                f"X has shape {X.shape}, the model expects {self.n_features_in_} features"
+            )
+        out = np.empty((len(X), self.coefs[-1].shape[1]), dtype=np.float64)
+        for start in range(0, len(X), CHUNK_ROWS):
+            out[start : start + CHUNK_ROWS] = self._forward(
+                X[start : start + CHUNK_ROWS]
+            )
+        return out.ravel() if out.shape[1] == 1 else out
+
+    def _forward(self, activations):
+        last = len(self.coefs) - 1
+        for nr, (coef, intercept) in enumerate(zip(self.coefs, self.intercepts)):
+            activations = activations @ coef
+            activations += intercept
+            ACTIVATIONS[self.out_activation if nr == last else self.activation](
+                activations
+            )
+        return activations
+
+
+class SklearnMLP:
+    """The unpickled scikit-learn model behind the same predict(X ndarray) interface as NumpyMLP"""
+
+    def __init__(self, mlp):
+        self.mlp = mlp
+        self.feature_names = list(getattr(mlp, "feature_names_in_", [])) or None
+        self.n_features_in_ = mlp.n_features_in_
+
+    def predict(self, X):
+        if self.feature_names is None:
+            return self.mlp.predict(X)
+        # the model was fitted with feature names
+        return self.mlp.predict(pd.DataFrame(X, columns=self.feature_names, copy=False))
+
+
+def export(pkl_path, npz_path=None):
+    """Exports the weights of a pickled MLPRegressor to a .npz (default: same name), returns its path"""
+    pkl_path = Path(pkl_path)
+    npz_path = Path(npz_path) if npz_path else pkl_path.with_suffix(".npz")
+    with open(pkl_path, "rb") as model_file:
+        mlp = pickle.load(model_file)
+    NumpyMLP.from_sklearn(mlp, source=file_digest(pkl_path)).save(npz_path)
+    return npz_path
+
+
+def load_numpy(pkl_path):
+    """Returns the NumpyMLP of a pickled model: from the exported .npz when it belongs to this pickle,
+    from the pickle (needs scikit-learn) otherwise
+    """
+    pkl_path = Path(pkl_path)
+    npz_path = pkl_path.with_suffix(".npz")
+    if npz_path.exists():
+        model = NumpyMLP.load(npz_path)
+        if model.source == file_digest(pkl_path):
+            return model
+    with open(pkl_path, "rb") as model_file:
+        return NumpyMLP.from_sklearn(
+            pickle.load(model_file), source=file_digest(pkl_path)
+        )
+
+
+if __name__ == "__main__":
+    from shared_code import ml
+
+    parser = argparse.ArgumentParser(
+        description="Exports the weights of a pickled model for ML_BACKEND=numpy"
+    )
+    parser.add_argument("pkl_path", nargs="?", default=str(ml.model_path))
+    parser.add_argument(
+        "npz_path", nargs="?", help="default: the pickle with the .npz suffix"
+    )
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO, format="%(message)s")
+    logging.info(f"exported {export(args.pkl_path, args.npz_path)}")
@@ -0,0 +1,265 @@
+import os
+import time
+import bisect
+import threading
+import contextvars
+from contextlib import contextmanager
+
+# SERVER_TIMING: on = add a Server-Timing header with the duration of every stage to the responses
+SERVER_TIMING = os.environ.get("SERVER_TIMING", "off")
+
+# histogram buckets (sec)
+BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+PREFIX = "solar_forecast_"
+
+
+def format_labels(names, values):
+    if not names:
+        return ""
+    return (
+        "{" + ",".join(f'{name}="{value}"' for name, value in zip(names, values)) + "}"
+    )
+
+
+class Counter:
+    """Counter per label values, thread safe"""
+
+    type = "counter"
+
+    def __init__(self, name, help, labelnames=()):
+        self.name = PREFIX + name
+        self.help = help
+        self.labelnames = tuple(labelnames)
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def inc(self, amount=1, **labels):
+        key = tuple(labels[name] for name in self.labelnames)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def value(self, **labels):
+        return self._values.get(tuple(labels[name] for name in self.labelnames), 0)
+
+    def samples(self):
+        with self._lock:
+            values = dict(self._values)
+        for key, value in sorted(values.items()):
+            yield self.name + format_labels(self.labelnames, key), value
+
+
+class Histogram:
+    """Histogram (cumulative buckets, sum, count) per label values, thread safe"""
+
+    type = "histogram"
+
+    def __init__(self, name, help, labelnames=(), buckets=BUCKETS):
+        self.name = PREFIX + name
+        self.help = help
+        self.labelnames = tuple(labelnames)
+        self.buckets = tuple(buckets)
+        self._values = {}  # label values -> [counts per bucket + inf, sum]
+        self._lock = threading.Lock()
+
+    def observe(self, value, **labels):
+        key = tuple(labels[name] for name in self.labelnames)
+        bucket = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            counts = self._values.get(key)
+            if counts is None:
+                counts = self._values[key] = [0] * (len(self.buckets) + 1) + [0.0]
+            counts[bucket] += 1
+            counts[-1] += value
+
+    def count(self, **labels):
+        counts = self._values.get(tuple(labels[name] for name in self.labelnames))
+        return 0 if counts is None else sum(counts[:-1])
+
+    def samples(self):
+        with self._lock:
+            values = {key: list(counts) for key, counts in self._values.items()}
+        names = self.labelnames + ("le",)
+        for key, counts in sorted(values.items()):
+            cumulative = 0
+            for bound, count in zip(self.buckets + ("+Inf",), counts[:-1]):
+                cumulative += count
+                yield self.name + "_bucket" + format_labels(
+                    names, key + (bound,)
+                ), cumulative
+            yield self.name + "_sum" + format_labels(self.labelnames, key), round(
+                counts[-1], 6
+            )
+            yield self.name + "_count" + format_labels(self.labelnames, key), cumulative
+
+
+class Gauge:
+    """Values read at scrape time from a callback: {label values: value}"""
+
+    type = "gauge"
+
+    def __init__(self, name, help, labelnames, collect, type="gauge"):
+        self.name = PREFIX + name
+        self.help = help
+        self.labelnames = tuple(labelnames)
+        self.collect = collect
+        self.type = type
+
+    def samples(self):
+        for key, value in sorted(self.collect().items()):
+            yield self.name + format_labels(self.labelnames, key), value
+
+
+REGISTRY = []
+
+
+def register(metric):
+    REGISTRY.append(metric)
+    return metric
+
+
+requests_total = register(
+    Counter(
+        "requests_total",
+        "HTTP requests per endpoint and status",
+        ["endpoint", "status"],
+    )
+)
+request_seconds = register(
+    Histogram(
+        "request_seconds", "duration of the HTTP requests per endpoint", ["endpoint"]
+    )
+)
+stage_seconds = register(
+    Histogram(
+        "stage_seconds",
+        "duration of the stages of the pipeline: weather, clear_sky, predict, encode",
+        ["stage"],
+    )
+)
+upstream_requests_total = register(
+    Counter(
+        "upstream_requests_total",
+        "requests to the weather providers",
+        ["host", "outcome"],
+    )
+)
+upstream_seconds = register(
+    Histogram(
+        "upstream_seconds",
+        "duration of the requests to the weather providers",
+        ["host"],
+    )
+)
+
+# caches with hits/misses/evictions/entries/bytes, see cache.LRUCache.stats
+caches = {}
+
+
+def register_cache(name, cache):
+    caches[name] = cache
+    return cache
+
+
+for stat, type in (
+    ("hits", "counter"),
+    ("misses", "counter"),
+    ("evictions", "counter"),
+    ("entries", "gauge"),
+    ("bytes", "gauge"),
+):
+    register(
+        Gauge(
+            f"cache_{stat}" + ("_total" if type == "counter" else ""),
+            f"{stat} of the caches",
+            ["cache"],
+            lambda stat=stat: {
+                (name,): cache.stats()[stat] for name, cache in caches.items()
+            },
+            type,
+        )
+    )
+
+# durations of the stages of the current request, for the Server-Timing header
+_timings = contextvars.ContextVar("timings", default=None)
+
+
+@contextmanager
+def stage(name):
+    """Records the duration of the block in stage_seconds (and Server-Timing)"""
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        record(name, time.perf_counter() - start)
+
+
+def record(name, duration, observe=True):
+    """Records the duration of a stage: stage_seconds (observe) and Server-Timing of the current request"""
+    if observe:
+        stage_seconds.observe(duration, stage=name)
+    timings = _timings.get()
+    if timings is not None:
+        timings.append((name, duration))
+
+
+@contextmanager
+def collect_timings():
+    """Collects the stages of the block in a list of (name, duration), eg. a job on another thread or process"""
+    timings = []
+    token = _timings.set(timings)
+    try:
+        yield timings
+    finally:
+        _timings.reset(token)
+
+
+def render():
+    """Returns all metrics in the Prometheus text format"""
+    lines = []
+    for metric in REGISTRY:
+        lines.append(f"# HELP {metric.name} {metric.help}")
+        lines.append(f"# TYPE {metric.name} {metric.type}")
+        lines.extend(f"{name} {value}" for name, value in metric.samples())
+    return "\n".join(lines) + "\n"
+
+
+def server_timing(timings, total):
+    return ", ".join(
+        f"{name};dur={duration * 1000:.1f}"
+        for name, duration in timings + [("total", total)]
+    )
+
+
+class MetricsMiddleware:
+    """ASGI middleware: duration and status per endpoint, optional Server-Timing header (SERVER_TIMING)"""
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            return await self.app(scope, receive, send)
+        start = time.perf_counter()
+        timings = []
+        token = _timings.set(timings)
+        status = [500]
+
+        async def send_wrapper(message):
+            if message["type"] == "http.response.start":
+                status[0] = message["status"]
+                if SERVER_TIMING == "on":
+                    header = server_timing(timings, time.perf_counter() - start)
+                    message["headers"] = list(message.get("headers", [])) + [
+                        (b"server-timing", header.encode())
+                    ]
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_wrapper)
+        finally:
+            _timings.reset(token)
+            # the router has set the endpoint, its function name is the label (not the path: ids)
+            endpoint = getattr(scope.get("endpoint"), "__name__", "not_found")
+            request_seconds.observe(time.perf_counter() - start, endpoint=endpoint)
+            requests_total.inc(endpoint=endpoint, status=status[0])
@@ -1,9 +1,11 @@
 from pathlib import Path
-import logging
-import pandas as pd
+import os
+import time
+import threading
 import numpy as np
 import pickle
-import sklearn
+
+from shared_code import startup, inference
 
 
 # Get the absolute path to the current file
@@ -12,42 +14,157 @@ base_path = Path(__file__).resolve().parent
 # Path to your model file
 model_path = base_path / "model" / "solar_mlp_model.pkl"
 
-with open(model_path, "rb") as myModel_file:
-    mlp = pickle.load(myModel_file)
+# ML_BACKEND: numpy = float32 forward pass of the exported weights (see inference), sklearn = MLPRegressor.predict
+ML_BACKEND = os.environ.get("ML_BACKEND", "numpy")
 
-# helper function clips positive Power to zero before sunrise and after sunset
-def eliminate_power_outside_sunrise_sunset(row):
-    Power = row["P_predicted"]
-    if row["clear_sky"] == 0 or row["P_predicted"] < 0:
-        Power = 0
-    return int(Power)
+# the model (and scikit-learn) is loaded on first use or by the warm-up, see startup
+# the active version is managed by models: versions, hot swap and shadow scoring
+mlp = None
+model_version = None
+_model_lock = threading.Lock()
 
+# called with (X, power, duration) after every prediction while a candidate model is shadowed, see models
+shadow = None
+
+
+def load_model(path, backend=None):
+    """Loads a model for the backend, both have predict(X ndarray)"""
+    path = Path(path)
+    if path.suffix == ".npz":
+        # exported weights: numpy backend only
+        return inference.NumpyMLP.load(path)
+    if (backend or ML_BACKEND) == "numpy":
+        return inference.load_numpy(path)
+    with open(path, "rb") as myModel_file:
+        return inference.SklearnMLP(pickle.load(myModel_file))
+
+
+def get_model():
+    """Returns the active MLP model, loads it on first use"""
+    from shared_code import models
+
+    # activated by another worker?
+    models.sync()
+    if mlp is None:
+        with _model_lock:
+            if mlp is None:
+                with startup.timed("load_model"):
+                    set_model(*models.load_active())
+    return mlp
+
+
+def set_model(model, version):
+    """Swaps the active model: a prediction in progress finishes with the model it started with"""
+    global mlp, model_version
+    mlp, model_version = model, version
+
+
+def model_loaded():
+    return mlp is not None
+
+
+# input features in the order the model was trained on
+FEATURE_COLUMNS = [
+    "temp",
+    "pressure",
+    "humidity",
+    "wind_speed",
+    "wind_deg",
+    "clouds_all",
+    "weather_id",
+    "clear_sky",
+    "day_of_year",
+]
+
+# columns of the DataFrame returned by enrichDataFrameWithPrediction
+OUTPUT_COLUMNS = ["dt", "clear_sky", "P_predicted"] + [
+    col for col in FEATURE_COLUMNS if col != "clear_sky"
+]
 
-def enrichDataFrameWithPrediction(dSet):
-    # dSet: dt/temp/pressure/humidity/wind_speed/wind_deg/clouds_all/weather_id/clear_sky/day_of_year
 
-    # Prepare X for ML: delet cols +  right order of cols
-    X = pd.DataFrame()
-    X = dSet.T.drop_duplicates().T
-    X = dSet.drop(["dt"], axis=1)
-    X = X.fillna(0)
+def featureMatrix(dSet):
+    """Returns the ML input of a dataSet: float64 array (rows x FEATURE_COLUMNS), missing values = 0"""
+    X = dSet[FEATURE_COLUMNS].to_numpy(dtype=np.float64)
+    X[np.isnan(X)] = 0
+    return X
 
-    # right order model: temp/pressure/humidity/wind_speed/wind_deg/clouds_all/weather_id/clear_sky/day_of_year
-    power = mlp.predict(X)
-    P = pd.DataFrame(power, columns=["P_predicted"], dtype=np.int16)
-    P_dSet = pd.concat([P, dSet], axis=1)
 
-    # order: dt/clear_sky/P_predicted/temp/pressure/humidity/wind_speed/wind_deg/clouds_all/weather_id/day_of_year
-    finalDataFrame = P_dSet.iloc[:, [1, 9, 0, 2, 3, 4, 5, 6, 7, 8, 10]]
+def clip_power(power, clear_sky):
+    """Finetuning model: int power, zero before sunrise and after sunset (clear_sky = 0) or when negative
+    and clipped to the envelope of the clear sky (theoretical max)
 
-    # Finetuning model
-    # power before sunrise and after sunset to zero - model sometomes show small values
-    finalDataFrame["P_predicted"] = finalDataFrame.apply(
-        eliminate_power_outside_sunrise_sunset, axis=1
-    )
-    # we clip the produced power to stay in the enveloppe of the clear sky(Theoretical max)
-    finalDataFrame["P_predicted"] = finalDataFrame[["P_predicted", "clear_sky"]].min(axis=1)
+    Args:
+        power (ndarray): predicted power
+        clear_sky (ndarray): clear sky power
 
+    Returns:
+        ndarray (int64): power
+    """
+    power = power.astype(np.int16)
+    power = np.where((clear_sky == 0) | (power < 0), 0, power)
+    return np.minimum(power, clear_sky).astype(np.int64)
 
-    logging.info(f"ML succeeded returned:{finalDataFrame.info()}")
+
+def predictPower(X):
+    """Predicts the power for a feature matrix, pure ndarray entry point
+
+    Args:
+        X (ndarray): rows x FEATURE_COLUMNS, see featureMatrix
+
+    Returns:
+        ndarray (int64): power per row, see clip_power
+    """
+    model = get_model()
+    clear_sky = X[:, FEATURE_COLUMNS.index("clear_sky")]
+    # the power is 0 without clear sky power (night): only the other rows are predicted
+    day = clear_sky > 0
+    power = np.zeros(len(X))
+    if day.any():
+        X_day = X if day.all() else X[day]
+        start = time.perf_counter()
+        power[day] = model.predict(X_day)
+        if shadow is not None:
+            shadow(X_day, power[day], time.perf_counter() - start)
+    return clip_power(power, clear_sky)
+
+
+def combinePrediction(dSet, power):
+    """Returns the dataSet with the predicted power in the order of OUTPUT_COLUMNS"""
+    finalDataFrame = dSet[[col for col in OUTPUT_COLUMNS if col != "P_predicted"]]
+    finalDataFrame = finalDataFrame.reset_index(drop=True)
+    finalDataFrame.insert(2, "P_predicted", power)
+    # the predictions of another version are not reused, see forecast.updateForecastBatch
+    finalDataFrame.attrs["model_version"] = model_version
     return finalDataFrame
+
+
+def enrichDataFrameWithPrediction(dSet):
+    """Adds the predicted power 'P_predicted' to a dataSet
+
+    Args:
+        dSet (pandas dataframe): dt/temp/pressure/humidity/wind_speed/wind_deg/clouds_all/weather_id/clear_sky/day_of_year
+
+    Returns:
+        pandas dataframe: dt/clear_sky/P_predicted/temp/pressure/humidity/wind_speed/wind_deg/clouds_all/weather_id/day_of_year
+    """
+    return combinePrediction(dSet, predictPower(featureMatrix(dSet)))
+
+
+def enrichDataFramesWithPrediction(dSets):
+    """Predicts the power for a list of dataSets with a single mlp.predict call
+
+    Args:
+        dSets (list of pandas dataframe): see enrichDataFrameWithPrediction
+
+    Returns:
+        list of pandas dataframe: one per dataSet, same order, see enrichDataFrameWithPrediction
+    """
+    if not dSets:
+        return []
+    # one feature matrix for all dataSets
+    power = predictPower(np.concatenate([featureMatrix(dSet) for dSet in dSets]))
+    bounds = np.cumsum([0] + [len(dSet) for dSet in dSets])
+    return [
+        combinePrediction(dSet, power[start:stop])
+        for dSet, start, stop in zip(dSets, bounds[:-1], bounds[1:])
+    ]
@@ -0,0 +1,248 @@
+import os
+import re
+import time
+import random
+import logging
+import threading
+from pathlib import Path
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+
+from shared_code import ml
+
+# directory of the model versions: <version>.pkl (+ its exported <version>.npz) or <version>.npz
+MODEL_DIR = Path(os.environ.get("MODEL_DIR", str(ml.model_path.parent)))
+# version used until another one is activated
+MODEL_VERSION = os.environ.get("MODEL_VERSION", ml.model_path.stem)
+# every worker checks the active version (file ACTIVE in MODEL_DIR) at most every interval (sec)
+MODEL_POLL_INTERVAL = float(os.environ.get("MODEL_POLL_INTERVAL", "10"))
+# fraction of the predictions that is scored by the shadow model
+SHADOW_SAMPLE_RATE = float(os.environ.get("SHADOW_SAMPLE_RATE", "0.1"))
+
+ACTIVE_FILE = "ACTIVE"
+VERSION_PATTERN = re.compile(r"^[A-Za-z0-9][A-Za-z0-9._-]*$")
+
+
+class InvalidModel(Exception):
+    """The model artifact cannot be loaded or does not fit the feature schema of ml.FEATURE_COLUMNS"""
+
+
+def artifact_path(version):
+    """Returns the artifact of a version, raises KeyError if there is none"""
+    if not VERSION_PATTERN.match(version):
+        raise KeyError(f"invalid model version '{version}'")
+    for suffix in (".pkl", ".npz"):
+        path = MODEL_DIR / f"{version}{suffix}"
+        if path.exists():
+            return path
+    raise KeyError(f"unknown model version '{version}'")
+
+
+def list_versions():
+    """Returns the versions in MODEL_DIR: version, artifact, size, modified"""
+    versions = {}
+    for path in sorted(MODEL_DIR.glob("*.npz")) + sorted(MODEL_DIR.glob("*.pkl")):
+        # the .pkl wins over its exported .npz
+        versions[path.stem] = path
+    return [
+        {
+            "version": version,
+            "artifact": path.name,
+            "size": path.stat().st_size,
+            "modified": path.stat().st_mtime,
+        }
+        for version, path in sorted(versions.items())
+    ]
+
+
+def validate(model):
+    """Checks that a model takes ml.FEATURE_COLUMNS and returns one finite value per row, raises InvalidModel"""
+    names = getattr(model, "feature_names", None)
+    if names is not None and list(names) != ml.FEATURE_COLUMNS:
+        raise InvalidModel(f"features {list(names)} differ from {ml.FEATURE_COLUMNS}")
+    if model.n_features_in_ != len(ml.FEATURE_COLUMNS):
+        raise InvalidModel(
+            f"{model.n_features_in_} features, expected {len(ml.FEATURE_COLUMNS)}"
+        )
+    power = np.asarray(model.predict(np.zeros((2, len(ml.FEATURE_COLUMNS)))))
+    if power.shape != (2,) or not np.isfinite(power).all():
+        raise InvalidModel(
+            f"prediction of shape {power.shape}, expected one finite value per row"
+        )
+
+
+def load_version(version):
+    """Loads and validates a version, raises KeyError (unknown) or InvalidModel"""
+    path = artifact_path(version)
+    try:
+        model = ml.load_model(path)
+    except Exception as e:
+        raise InvalidModel(f"cannot load {path.name}: {e!r}")
+    validate(model)
+    return model
+
+
+def active_version():
+    """Returns the version in ACTIVE (written by activate), MODEL_VERSION if none"""
+    try:
+        return (MODEL_DIR / ACTIVE_FILE).read_text().strip() or MODEL_VERSION
+    except FileNotFoundError:
+        return MODEL_VERSION
+
+
+def load_active():
+    """Returns (model, version) of the active version"""
+    version = active_version()
+    return load_version(version), version
+
+
+_sync = {"checked": 0.0}
+_sync_lock = threading.Lock()
+
+
+def activate(version):
+    """Loads, validates and swaps in a version without restart, the other workers follow (see sync)"""
+    model = load_version(version)
+    ml.set_model(model, version)
+    # atomic for the workers reading it
+    tmp = MODEL_DIR / f".{ACTIVE_FILE}.{os.getpid()}"
+    tmp.write_text(version)
+    os.replace(tmp, MODEL_DIR / ACTIVE_FILE)
+    logging.info(f"Model: version {version} activated")
+    return version
+
+
+def sync(now=None):
+    """Swaps in the version activated by another worker, checks at most every MODEL_POLL_INTERVAL"""
+    now = time.monotonic() if now is None else now
+    if now - _sync["checked"] < MODEL_POLL_INTERVAL or ml.mlp is None:
+        return
+    with _sync_lock:
+        if now - _sync["checked"] < MODEL_POLL_INTERVAL:
+            return
+        _sync["checked"] = now
+    version = active_version()
+    if version == ml.model_version:
+        return
+    try:
+        ml.set_model(load_version(version), version)
+        logging.info(f"Model: switched to version {version}")
+    except (KeyError, InvalidModel) as e:
+        logging.error(
+            f"Model: keeping version {ml.model_version}, {version} is invalid: {e}"
+        )
+
+
+# ACTIVE file of a process without model (eg. the app with COMPUTE_POOL=process)
+_active = {"version": None, "checked": None}
+
+
+def serving_version(now=None):
+    """Returns the version of the predictions of this process without reading ACTIVE per call:
+    the loaded version (see sync), the ACTIVE file read at most every MODEL_POLL_INTERVAL before the model is loaded
+    """
+    now = time.monotonic() if now is None else now
+    sync(now)
+    if ml.model_version is not None:
+        return ml.model_version
+    if _active["checked"] is None or now - _active["checked"] >= MODEL_POLL_INTERVAL:
+        _active.update(version=active_version(), checked=now)
+    return _active["version"]
+
+
+# shadow scoring: a candidate model predicts a sample of the requests next to the active model
+shadow = {"version": None, "model": None, "sample_rate": SHADOW_SAMPLE_RATE}
+shadow_stats = {}
+# one scoring at a time, off the request path, samples are skipped while it is busy
+shadow_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="shadow")
+_shadow_busy = threading.Lock()
+
+
+def reset_shadow_stats():
+    shadow_stats.update(
+        samples=0,
+        skipped=0,
+        rows=0,
+        active_sec=0.0,
+        shadow_sec=0.0,
+        abs_diff=0.0,
+        max_abs_diff=0,
+    )
+
+
+reset_shadow_stats()
+
+
+def set_shadow(version, sample_rate=None):
+    """Scores a fraction (default SHADOW_SAMPLE_RATE) of the predictions with a candidate version"""
+    model = load_version(version)
+    shadow.update(
+        version=version,
+        model=model,
+        sample_rate=SHADOW_SAMPLE_RATE if sample_rate is None else sample_rate,
+    )
+    reset_shadow_stats()
+    ml.shadow = observe
+    return version
+
+
+def clear_shadow():
+    ml.shadow = None
+    shadow.update(version=None, model=None)
+
+
+def observe(X, power, duration):
+    """Called by ml.predictPower: scores a sample of the predictions with the shadow model"""
+    model = shadow["model"]
+    if model is None or random.random() >= shadow["sample_rate"]:
+        return
+    if not _shadow_busy.acquire(blocking=False):
+        shadow_stats["skipped"] += 1
+        return
+    shadow_executor.submit(score, model, X.copy(), power, duration)
+
+
+def score(model, X, power, duration):
+    """Compares the (clipped) power and the latency of the shadow model with the active model"""
+    try:
+        start = time.perf_counter()
+        shadow_power = model.predict(X)
+        shadow_duration = time.perf_counter() - start
+        clear_sky = X[:, ml.FEATURE_COLUMNS.index("clear_sky")]
+        diff = np.abs(
+            ml.clip_power(shadow_power, clear_sky) - ml.clip_power(power, clear_sky)
+        )
+        shadow_stats["samples"] += 1
+        shadow_stats["rows"] += len(X)
+        shadow_stats["active_sec"] += duration
+        shadow_stats["shadow_sec"] += shadow_duration
+        shadow_stats["abs_diff"] += float(diff.sum())
+        shadow_stats["max_abs_diff"] = max(
+            shadow_stats["max_abs_diff"], int(diff.max(initial=0))
+        )
+    except Exception:
+        logging.exception("Model: shadow scoring failed")
+    finally:
+        _shadow_busy.release()
+
+
+def status():
+    """Returns the active and shadow version, the versions in MODEL_DIR and the shadow comparison"""
+    stats = shadow_stats
+    samples = stats["samples"] or 1
+    return {
+        "active": ml.model_version,
+        "versions": list_versions(),
+        "shadow": {
+            "version": shadow["version"],
+            "sample_rate": shadow["sample_rate"],
+            "samples": stats["samples"],
+            "skipped": stats["skipped"],
+            "rows": stats["rows"],
+            "active_ms": round(stats["active_sec"] / samples * 1000, 3),
+            "shadow_ms": round(stats["shadow_sec"] / samples * 1000, 3),
+            "mean_abs_diff": round(stats["abs_diff"] / (stats["rows"] or 1), 3),
+            "max_abs_diff": stats["max_abs_diff"],
+        },
+    }
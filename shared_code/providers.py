@@ -0,0 +1,107 @@
+import os
+import json
+import asyncio
+from pathlib import Path
+
+from shared_code import weatherforecast, httpclient
+
+# provider used when the request does not ask for one
+DEFAULT_PROVIDER = os.environ.get("WEATHER_PROVIDER", "openmeteo")
+# open-meteo response used by the 'file' provider
+WEATHER_FIXTURE = os.environ.get(
+    "WEATHER_FIXTURE",
+    str(Path(__file__).resolve().parent / "fixtures" / "openmeteo_forecast.json"),
+)
+
+
+class WeatherProvider:
+    """Interface of a weather provider: returns the 15min weather forecast of an installation
+
+    DataFrame: dt	temp	pressure	humidity	wind_speed	wind_deg	clouds_all	weather_id	clear_sky	day_of_year
+    """
+
+    name = None
+
+    def getData(self, installation):
+        raise NotImplementedError
+
+    async def getDataAsync(self, installation):
+        """Default: runs getData on the thread pool of the http client"""
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(
+            httpclient.executor, self.getData, installation
+        )
+
+    def getDataBulk(self, installations):
+        """Forecasts of many installations (same order), default: one getData per installation"""
+        return [self.getData(installation) for installation in installations]
+
+    async def getDataBulkAsync(self, installations):
+        """Async version of getDataBulk, default: concurrent getDataAsync"""
+        return await asyncio.gather(
+            *[self.getDataAsync(installation) for installation in installations]
+        )
+
+
+class OpenMeteoProvider(WeatherProvider):
+    name = "openmeteo"
+
+    def getData(self, installation):
+        return weatherforecast.getOpenMeteoData(installation)
+
+    async def getDataAsync(self, installation):
+        return await weatherforecast.getOpenMeteoDataAsync(installation)
+
+    def getDataBulk(self, installations):
+        return weatherforecast.getOpenMeteoDataBulk(installations)
+
+    async def getDataBulkAsync(self, installations):
+        return await weatherforecast.getOpenMeteoDataBulkAsync(installations)
+
+
+class OpenWeatherMapProvider(WeatherProvider):
+    name = "openweathermap"
+
+    def getData(self, installation):
+        return weatherforecast.getOpenWeatherData(installation)
+
+    async def getDataAsync(self, installation):
+        return await weatherforecast.getOpenWeatherDataAsync(installation)
+
+
+class FileProvider(WeatherProvider):
+    """Offline provider for tests: the same open-meteo response (json file) for every location"""
+
+    name = "file"
+
+    def __init__(self, path=None):
+        self.path = Path(path or WEATHER_FIXTURE)
+
+    def getData(self, installation):
+        resp = json.loads(self.path.read_text())
+        return weatherforecast.parseOpenMeteoData(resp, installation)
+
+
+# name -> provider
+PROVIDERS = {}
+
+
+def register_provider(provider):
+    """Adds (or replaces) a provider in the registry"""
+    PROVIDERS[provider.name] = provider
+    return provider
+
+
+def get_provider(name=None):
+    """Returns the provider with this name (default DEFAULT_PROVIDER), raises KeyError for an unknown name"""
+    name = name or DEFAULT_PROVIDER
+    if name not in PROVIDERS:
+        raise KeyError(
+            f"unknown weather provider '{name}', use one of: {', '.join(PROVIDERS)}"
+        )
+    return PROVIDERS[name]
+
+
+register_provider(OpenMeteoProvider())
+register_provider(OpenWeatherMapProvider())
+register_provider(FileProvider())
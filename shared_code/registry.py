@@ -0,0 +1,115 @@
+import os
+import json
+import time
+import sqlite3
+import hashlib
+import threading
+from pathlib import Path
+
+# SQLite file of the registered installations, see scheduler
+REGISTRY_DB = os.environ.get(
+    "REGISTRY_DB",
+    str(Path(__file__).resolve().parent.parent / "data" / "installations.db"),
+)
+
+
+def site_id(installation):
+    """Returns the id of an installation: a hash of its fields, except 'date'.
+    A forecast request for a registered installation has the same id.
+    """
+    site = {key: value for key, value in installation.items() if key != "date"}
+    return hashlib.sha1(json.dumps(site, sort_keys=True).encode()).hexdigest()[:16]
+
+
+class InstallationRegistry:
+    """Installations (+ weather provider) of which the forecast is precomputed, persisted in SQLite
+
+    A registered site: {"id": str, "provider": str, "installation": dict, "created": epoch}
+
+    Args:
+        path (str): SQLite file, default REGISTRY_DB (":memory:" for tests)
+    """
+
+    def __init__(self, path=None):
+        self.path = path or REGISTRY_DB
+        if self.path != ":memory:":
+            Path(self.path).parent.mkdir(parents=True, exist_ok=True)
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(self.path, check_same_thread=False)
+        with self._lock, self._db:
+            self._db.execute(
+                "CREATE TABLE IF NOT EXISTS installations ("
+                "id TEXT PRIMARY KEY, provider TEXT NOT NULL, installation TEXT NOT NULL, created REAL NOT NULL)"
+            )
+
+    def __len__(self):
+        with self._lock:
+            return self._db.execute("SELECT COUNT(*) FROM installations").fetchone()[0]
+
+    def add(self, installation, provider):
+        """Registers an installation (again: replaces the provider), returns the registered site"""
+        site = {
+            "id": site_id(installation),
+            "provider": provider,
+            "installation": installation,
+            "created": time.time(),
+        }
+        with self._lock, self._db:
+            self._db.execute(
+                "INSERT OR REPLACE INTO installations VALUES (?, ?, ?, ?)",
+                (site["id"], provider, json.dumps(installation), site["created"]),
+            )
+        return site
+
+    def get(self, id):
+        """Returns the registered site with this id, None if unknown"""
+        with self._lock:
+            row = self._db.execute(
+                "SELECT * FROM installations WHERE id = ?", (id,)
+            ).fetchone()
+        return row and self._site(row)
+
+    def list(self):
+        """Returns all registered sites, oldest first"""
+        with self._lock:
+            rows = self._db.execute(
+                "SELECT * FROM installations ORDER BY created"
+            ).fetchall()
+        return [self._site(row) for row in rows]
+
+    def remove(self, id):
+        """Unregisters a site, returns False if unknown"""
+        with self._lock, self._db:
+            cursor = self._db.execute("DELETE FROM installations WHERE id = ?", (id,))
+        return cursor.rowcount > 0
+
+    @staticmethod
+    def _site(row):
+        id, provider, installation, created = row
+        return {
+            "id": id,
+            "provider": provider,
+            "installation": json.loads(installation),
+            "created": created,
+        }
+
+
+# opened on first use: not in the master process of the pre-fork server
+_registry = None
+_registry_lock = threading.Lock()
+
+
+def get_registry():
+    """Returns the registry of REGISTRY_DB"""
+    global _registry
+    with _registry_lock:
+        if _registry is None:
+            _registry = InstallationRegistry()
+        return _registry
+
+
+def set_registry(registry):
+    """Replaces the registry (eg. another file or ':memory:' in tests)"""
+    global _registry
+    with _registry_lock:
+        _registry = registry
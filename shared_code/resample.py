@@ -0,0 +1,102 @@
+import numpy as np
+import pandas as pd
+
+
+def fill_gaps(times, values):
+    """Fills the missing values (NaN) of the columns of 'values' in place:
+    linear in time between the valid values, last valid value after, still NaN before the first valid value
+
+    Args:
+        times (ndarray): epoch sec (rows)
+        values (ndarray): float (rows x columns)
+    """
+    for col in np.flatnonzero(np.isnan(values).any(axis=0)):
+        column = values[:, col]
+        valid = ~np.isnan(column)
+        if not valid.any():
+            continue
+        first = np.argmax(valid)
+        column[first:] = np.interp(times[first:], times[valid], column[valid])
+
+
+def hold_gaps(values):
+    """Fills the missing values (NaN) of the columns of 'values' in place with the last valid value"""
+    for col in np.flatnonzero(np.isnan(values).any(axis=0)):
+        column = values[:, col]
+        last = np.where(~np.isnan(column), np.arange(len(column)), 0)
+        np.maximum.accumulate(last, out=last)
+        column[:] = column[last]
+
+
+def upsample(dt, interp_values, hold_values, step=900, period=3600):
+    """Upsamples a time series to a finer resolution in one pass over NumPy arrays:
+    linear interpolation in time for continuous fields, hold last value for categorical fields.
+    The last source period is filled up too: the result ends at dt[-1] + period - step.
+
+    Memory: the result + one temporary array of the same size, whatever the number of fields.
+
+    Args:
+        dt (ndarray): epoch sec of the source rows, sorted
+        interp_values (ndarray): float (rows x continuous fields)
+        hold_values (ndarray): float (rows x categorical fields)
+        step (int): target resolution (sec), eg. 300, 900 or 1800
+        period (int): resolution (sec) of the source
+
+    Returns:
+        tuple of ndarrays: new dt (int64), interpolated values, held values
+    """
+    dt = np.asarray(dt, dtype=np.int64)
+    new_dt = np.arange(dt[0], dt[-1] + period - step + 1, step, dtype=np.int64)
+
+    # source row before (or at) every new timestamp and its weight for the next row
+    lower = np.searchsorted(dt, new_dt, side="right") - 1
+    upper = np.minimum(lower + 1, len(dt) - 1)
+    span = (dt[upper] - dt[lower]).astype(np.float64)
+    weight = np.divide(
+        (new_dt - dt[lower]).astype(np.float64),
+        span,
+        out=np.zeros(len(new_dt)),
+        where=span > 0,
+    )[:, None]
+
+    interp_values = np.array(interp_values, dtype=np.float64)
+    fill_gaps(dt.astype(np.float64), interp_values)
+    interpolated = np.take(interp_values, lower, axis=0)
+    delta = np.take(interp_values, upper, axis=0)
+    delta -= interpolated
+    delta *= weight
+    interpolated += delta
+
+    hold_values = np.array(hold_values, dtype=np.float64)
+    hold_gaps(hold_values)
+    held = np.take(hold_values, lower, axis=0)
+
+    return new_dt, interpolated, held
+
+
+def upsample_frame(df, interp_cols, step=900, period=3600):
+    """Upsamples a DataFrame with a 'dt' column (epoch sec), see upsample
+
+    Args:
+        df (pandas dataframe): 'dt' + fields
+        interp_cols (list of strings): continuous fields, the others are held
+        step (int): target resolution (sec)
+        period (int): resolution (sec) of the source
+
+    Returns:
+        pandas dataframe: 'dt' (int64) + same fields (float64) in the same order
+    """
+    df = df.sort_values("dt")
+    hold_cols = [col for col in df.columns if col not in interp_cols + ["dt"]]
+    new_dt, interpolated, held = upsample(
+        df["dt"].to_numpy(),
+        df[interp_cols].to_numpy(dtype=np.float64),
+        df[hold_cols].to_numpy(dtype=np.float64),
+        step,
+        period,
+    )
+    values = {col: interpolated[:, nr] for nr, col in enumerate(interp_cols)}
+    values.update({col: held[:, nr] for nr, col in enumerate(hold_cols)})
+    return pd.DataFrame(
+        dict(dt=new_dt, **{col: values[col] for col in df.columns if col != "dt"})
+    )
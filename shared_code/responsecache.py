@@ -0,0 +1,103 @@
+"""Cache of the encoded responses of /forecast and /clearsky
+
+The key is a hash of everything the response depends on (validated installation, query params, format,
+weather model run, model version), the value the encoded bytes: a hit is returned without decoding or encoding.
+The ETag is the hash of the bytes: a client (or reverse proxy) sending it back in If-None-Match gets a 304,
+also after a new model run when the forecast did not change.
+"""
+import os
+import json
+import time
+import hashlib
+from collections import namedtuple
+
+from fastapi.responses import Response
+
+from shared_code import metrics
+from shared_code.cache import LRUCache
+
+# on: the encoded responses are kept, off: only ETag / Cache-Control / 304
+RESPONSE_CACHE = os.environ.get("RESPONSE_CACHE", "on")
+# Cache-Control max-age (sec) of a clear sky: it only depends on the installation
+CLEARSKY_MAX_AGE = int(os.environ.get("CLEARSKY_MAX_AGE", "86400"))
+
+response_cache = LRUCache(
+    max_entries=int(os.environ.get("RESPONSE_CACHE_MAX_ENTRIES", "4096")),
+    max_bytes=int(os.environ.get("RESPONSE_CACHE_MAX_MB", "128")) * 2**20,
+)
+
+metrics.register_cache("response", response_cache)
+not_modified_total = metrics.register(
+    metrics.Counter(
+        "response_not_modified_total",
+        "responses answered with 304 Not Modified (If-None-Match)",
+    )
+)
+
+# expires: epoch (sec) the response changes, None = CLEARSKY_MAX_AGE
+CachedResponse = namedtuple(
+    "CachedResponse", ["content", "media_type", "etag", "expires"]
+)
+
+
+def request_key(*parts):
+    """Returns the canonical hash of the parts of a request (dicts, lists, strings, numbers):
+    the same installation gives the same key whatever the order of its fields
+    """
+    data = json.dumps(parts, sort_keys=True, separators=(",", ":"), default=str)
+    return hashlib.sha256(data.encode()).hexdigest()
+
+
+def lookup(key):
+    """Returns the CachedResponse of a request key, None if not cached (or RESPONSE_CACHE is off)"""
+    if RESPONSE_CACHE != "on":
+        return None
+    return response_cache.get(key)
+
+
+def create(content, media_type, expires=None):
+    """Returns the CachedResponse of encoded bytes, the ETag is their hash"""
+    etag = '"' + hashlib.sha256(content).hexdigest()[:32] + '"'
+    return CachedResponse(content, media_type, etag, expires)
+
+
+def store(key, response):
+    """Keeps a CachedResponse until it expires (LRU evicted before that when the cache is full)"""
+    if RESPONSE_CACHE == "on":
+        response_cache.put(key, response, expires=response.expires)
+    return response
+
+
+def matches(if_none_match, etag):
+    """True if the If-None-Match header contains the ETag (weak comparison) or is *"""
+    if not if_none_match:
+        return False
+    tags = [tag.strip() for tag in if_none_match.split(",")]
+    return "*" in tags or etag in [
+        tag[2:] if tag.startswith("W/") else tag for tag in tags
+    ]
+
+
+def respond(request, response, now=None):
+    """Returns the cached bytes with ETag and Cache-Control, a 304 without body if If-None-Match matches
+
+    Args:
+        request (Request): the request, for its If-None-Match header
+        response (CachedResponse): see create
+    """
+    now = time.time() if now is None else now
+    if response.expires is None:
+        max_age = CLEARSKY_MAX_AGE
+    else:
+        max_age = max(int(response.expires - now), 0)
+    headers = {
+        "ETag": response.etag,
+        "Cache-Control": f"public, max-age={max_age}",
+        "Vary": "Accept",
+    }
+    if matches(request.headers.get("if-none-match"), response.etag):
+        not_modified_total.inc()
+        return Response(status_code=304, headers=headers)
+    return Response(
+        content=response.content, media_type=response.media_type, headers=headers
+    )
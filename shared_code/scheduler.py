@@ -0,0 +1,195 @@
+import os
+import time
+import random
+import asyncio
+import logging
+from concurrent.futures import ThreadPoolExecutor
+
+from shared_code import forecast, registry, weatherforecast, metrics
+from shared_code.cache import LRUCache
+
+# SCHEDULER: on = precompute the forecasts of the registered installations after every weather model update,
+# in every worker (the forecast store is per worker)
+SCHEDULER = os.environ.get("SCHEDULER", "off")
+# random delay (sec) after the model update: spreads the upstream load of several servers/workers
+SCHEDULER_JITTER = float(os.environ.get("SCHEDULER_JITTER", "60"))
+# installations per batch (one weather bulk fetch + one ML prediction) and max simultaneous batches
+SCHEDULER_BATCH_SIZE = int(os.environ.get("SCHEDULER_BATCH_SIZE", "500"))
+SCHEDULER_CONCURRENCY = int(os.environ.get("SCHEDULER_CONCURRENCY", "2"))
+# on = only predict the rows of which the weather changed since the previous cycle, see forecast.updateForecastBatch
+SCHEDULER_INCREMENTAL = os.environ.get("SCHEDULER_INCREMENTAL", "on")
+
+# precomputed forecasts per (site id, provider)
+forecast_store = LRUCache(
+    max_entries=int(os.environ.get("FORECAST_STORE_MAX_ENTRIES", "100000")),
+    max_bytes=int(os.environ.get("FORECAST_STORE_MAX_MB", "256")) * 2**20,
+)
+
+metrics.register_cache("forecast_store", forecast_store)
+
+# the batches run on threads: the event loop keeps serving requests
+executor = ThreadPoolExecutor(
+    max_workers=SCHEDULER_CONCURRENCY, thread_name_prefix="scheduler"
+)
+
+# metrics of the scheduler and its last cycle
+stats = {"cycles": 0, "failed_cycles": 0, "next_cycle": None, "last_cycle": None}
+
+_task = None
+
+metrics.register(
+    metrics.Gauge(
+        "scheduler_cycles_total",
+        "precomputation cycles of the scheduler",
+        ["outcome"],
+        lambda: {("ok",): stats["cycles"], ("failed",): stats["failed_cycles"]},
+        "counter",
+    )
+)
+metrics.register(
+    metrics.Gauge(
+        "scheduler_last_cycle",
+        "sites, rows, recomputed_rows, failed_batches and duration (sec) of the last cycle",
+        ["value"],
+        lambda: {
+            (key,): value
+            for key, value in (stats["last_cycle"] or {}).items()
+            if key != "started"
+        },
+    )
+)
+
+
+def lookup(installation, provider):
+    """Returns (a copy of) the precomputed forecast of an installation, None if not precomputed"""
+    df = forecast_store.get((registry.site_id(installation), provider))
+    return None if df is None else df.copy()
+
+
+def forget(site):
+    """Removes the precomputed forecast of a registered site"""
+    forecast_store.remove((site["id"], site["provider"]))
+
+
+def batches(sites):
+    """Splits the sites per provider in batches of SCHEDULER_BATCH_SIZE: list of (provider, sites)"""
+    per_provider = {}
+    for site in sites:
+        per_provider.setdefault(site["provider"], []).append(site)
+    return [
+        (provider, members[start : start + SCHEDULER_BATCH_SIZE])
+        for provider, members in per_provider.items()
+        for start in range(0, len(members), SCHEDULER_BATCH_SIZE)
+    ]
+
+
+def refresh_batch(provider, sites):
+    """Calculates and stores the forecasts of a batch of sites of the same provider
+
+    Returns:
+        _type_ tuple: number of rows, number of recomputed rows
+    """
+    installations = [site["installation"] for site in sites]
+    # weather model run of the forecasts, see responsecache in app
+    model_run = weatherforecast.model_run()
+    if SCHEDULER_INCREMENTAL == "on":
+        previous = [forecast_store.get((site["id"], provider)) for site in sites]
+        dfs, recomputed = forecast.updateForecastBatch(
+            installations, previous, provider
+        )
+    else:
+        dfs = forecast.calcForecastBatch(installations, provider)
+        recomputed = sum(len(df) for df in dfs)
+    # served until replaced by the next cycle, a cycle after the next update at the latest
+    expires = weatherforecast.next_model_update() + weatherforecast.MODEL_UPDATE_CYCLE
+    for site, df in zip(sites, dfs):
+        df.attrs["model_run"] = model_run
+        forecast_store.put((site["id"], provider), df, expires=expires)
+    return sum(len(df) for df in dfs), recomputed
+
+
+async def refresh(sites):
+    """Precomputes the forecasts of the sites, SCHEDULER_CONCURRENCY batches at a time
+
+    Returns:
+        _type_ dict: sites, batches, failed_batches, rows, recomputed_rows, duration (sec)
+    """
+    start = time.perf_counter()
+    loop = asyncio.get_running_loop()
+    todo = batches(sites)
+    results = await asyncio.gather(
+        *[
+            loop.run_in_executor(executor, refresh_batch, provider, members)
+            for provider, members in todo
+        ],
+        return_exceptions=True,
+    )
+    failed = [result for result in results if isinstance(result, Exception)]
+    for error in failed:
+        logging.error(f"Scheduler: batch failed: {error!r}")
+    done = [result for result in results if not isinstance(result, Exception)]
+    return {
+        "sites": len(sites),
+        "batches": len(todo),
+        "failed_batches": len(failed),
+        "rows": sum(rows for rows, recomputed in done),
+        "recomputed_rows": sum(recomputed for rows, recomputed in done),
+        "duration": round(time.perf_counter() - start, 3),
+    }
+
+
+async def run_cycle():
+    """Refreshes all registered sites, records the metrics of the cycle in stats"""
+    started = time.time()
+    try:
+        cycle = await refresh(registry.get_registry().list())
+    except Exception:
+        stats["failed_cycles"] += 1
+        logging.exception("Scheduler: cycle failed")
+        return None
+    cycle["started"] = started
+    stats["cycles"] += 1
+    stats["last_cycle"] = cycle
+    logging.info(f"Scheduler: cycle {cycle}")
+    return cycle
+
+
+async def run_forever():
+    """Refreshes now and after every weather model update (+ jitter)"""
+    while True:
+        await run_cycle()
+        stats["next_cycle"] = weatherforecast.next_model_update() + random.uniform(
+            0, SCHEDULER_JITTER
+        )
+        await asyncio.sleep(max(0, stats["next_cycle"] - time.time()))
+
+
+def start(mode=None):
+    """Starts the scheduler on the running event loop according to SCHEDULER, called by the FastAPI startup event"""
+    global _task
+    if (mode or SCHEDULER) != "on" or _task is not None:
+        return
+    _task = asyncio.get_running_loop().create_task(run_forever())
+
+
+async def stop():
+    """Stops the scheduler, called by the FastAPI shutdown event"""
+    global _task
+    if _task is None:
+        return
+    _task.cancel()
+    try:
+        await _task
+    except asyncio.CancelledError:
+        pass
+    _task = None
+
+
+def status():
+    """Returns the scheduler metrics + the size of the forecast store"""
+    return dict(
+        stats,
+        running=_task is not None,
+        sites=len(registry.get_registry()),
+        store=forecast_store.stats(),
+    )
@@ -0,0 +1,132 @@
+import os
+import gc
+import sys
+import time
+import signal
+import socket
+import logging
+
+import uvicorn
+from threadpoolctl import threadpool_limits
+
+from shared_code import startup
+
+# number of worker processes, 1 = single process uvicorn
+WEB_CONCURRENCY = int(os.environ.get("WEB_CONCURRENCY", "1"))
+# BLAS/OpenMP threads per worker: more workers x threads than cores only adds contention
+BLAS_THREADS = int(os.environ.get("BLAS_THREADS", "1"))
+# a worker that exits within WORKER_MIN_UPTIME (sec) failed to start: it is replaced after a backoff
+WORKER_MIN_UPTIME = float(os.environ.get("WORKER_MIN_UPTIME", "10"))
+# backoff (sec) after the first failed start, doubled after every next one upto WORKER_BACKOFF_MAX
+WORKER_BACKOFF = float(os.environ.get("WORKER_BACKOFF", "0.5"))
+WORKER_BACKOFF_MAX = float(os.environ.get("WORKER_BACKOFF_MAX", "30"))
+# the master stops (exit code 1) after this many failed starts in a row
+WORKER_MAX_FAILURES = int(os.environ.get("WORKER_MAX_FAILURES", "5"))
+
+
+def limit_blas_threads(threads=BLAS_THREADS):
+    """Limits the threads of numpy/scikit-learn (BLAS, OpenMP) in this process"""
+    threadpool_limits(limits=threads)
+
+
+def respawn_delay(failures):
+    """Returns the backoff (sec) before replacing a worker after 'failures' failed starts in a row"""
+    if failures <= 0:
+        return 0
+    return min(WORKER_BACKOFF * 2 ** (failures - 1), WORKER_BACKOFF_MAX)
+
+
+def serve(app, host="0.0.0.0", port=8080, workers=WEB_CONCURRENCY):
+    """Runs the app with uvicorn: one process, or a master that forks 'workers' processes.
+
+    The master loads the model and warms up pvlib and the clear sky caches before forking,
+    so the workers share them copy-on-write instead of each unpickling the model.
+    The workers accept connections on the socket of the master, a worker that dies is replaced:
+    after a backoff if it failed to start, the master gives up after WORKER_MAX_FAILURES in a row.
+
+    Args:
+        app (FastAPI): the application
+        host (string): interface to listen on
+        port (int): port to listen on
+        workers (int): number of worker processes
+    """
+    if workers <= 1 or not hasattr(os, "fork"):
+        limit_blas_threads()
+        uvicorn.run(app, port=port, host=host)
+        return
+
+    # load everything once in the master
+    startup.warmup()
+    # objects that exist now are never collected: the gc does not touch (and copy) their pages in the workers
+    gc.freeze()
+
+    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    sock.bind((host, port))
+    sock.listen(2048)
+    sock.set_inheritable(True)
+
+    # pid: start time (monotonic)
+    children = {}
+    stopping = False
+    failures = 0
+
+    def spawn():
+        pid = os.fork()
+        if pid == 0:
+            signal.signal(signal.SIGINT, signal.SIG_DFL)
+            signal.signal(signal.SIGTERM, signal.SIG_DFL)
+            limit_blas_threads()
+            config = uvicorn.Config(app, host=host, port=port)
+            try:
+                uvicorn.Server(config).run(sockets=[sock])
+            except BaseException:
+                # never return into the loop of the master
+                logging.exception("Worker failed")
+                os._exit(1)
+            os._exit(0)
+        children[pid] = time.monotonic()
+        logging.info(f"Started worker {pid}")
+
+    def stop(signum, frame):
+        nonlocal stopping
+        stopping = True
+        for pid in children:
+            os.kill(pid, signal.SIGTERM)
+
+    signal.signal(signal.SIGINT, stop)
+    signal.signal(signal.SIGTERM, stop)
+
+    for nr in range(workers):
+        spawn()
+
+    while children:
+        try:
+            pid, status = os.wait()
+        except ChildProcessError:
+            break
+        except InterruptedError:
+            continue
+        started = children.pop(pid, None)
+        if stopping or started is None:
+            continue
+        if time.monotonic() - started < WORKER_MIN_UPTIME:
+            failures += 1
+        else:
+            failures = 0
+        if failures >= WORKER_MAX_FAILURES:
+            logging.error(
+                f"Worker {pid} exited ({status}), {failures} failed starts in a row: stopping"
+            )
+            stop(None, None)
+            continue
+        delay = respawn_delay(failures)
+        logging.warning(
+            f"Worker {pid} exited ({status}), starting a new one in {delay:.1f}s"
+        )
+        time.sleep(delay)
+        if not stopping:
+            spawn()
+    sock.close()
+    if failures >= WORKER_MAX_FAILURES:
+        sys.exit(1)
@@ -0,0 +1,95 @@
+import asyncio
+import functools
+import threading
+
+
+class _Call:
+    def __init__(self):
+        self.event = threading.Event()
+        self.result = None
+        self.error = None
+
+
+class SingleFlight:
+    """Request coalescing: while a call for a key is in flight, callers with the same key wait for it
+    and share its result (or exception) instead of making the same call again.
+
+    calls: number of calls executed
+    shared: number of callers that got the result of a call of another caller
+    """
+
+    def __init__(self):
+        self.calls = 0
+        self.shared = 0
+        self._calls = {}
+        self._futures = {}
+        self._lock = threading.Lock()
+
+    def do(self, key, func):
+        """Returns func(), or the result of the call for key that is already in flight (threads)"""
+        with self._lock:
+            call = self._calls.get(key)
+            leader = call is None
+            if leader:
+                call = self._calls[key] = _Call()
+                self.calls += 1
+            else:
+                self.shared += 1
+        if not leader:
+            call.event.wait()
+            if call.error is not None:
+                raise call.error
+            return call.result
+        try:
+            call.result = func()
+        except BaseException as e:
+            call.error = e
+            raise
+        finally:
+            with self._lock:
+                del self._calls[key]
+            call.event.set()
+        return call.result
+
+    async def do_async(self, key, func):
+        """Returns await func(), or the result of the call for key that is already in flight (event loop)"""
+
+        async def call(keys):
+            return {key: await func()}
+
+        return (await self.do_many_async([key], call))[key]
+
+    async def do_many_async(self, keys, func):
+        """Returns {key: result} of several keys (event loop): await func(keys) is called once with the keys
+        that are not in flight and returns their results {key: result}, the other keys share the calls in flight.
+        The call runs in its own task: a cancelled caller (eg. client disconnect) does not cancel the others.
+        """
+        loop = asyncio.get_running_loop()
+        futures, own = {}, []
+        for key in dict.fromkeys(keys):
+            future = self._futures.get((loop, key))
+            if future is None:
+                own.append(key)
+            else:
+                self.shared += 1
+                futures[key] = future
+        if own:
+            self.calls += 1
+            for key in own:
+                futures[key] = self._futures[(loop, key)] = loop.create_future()
+            task = loop.create_task(func(own))
+            task.add_done_callback(functools.partial(self._done, loop, own))
+        return {key: await asyncio.shield(future) for key, future in futures.items()}
+
+    def _done(self, loop, keys, task):
+        # hands the result (or exception) of a call to the futures of its keys
+        for key in keys:
+            future = self._futures.pop((loop, key))
+            if task.cancelled():
+                future.cancel()
+            elif task.exception() is not None:
+                future.set_exception(task.exception())
+                # retrieved: no warning when nobody waits for it (anymore)
+                future.exception()
+            else:
+                future.set_result(task.result()[key])
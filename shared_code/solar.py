@@ -1,62 +1,234 @@
+import os
+import importlib.util
 import logging
 import json
 from operator import itemgetter
 import pandas as pd
 import numpy as np
-import pvlib
-from pvlib import clearsky, atmosphere, solarposition, irradiance
-from pvlib.location import Location
-from datetime import datetime, timezone
+from datetime import datetime, timedelta, timezone
 from zoneinfo import ZoneInfo
 
+from shared_code import metrics, clearsky_table
+from shared_code.cache import LRUCache
+
+# Cache of the un-scaled POA profiles per site geometry and time window
+clear_sky_cache = LRUCache(
+    max_entries=int(os.environ.get("CLEARSKY_CACHE_MAX_ENTRIES", "4096")),
+    max_bytes=int(os.environ.get("CLEARSKY_CACHE_MAX_MB", "32")) * 2**20,
+)
+metrics.register_cache("clear_sky", clear_sky_cache)
+
+# solar position algorithms, see solar_position
+SOLAR_POSITIONS = ("nrel_numpy", "nrel_numba", "ephemeris", "analytical")
+# algorithm when the request does not ask for one
+SOLAR_POSITION = os.environ.get("SOLAR_POSITION", "nrel_numpy")
+
+
+class UnsupportedSolarPosition(Exception):
+    """The solar position algorithm is unknown or can not be used in this process"""
+
+
+def check_solar_position(method=None):
+    """Returns the solar position algorithm (default SOLAR_POSITION) or raises UnsupportedSolarPosition.
+    pvlib switches between nrel_numpy and nrel_numba by reloading its spa module (not thread safe):
+    a process only uses the nrel variant of SOLAR_POSITION (nrel_numpy for the other algorithms).
+    """
+    method = method or SOLAR_POSITION
+    if method not in SOLAR_POSITIONS:
+        raise UnsupportedSolarPosition(
+            f"unknown solar position '{method}', use one of: {', '.join(SOLAR_POSITIONS)}"
+        )
+    if method.startswith("nrel_"):
+        nrel = SOLAR_POSITION if SOLAR_POSITION.startswith("nrel_") else "nrel_numpy"
+        if method != nrel:
+            raise UnsupportedSolarPosition(
+                f"solar position '{method}' needs SOLAR_POSITION={method}, this process uses {nrel}"
+            )
+    if method == "nrel_numba" and importlib.util.find_spec("numba") is None:
+        # pvlib would silently fall back to numpy
+        raise UnsupportedSolarPosition("solar position 'nrel_numba' needs numba")
+    return method
+
+
+def solar_position(site_location, times, method="nrel_numpy"):
+    """Returns the position of the sun, see SOLAR_POSITIONS:
+        - nrel_numpy: NREL SPA (pvlib default), +/- 0.0003 deg
+        - nrel_numba: the same SPA compiled by numba (the first call compiles it)
+        - ephemeris: pvlib ephemeris (pure python), +/- 0.1 deg with refraction
+        - analytical: Spencer declination and equation of time (vectorised), +/- 0.5 deg
 
-def get_irradiance(site_location, date, tilt, surface_azimuth, **kwargs):
-    """Returns the 'Clear Sky Power (GHI and POI at every 15min interval for a given day '
-        Remark : all timestamps are refered GMT+0 and we need it to convert in frontend to timezone
     Args:
         site_location (pvlib Location object): (latitude, longitude, tz='UTC', altitude=0, name=None)
-        date (string - 'MM-DD-YYYY'): A day of the year
-        tilt (integer): Inclination of the installation (deg °) typical roof = 35°
-        surface_azimuth (integer): Orientation of solar installation (deg °) eg 180°=south
+        times (pandas DatetimeIndex): see get_times
+        method (string): see SOLAR_POSITIONS
 
     Returns:
-        pandas dataframe: {'GHI': clearsky['ghi'], 'POA': POA_irradiance['poa_global']}
+        pandas dataframe: index(times) + 'apparent_zenith', 'azimuth' (deg, N=0 E=90) + others of the algorithm
     """
+    if method == "analytical":
+        return analytical_solar_position(site_location, times)
+    return site_location.get_solarposition(times=times, method=method)
+
 
+def analytical_solar_position(site_location, times):
+    """Solar position from the Spencer (1971) fits of the declination and the equation of time, see solar_position"""
+    from pvlib import solarposition
+
+    # in utc: pvlib's hour_angle uses one utc offset for all times (wrong on a DST change)
+    utc = times.tz_convert("UTC")
+    day_of_year = utc.dayofyear.to_numpy()
+    declination = solarposition.declination_spencer71(day_of_year)
+    equation_of_time = solarposition.equation_of_time_spencer71(day_of_year)
+    hour_angle = solarposition.hour_angle(
+        utc, site_location.longitude, equation_of_time
+    )
+    # -180..180 deg: the sign of the hour angle is the side of the azimuth (east/west)
+    hour_angle = np.radians((hour_angle + 180) % 360 - 180)
+    latitude = np.radians(site_location.latitude)
+    zenith = solarposition.solar_zenith_analytical(latitude, hour_angle, declination)
+    azimuth = solarposition.solar_azimuth_analytical(
+        latitude, hour_angle, declination, zenith
+    )
+    zenith, azimuth = np.degrees(zenith), np.degrees(azimuth)
+    # atmospheric refraction (Saemundsson, as SPA at 1010 mbar and 10 C), the sun rises a few minutes earlier
+    elevation = np.maximum(90 - zenith, -0.5667)
+    refraction = 1.02 / (60 * np.tan(np.radians(elevation + 10.3 / (elevation + 5.11))))
+    apparent_zenith = zenith - np.where(90 - zenith >= -0.5667, refraction, 0)
+    return pd.DataFrame(
+        {
+            "apparent_zenith": apparent_zenith,
+            "zenith": zenith,
+            "apparent_elevation": 90 - apparent_zenith,
+            "elevation": 90 - zenith,
+            "azimuth": azimuth,
+        },
+        index=times,
+    )
+
+
+def get_times(site_location, date, **kwargs):
+    """Returns the 15min timestamps (tz aware) of a day, from startEpochHour upto and ending stopEpochHour,
+    or of all the days from start_date upto and including end_date
+
+    Args:
+        site_location (pvlib Location object): (latitude, longitude, tz='UTC', altitude=0, name=None)
+        date (string - 'MM-DD-YYYY'): A day of the year
+        **kwargs:
+            startEpochHour (int): sec
+            stopEpochHour (int): sec
+            freq (string): pandas frequency, default "15min"
+            or
+            start_date (string): "dd-MM-yyyy"
+            end_date (string): "dd-MM-yyyy"
+            freq (string): pandas frequency, default "15min"
+
+    Returns:
+        pandas DatetimeIndex
+    """
+    if "start_date" in kwargs:
+        # all timestamps of the days start_date upto and including end_date
+        start = datetime.strptime(kwargs["start_date"], "%d-%m-%Y")
+        end = datetime.strptime(kwargs["end_date"], "%d-%m-%Y") + timedelta(days=1)
+        return pd.date_range(
+            start=start,
+            end=end,
+            freq=kwargs.get("freq", "15min"),
+            tz=site_location.tz,
+            inclusive="left",
+        )
     # Creates one day's worth of 15 min intervals
     if kwargs:
         # return 48h x 4(15min) + 1 timestamps from startEpochHour upto and ending stopEpochHour
         start_utc = datetime.fromtimestamp(kwargs["startEpochHour"], tz=timezone.utc)
         start = start_utc.astimezone(ZoneInfo(site_location.tz))
-        
+
         stop_utc = datetime.fromtimestamp(kwargs["stopEpochHour"], tz=timezone.utc)
         stop = stop_utc.astimezone(ZoneInfo(site_location.tz))
-        times = pd.date_range(start=start, end=stop, freq="15min", tz=ZoneInfo(site_location.tz))
-    else:
-        # return 24h x 4(15min) timstamps for one complete day
-        times = pd.date_range(date, freq="15min", periods=4 * 24, tz=site_location.tz)
+        return pd.date_range(
+            start=start,
+            end=stop,
+            freq=kwargs.get("freq", "15min"),
+            tz=ZoneInfo(site_location.tz),
+        )
+    # return 24h x 4(15min) timstamps for one complete day
+    return pd.date_range(date, freq="15min", periods=4 * 24, tz=site_location.tz)
+
+
+def get_sky(site_location, times, method="nrel_numpy"):
+    """Returns the clear sky irradiance and the solar position of a location.
+    Only depends on the location and the times: it is shared by all the planes (tilt/azimuth) of a site.
+
+    Args:
+        site_location (pvlib Location object): (latitude, longitude, tz='UTC', altitude=0, name=None)
+        times (pandas DatetimeIndex): see get_times
+        method (string): solar position algorithm, see solar_position
 
+    Returns:
+        pandas dataframe: index(times) + 'ghi', 'dni', 'dhi', 'apparent_zenith', 'azimuth'
+    """
+    # Get solar azimuth and zenith, the most expensive step: we only do it once
+    position = solar_position(site_location, times, method)
     # Generate clearsky data using the Ineichen model, which is the default
     # The get_clearsky method returns a dataframe with values for GHI, DNI,
     # and DHI
-    clearsky = site_location.get_clearsky(times)
-    # Get solar azimuth and zenith to pass to the transposition function
-    solar_position = site_location.get_solarposition(times=times)
+    clearsky = site_location.get_clearsky(times, solar_position=position)
+    return pd.DataFrame(
+        {
+            "ghi": clearsky["ghi"],
+            "dni": clearsky["dni"],
+            "dhi": clearsky["dhi"],
+            "apparent_zenith": position["apparent_zenith"],
+            "azimuth": position["azimuth"],
+        }
+    )
+
+
+def get_plane_irradiance(sky, tilt, surface_azimuth):
+    """Transposes the clear sky irradiance to the plane of a PV array
+
+    Args:
+        sky (pandas dataframe): see get_sky
+        tilt (integer): Inclination of the installation (deg °) typical roof = 35°
+        surface_azimuth (integer): Orientation of solar installation (deg °) eg 180°=south
+
+    Returns:
+        pandas dataframe: {'POA': POA_irradiance['poa_global']}
+    """
+    # pvlib is imported on first use, see startup
+    from pvlib import irradiance
+
     # Use the get_total_irradiance function to transpose the GHI to POA
     POA_irradiance = irradiance.get_total_irradiance(
         surface_tilt=tilt,
         surface_azimuth=surface_azimuth,
-        dni=clearsky["dni"],
-        ghi=clearsky["ghi"],
-        dhi=clearsky["dhi"],
-        solar_zenith=solar_position["apparent_zenith"],
-        solar_azimuth=solar_position["azimuth"],
+        dni=sky["dni"],
+        ghi=sky["ghi"],
+        dhi=sky["dhi"],
+        solar_zenith=sky["apparent_zenith"],
+        solar_azimuth=sky["azimuth"],
     )
-    # Return DataFrame with only GHI and POA
+    # Return DataFrame with only POA
     return pd.DataFrame({"POA": POA_irradiance["poa_global"]})
 
 
-def getClearSky(body, **kwargs):
+def get_irradiance(site_location, date, tilt, surface_azimuth, **kwargs):
+    """Returns the 'Clear Sky Power (GHI and POI at every 15min interval for a given day '
+        Remark : all timestamps are refered GMT+0 and we need it to convert in frontend to timezone
+    Args:
+        site_location (pvlib Location object): (latitude, longitude, tz='UTC', altitude=0, name=None)
+        date (string - 'MM-DD-YYYY'): A day of the year
+        tilt (integer): Inclination of the installation (deg °) typical roof = 35°
+        surface_azimuth (integer): Orientation of solar installation (deg °) eg 180°=south
+        **kwargs: time window, see get_times
+
+    Returns:
+        pandas dataframe: {'POA': POA_irradiance['poa_global']}
+    """
+    times = get_times(site_location, date, **kwargs)
+    return get_plane_irradiance(get_sky(site_location, times), tilt, surface_azimuth)
+
+
+def getClearSky(body, solar_position=None, **kwargs):
     """ " Calculates for a certain date and PV installation parameters the 'Clear Sky' power in Watts for every 15 of that day.
 
     Args:
@@ -69,14 +241,22 @@ def getClearSky(body, **kwargs):
             totalWattPeak (int): Total Peak power of installation: this is n x solarpanel power
             wattInvertor (int): max power of invertor
             timezone (string): official IANA timezone
-        **kwargs:
+            planes (list of dict, optional): PV arrays {tilt, azimuth, wattPeak} of a multi-array installation
+                (eg. east/west), replaces tilt/azimuth/totalWattPeak
+        solar_position (string): solar position algorithm (default SOLAR_POSITION), see check_solar_position.
+            Default with CLEARSKY_ENGINE=table: the clear sky table, see clearsky_table
+        **kwargs: time window, see get_times
             startEpochHour (int): sec
             stopEpochHour (int): sec
+            or
+            start_date (string): "dd-MM-yyyy"
+            end_date (string): "dd-MM-yyyy"
+            freq (string): pandas frequency, default "15min"
 
     Returns:
         pandas dataframe: 96 x ( index + 'dt'(int32) + 'P_invertor'(int16) )
+            + 'clear_sky_<nr>'(int16) per plane (before invertor clipping) for a multi-array installation
     """
-
     (
         dateEU,
         location,
@@ -99,47 +279,219 @@ def getClearSky(body, **kwargs):
         body
     )
 
-    # re-format date from dd-MM-yyyy to MM-dd-yyyy
-    date = dateEU[3:5] + "-" + dateEU[0:2] + "-" + dateEU[6:]
+    if solar_position is None and clearsky_table.use_table(location, altitude):
+        # interpolated from the clear sky table, see CLEARSKY_ENGINE
+        method = "table"
+    else:
+        method = check_solar_position(solar_position)
+
+    planes = body.get("planes")
+    if planes:
+        # the solar position and clear sky are calculated once, only the transposition is per plane
+        profiles = [
+            get_poa_profile(
+                location,
+                altitude,
+                timezone,
+                plane["tilt"],
+                plane["azimuth"],
+                dateEU,
+                method,
+                **kwargs,
+            )
+            for plane in planes
+        ]
+        return scale_clear_sky_planes(
+            profiles, [plane["wattPeak"] for plane in planes], P_Invertor
+        )
+
+    profile = get_poa_profile(
+        location, altitude, timezone, tilt, azimuth, dateEU, method, **kwargs
+    )
+    return scale_clear_sky(profile, P_Installed, P_Invertor)
 
-    site = Location(location["lat"], location["lng"], timezone, altitude, "MySite")
 
+def get_sky_profile(
+    location, altitude, timezone, dateEU, method="nrel_numpy", **kwargs
+):
+    """Returns the (cached) clear sky irradiance and solar position of a location, see get_sky.
+    It is cached in clear_sky_cache per location, solar position algorithm and time window.
+
+    Args:
+        location (_type_): {lat:x,lng:y}
+        altitude, timezone: see getClearSky
+        dateEU (string): "dd-MM-yyy", not used when a time window is given
+        method (string): solar position algorithm (see solar_position) or 'table' (see clearsky_table)
+        **kwargs: time window, see get_times
+            startEpochHour (int): sec
+            stopEpochHour (int): sec
+
+    Returns:
+        pandas dataframe: see get_sky
+    """
+    key = (
+        "sky",
+        location["lat"],
+        location["lng"],
+        altitude,
+        timezone,
+        method,
+    ) + time_window(dateEU, **kwargs)
+    sky = clear_sky_cache.get(key)
+    if sky is None:
+        from pvlib.location import Location
+
+        # re-format date from dd-MM-yyyy to MM-dd-yyyy
+        date = dateEU[3:5] + "-" + dateEU[0:2] + "-" + dateEU[6:]
+
+        site = Location(location["lat"], location["lng"], timezone, altitude, "MySite")
+        times = get_times(site, date, **kwargs)
+        if method == "table":
+            sky = clearsky_table.get_table().sky(
+                location["lat"], location["lng"], altitude, times
+            )
+        else:
+            sky = get_sky(site, times, method)
+        clear_sky_cache.put(key, sky)
+    return sky
+
+
+def time_window(dateEU, **kwargs):
+    """Returns the time window of a clear sky calculation as cache key, see get_times"""
+    if "start_date" in kwargs:
+        return (kwargs["start_date"], kwargs["end_date"], kwargs.get("freq", "15min"))
     if kwargs:
-        irradiance = get_irradiance(
-            site,
-            date,
-            tilt,
-            azimuth,
-            startEpochHour=kwargs["startEpochHour"],
-            stopEpochHour=kwargs["stopEpochHour"],
+        return (
+            int(kwargs["startEpochHour"]),
+            int(kwargs["stopEpochHour"]),
+            kwargs.get("freq", "15min"),
         )
-    else:
-        irradiance = get_irradiance(site, date, tilt, azimuth)
+    return (dateEU,)
 
-    # we assume max sun power =+/- 1000 Watt/m2 (913) and have a installation of peak 7480 Watt so we multiply by 7.48
-    cf = 0.97
-    P_max_m2 = 913
-    P_peak = P_Installed / P_max_m2
-    irradiance["clear_sky"] = cf * P_peak * irradiance["POA"]
 
-    # we clip the produced powe to the max of the inverter (5040 Watt in this case)
-    irradiance["clear_sky"] = irradiance["clear_sky"].apply(
-        lambda x: P_Invertor if x > P_Invertor else x
-    )
-    # remove POA
-    irradiance.drop(["POA"], inplace=True, axis=1)
+def get_poa_profile(
+    location, altitude, timezone, tilt, azimuth, dateEU, method="nrel_numpy", **kwargs
+):
+    """Returns the (cached) un-scaled POA irradiance of a site, see get_irradiance.
+    The profile only depends on the site geometry and the time window: it is cached in clear_sky_cache.
+    The solar position and clear sky irradiance are shared by all planes of a location, see get_sky_profile.
 
-    # reset index: before date was index -> this wil create new column + we rename it
-    irradiance = irradiance.reset_index().rename(columns={"index": "dt"})
+    Args:
+        location (_type_): {lat:x,lng:y}
+        altitude, timezone, tilt, azimuth: see getClearSky
+        dateEU (string): "dd-MM-yyy", not used when a time window is given
+        method (string): solar position algorithm (see solar_position) or 'table' (see clearsky_table)
+        **kwargs: time window, see get_times
+            startEpochHour (int): sec
+            stopEpochHour (int): sec
 
-    # convert date from datetime type to iso-string -> needed becaus key in dict must be native python type
-    # irradiance["date"] = irradiance["date"].map(lambda x: x.isoformat())
+    Returns:
+        tuple of read-only ndarrays: ('dt' epoch sec (int32), 'POA' W/m2 (float64))
+    """
+    key = (
+        location["lat"],
+        location["lng"],
+        altitude,
+        timezone,
+        tilt,
+        azimuth,
+        method,
+    ) + time_window(dateEU, **kwargs)
+    profile = clear_sky_cache.get(key)
+    if profile is None:
+        sky = get_sky_profile(location, altitude, timezone, dateEU, method, **kwargs)
+        if method == "table":
+            POA = clearsky_table.plane_irradiance(sky, tilt, azimuth)
+        else:
+            POA = get_plane_irradiance(sky, tilt, azimuth)
+
+        # convert date from datetime type to epoch secs
+        profile = (
+            (POA.index.asi8 // 10**9).astype(np.int32),
+            POA["POA"].to_numpy(dtype=np.float64),
+        )
+        for array in profile:
+            array.flags.writeable = False
+        clear_sky_cache.put(key, profile)
+    return profile
+
+
+# we assume max sun power =+/- 1000 Watt/m2 (913) and have a installation of peak 7480 Watt so we multiply by 7.48
+CF = 0.97
+P_MAX_M2 = 913
+
+
+def scale_clear_sky(profile, P_Installed, P_Invertor):
+    """Converts the POA irradiance (W/m2) into the 'Clear Sky' power (Watts) of an installation
+
+    Args:
+        profile (tuple of ndarrays): ('dt', 'POA'), see get_poa_profile
+        P_Installed (int): Total Peak power of installation
+        P_Invertor (int): max power of invertor
+
+    Returns:
+        pandas dataframe: index + 'dt'(int32) + 'clear_sky'(int16)
+    """
+    dt, POA = profile
+    clear_sky = CF * (P_Installed / P_MAX_M2) * POA
 
-    # convert date from datetime type to epoch secs (int64)
-    irradiance["dt"] = irradiance["dt"].map(lambda x: x.timestamp())
+    # we clip the produced powe to the max of the inverter (5040 Watt in this case)
+    clear_sky = np.minimum(clear_sky, P_Invertor)
 
     # round power to int
-    irradiance = irradiance.astype({"clear_sky": np.int16, "dt": np.int32})
+    return pd.DataFrame({"dt": dt, "clear_sky": clear_sky.astype(np.int16)})
+
+
+def scale_clear_sky_planes(profiles, wattPeaks, P_Invertor):
+    """Converts the POA irradiance of every plane of a multi-array installation into 'Clear Sky' power
+
+    Args:
+        profiles (list of tuple of ndarrays): ('dt', 'POA') per plane, see get_poa_profile
+        wattPeaks (list of int): Peak power per plane
+        P_Invertor (int): max power of invertor
+
+    Returns:
+        pandas dataframe: index + 'dt'(int32) + 'clear_sky'(int16) (sum of the planes, clipped by the invertor)
+            + 'clear_sky_<nr>'(int16) per plane
+    """
+    planes = [CF * (P / P_MAX_M2) * POA for (dt, POA), P in zip(profiles, wattPeaks)]
+    clear_sky = np.minimum(np.sum(planes, axis=0), P_Invertor)
+
+    df = pd.DataFrame({"dt": profiles[0][0], "clear_sky": clear_sky.astype(np.int16)})
+    for nr, plane in enumerate(planes):
+        df[f"clear_sky_{nr}"] = plane.astype(np.int16)
+    return df
+
+
+def getClearSkyBatch(bodies, solar_position=None, **kwargs):
+    """Calculates the 'Clear Sky' power for a list of PV installations.
+    pvlib only runs once per distinct site geometry (location/altitude/timezone/tilt/azimuth/date),
+    the installations sharing it only differ by a cheap scaling and clipping, see get_poa_profile.
+
+    Args:
+        bodies (list of dict): see getClearSky
+        solar_position (string): see getClearSky
+        **kwargs: time window, see get_times
+            startEpochHour (int): sec
+            stopEpochHour (int): sec
+
+    Returns:
+        list of pandas dataframe: one per body, same order, see getClearSky
+    """
+    return [getClearSky(body, solar_position, **kwargs) for body in bodies]
 
-    # we return a pandas.DataFrame
-    return irradiance
+
+def warmup():
+    """Imports pvlib and its data by calculating the clear sky of a day"""
+    getClearSky(
+        {
+            "date": "21-06-2022",
+            "location": {"lat": 51.0, "lng": 3.11},
+            "altitude": 70,
+            "tilt": 35,
+            "azimuth": 180,
+            "totalWattPeak": 7400,
+            "wattInvertor": 5040,
+            "timezone": "Europe/Brussels",
+        }
+    )
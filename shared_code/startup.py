@@ -0,0 +1,59 @@
+import os
+import time
+import logging
+import threading
+from contextlib import contextmanager
+
+# SOLAR_WARMUP: when to load the model and the heavy libraries (pvlib, scikit-learn)
+#   background: in a thread at startup, the server accepts requests immediately (default)
+#   blocking: at startup, before the server accepts requests
+#   off: on first use
+WARMUP = os.environ.get("SOLAR_WARMUP", "background")
+
+# duration (sec) of the import and load steps
+timings = {}
+warmed_up = threading.Event()
+
+
+@contextmanager
+def timed(name):
+    """Records the duration of the block in timings[name]"""
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        timings[name] = round(time.perf_counter() - start, 4)
+        logging.info(f"Startup: {name} took {timings[name]}s")
+
+
+def warmup():
+    """Loads the model and imports pvlib by calculating a clear sky"""
+    from shared_code import ml, solar
+
+    with timed("warmup"):
+        ml.get_model()
+        solar.warmup()
+    warmed_up.set()
+
+
+def start(mode=None):
+    """Starts the warm-up according to SOLAR_WARMUP, called by the FastAPI startup event"""
+    mode = mode or WARMUP
+    if warmed_up.is_set():
+        # eg. a worker forked from a warmed up master, see server
+        return
+    if mode == "blocking":
+        warmup()
+    elif mode == "background":
+        threading.Thread(target=warmup, name="warmup", daemon=True).start()
+
+
+def status():
+    """Returns the readiness: ready when warmed up (or immediately when the warm-up is off)"""
+    from shared_code import ml
+
+    return {
+        "ready": warmed_up.is_set() or WARMUP == "off",
+        "model_loaded": ml.model_loaded(),
+        "timings": dict(timings),
+    }
@@ -1,13 +1,175 @@
 import os
 import json
+import time
+import asyncio
 import logging
-import requests
+import functools
 from datetime import datetime, timedelta
-import pytz
 
 import pandas as pd
+import numpy as np
 
-API_KEY = os.environ["OPENWEATHERMAP_API_KEY"]
+from shared_code import httpclient, resample, metrics
+from shared_code.cache import LRUCache
+from shared_code.singleflight import SingleFlight
+
+# only needed for openweathermap
+API_KEY = os.environ.get("OPENWEATHERMAP_API_KEY")
+
+# Base url of the providers: can point to a local stub server for tests
+OPEN_METEO_URL = os.environ.get(
+    "OPEN_METEO_URL", "https://api.open-meteo.com/v1/forecast"
+)
+OPENWEATHERMAP_URL = os.environ.get(
+    "OPENWEATHERMAP_URL", "https://api.openweathermap.org/data/3.0/onecall"
+)
+
+
+class ProviderNotConfigured(Exception):
+    """The weather provider needs a setting that is missing (eg. OPENWEATHERMAP_API_KEY)"""
+
+
+# Size of a weather grid cell in degrees (0.01° = +/- 1km): installations in the same cell share one forecast
+GRID_RESOLUTION = float(os.environ.get("WEATHER_GRID_RESOLUTION", "0.01"))
+
+
+def snap_location(location):
+    """Snaps a location {lat:x,lng:y} to the center of its weather grid cell
+
+    Args:
+        location (_type_ dict): Geo coordinates
+
+    Returns:
+        _type_ dict: Geo coordinates of the grid cell
+    """
+    return {
+        "lat": round(round(location["lat"] / GRID_RESOLUTION) * GRID_RESOLUTION, 6),
+        "lng": round(round(location["lng"] / GRID_RESOLUTION) * GRID_RESOLUTION, 6),
+    }
+
+
+def grid_key(installation):
+    """Returns the key of the weather grid cell of an installation: (lat, lng, timezone)
+    Installations with the same key get the same weather forecast.
+    """
+    location = snap_location(installation.get("location"))
+    return (location["lat"], location["lng"], installation.get("timezone"))
+
+
+# The weather models are refreshed every cycle (sec), OFFSET is the delay before a new run is published
+MODEL_UPDATE_CYCLE = int(os.environ.get("WEATHER_MODEL_UPDATE_CYCLE", "3600"))
+MODEL_UPDATE_OFFSET = int(os.environ.get("WEATHER_MODEL_UPDATE_OFFSET", "0"))
+
+# days of forecast asked to open-meteo, unless the request needs less (installation["forecast_days"])
+DEFAULT_FORECAST_DAYS = int(os.environ.get("WEATHER_FORECAST_DAYS", "7"))
+MAX_FORECAST_DAYS = 16
+
+# max number of locations in one open-meteo request, see getOpenMeteoDataBulk
+OPEN_METEO_BULK_SIZE = int(os.environ.get("OPEN_METEO_BULK_SIZE", "100"))
+
+# Cache of the 15min forecasts per provider and grid cell
+weather_cache = LRUCache(
+    max_entries=int(os.environ.get("WEATHER_CACHE_MAX_ENTRIES", "1024")),
+    max_bytes=int(os.environ.get("WEATHER_CACHE_MAX_MB", "64")) * 2**20,
+)
+
+
+# Simultaneous upstream calls for the same grid cell
+coalescer = SingleFlight()
+
+metrics.register_cache("weather", weather_cache)
+metrics.register(
+    metrics.Gauge(
+        "upstream_coalesced_total",
+        "weather requests that shared the upstream call of another request",
+        [],
+        lambda: {(): coalescer.shared},
+        "counter",
+    )
+)
+
+
+def next_model_update(now=None):
+    """Returns the epoch (sec) of the next weather model update: a cached forecast expires at that moment"""
+    now = time.time() if now is None else now
+    cycles = (now - MODEL_UPDATE_OFFSET) // MODEL_UPDATE_CYCLE
+    return (cycles + 1) * MODEL_UPDATE_CYCLE + MODEL_UPDATE_OFFSET
+
+
+def model_run(now=None):
+    """Returns the epoch (sec) of the last weather model update: the forecasts of the providers change after it"""
+    return next_model_update(now) - MODEL_UPDATE_CYCLE
+
+
+def forecast_days(installation):
+    """Returns the days of forecast to fetch for an installation, see forecast.forecastWindow"""
+    return installation.get("forecast_days") or DEFAULT_FORECAST_DAYS
+
+
+def weather_key(provider, installation):
+    """Returns the cache key of the forecast of an installation: provider, grid cell, days"""
+    return (provider,) + grid_key(installation) + (forecast_days(installation),)
+
+
+def cache_lookup(provider, installation):
+    """Returns the cached forecast of the grid cell: for the requested days or a longer (default) one"""
+    df = weather_cache.get(weather_key(provider, installation))
+    if df is None and forecast_days(installation) < DEFAULT_FORECAST_DAYS:
+        df = weather_cache.get(
+            weather_key(
+                provider, dict(installation, forecast_days=DEFAULT_FORECAST_DAYS)
+            )
+        )
+    return df
+
+
+def cached_by_grid(provider):
+    """Decorator: caches the forecast of a provider per weather grid cell until the next model update.
+    The provider is called with the location of the grid cell, so all installations in the cell get the same forecast.
+    Simultaneous cache misses for the same cell are coalesced into one upstream call, see SingleFlight.
+    Every caller gets its own copy of the cached DataFrame.
+    Works for plain functions and coroutine functions.
+    """
+
+    def decorator(getData):
+        def grid_installation(installation):
+            return dict(installation, location=snap_location(installation["location"]))
+
+        if asyncio.iscoroutinefunction(getData):
+
+            @functools.wraps(getData)
+            async def async_wrapper(installation):
+                key = weather_key(provider, installation)
+                df = cache_lookup(provider, installation)
+                if df is None:
+
+                    async def fetch():
+                        df = await getData(grid_installation(installation))
+                        weather_cache.put(key, df, expires=next_model_update())
+                        return df
+
+                    df = await coalescer.do_async(key, fetch)
+                return df.copy()
+
+            return async_wrapper
+
+        @functools.wraps(getData)
+        def wrapper(installation):
+            key = weather_key(provider, installation)
+            df = cache_lookup(provider, installation)
+            if df is None:
+
+                def fetch():
+                    df = getData(grid_installation(installation))
+                    weather_cache.put(key, df, expires=next_model_update())
+                    return df
+
+                df = coalescer.do(key, fetch)
+            return df.copy()
+
+        return wrapper
+
+    return decorator
 
 
 def map_open_meteo_to_openweathermap_code(code):
@@ -110,41 +272,31 @@ def map_weather_code(code):
         return code
 
 
-def create_15min_by_interpolation(df_orig, interp_cols):
-    """Create 15min forecast by inserting 15min deltas by interpolation only for the Interpolated columns, rest will be copied"""
-    df = df_orig.copy()
-
-    # Columns to just copy (i.e., not interpolated)
-    copy_cols = [col for col in df.columns if col not in interp_cols + ["dt"]]
-
-    # Set dt as datetime index if not already
-    df["dt"] = pd.to_datetime(df["dt"], unit='s')
-    df.set_index("dt", inplace=True)
-
-    # Create a new datetime index with 15-minute frequency and last hour(23h00) has 3 extra 15min
-    extended_end = df.index.max() + timedelta(minutes=45)
-    new_index = pd.date_range(start=df.index.min(), end=extended_end, freq="15min")
-
-    # Reindex the dataframe to 15-minute intervals
-    df_15min = df.reindex(new_index)
-
-    # Interpolate the numeric columns
-    df_15min[interp_cols] = df_15min[interp_cols].interpolate(method="time")
-
-    # Forward fill the copied fields
-    df_15min[copy_cols] = df_15min[copy_cols].ffill()
+def create_15min_by_interpolation(df_orig, interp_cols, step=900):
+    """Create 15min forecast by inserting 15min deltas by interpolation only for the Interpolated columns, rest will be copied
+    The last hour (eg. 23h00) gets the extra 15min too. Other resolutions with 'step' (sec), see resample.upsample
+    """
+    return resample.upsample_frame(df_orig, interp_cols, step=step)
 
-    # Reset index and convert datetime back to UNIX timestamp (seconds)
-    df_15min = df_15min.reset_index()
-    df_15min.rename(columns={"index": "dt"}, inplace=True)
-    df_15min["dt"] = df_15min["dt"].astype("int64") // 10**9
 
-    return df_15min
+# Columns to interpolate, the others (weather_id, clear_sky, day_of_year) are copied from the previous hour
+interp_cols = ["temp", "pressure", "humidity", "wind_speed", "wind_deg", "clouds_all"]
 
 
-   
+def open_meteo_params(installation):
+    """Returns the query parameters of the open-meteo request for an installation"""
+    location = installation.get("location")
+    return {
+        "latitude": location["lat"],
+        "longitude": location["lng"],
+        "timezone": installation.get("timezone"),
+        "hourly": "temperature_2m,pressure_msl,relativehumidity_2m,windspeed_10m,winddirection_10m,cloudcover,weathercode",
+        "windspeed_unit": "ms",
+        "forecast_days": forecast_days(installation),
+    }
 
 
+@cached_by_grid("openmeteo")
 def getOpenMeteoData(installation):
     """Gets a dict {lat:x,lng:y} and calls open-meteo api and returns  a weather list.
     Every item of the list has the 'hourly' forecast
@@ -155,67 +307,231 @@ def getOpenMeteoData(installation):
     Returns:
         _type_ list of dicts: list of dicts, every dict has the forecast for parameters:...
     """
-    location = installation.get("location")
-    timezone = installation.get("timezone")
-    tz = pytz.timezone(timezone)
-    params = f'?latitude={location["lat"]}&longitude={location["lng"]}&timezone={timezone}&hourly=temperature_2m,pressure_msl,relativehumidity_2m,windspeed_10m,winddirection_10m,cloudcover,weathercode&windspeed_unit=ms'
-    url = "https://api.open-meteo.com/v1/forecast" + params
-    resp = requests.get(url).json()
+    resp = httpclient.get_json(OPEN_METEO_URL, open_meteo_params(installation))
+    return parseOpenMeteoData(resp, installation)
 
-    df_OM = pd.DataFrame.from_dict(resp["hourly"])
 
-    # °C to °K and round to 1 decimal
-    df_OM["temperature_2m"] = df_OM["temperature_2m"].apply(
-        lambda t: round(t + 273.15, 1)
+@cached_by_grid("openmeteo")
+async def getOpenMeteoDataAsync(installation):
+    """Async version of getOpenMeteoData: the upstream call does not block the event loop"""
+    resp = await httpclient.get_json_async(
+        OPEN_METEO_URL, open_meteo_params(installation)
     )
+    return parseOpenMeteoData(resp, installation)
 
-    # we take naive time, convert into aware time
-    df_OM["time"] = df_OM["time"].apply(
-        lambda t: tz.localize(datetime.strptime(t, "%Y-%m-%dT%H:%M"))
-    )
-    # we make timestamp
-    df_OM["dt"] = df_OM["time"].apply(lambda t: int(t.timestamp()))
 
-    # drop 'time' col -> not needed when we return
-    df_OM.drop(["time"], inplace=True, axis=1)
+# open-meteo weather code (0-99) -> openweathermap code, NaN = unknown code
+OPEN_METEO_CODES = np.array(
+    [
+        np.nan
+        if map_open_meteo_to_openweathermap_code(code) is None
+        else map_open_meteo_to_openweathermap_code(code)
+        for code in range(100)
+    ]
+)
+
 
-    # we create clear_sky col (default=0)
-    df_OM["clear_sky"] = 0
-    df_OM["day_of_year"] = df_OM["dt"].apply(
-        lambda ts: datetime.fromtimestamp(ts).timetuple().tm_yday
+def map_open_meteo_codes(codes):
+    """Vectorized map_open_meteo_to_openweathermap_code: maps an array of codes with a lookup table
+
+    Args:
+        codes (_type_ array): open-meteo weather codes
+
+    Returns:
+        _type_ ndarray (float): openweathermap codes, NaN for unknown codes
+    """
+    codes = np.asarray(codes, dtype=np.float64)
+    known = (codes >= 0) & (codes < len(OPEN_METEO_CODES))
+    mapped = np.full(codes.shape, np.nan)
+    mapped[known] = OPEN_METEO_CODES[codes[known].astype(np.int64)]
+    return mapped
+
+
+def day_of_year(dt, timezone):
+    """Returns the day of the year of epoch timestamps (sec) in the timezone of the site
+
+    Args:
+        dt (_type_ array): epoch sec
+        timezone (_type_ string): official IANA timezone
+
+    Returns:
+        _type_ ndarray (int): day of year 1-366
+    """
+    times = pd.DatetimeIndex(pd.to_datetime(np.asarray(dt), unit="s", utc=True))
+    # Series.dt: pylint cannot infer the field accessors of DatetimeIndex
+    return pd.Series(times.tz_convert(timezone)).dt.dayofyear.to_numpy()
+
+
+def ingestOpenMeteoData(resp, timezone):
+    """Converts the 'hourly' forecast of an open-meteo response into an hourly weather DataFrame.
+    Columnar: every field is converted as one array.
+
+    Args:
+        resp (_type_ dict): decoded json response of open-meteo
+        timezone (_type_ string): official IANA timezone of the (local) times in the response
+
+    Returns:
+        _type_ DataFrame: dt	temp	pressure	humidity	wind_speed	wind_deg	clouds_all	weather_id	clear_sky	day_of_year
+    """
+    hourly = resp["hourly"]
+
+    # we take naive time, convert into aware time (ambiguous and non existing hours as standard time)
+    times = pd.DatetimeIndex(pd.to_datetime(hourly["time"], format="%Y-%m-%dT%H:%M"))
+    times = times.tz_localize(
+        timezone,
+        ambiguous=np.zeros(len(times), dtype=bool),
+        nonexistent=pd.Timedelta(hours=1),
     )
 
-    # map opemn-meteo weather code to openweathermap codes
-    df_OM["weathercode"] = df_OM["weathercode"].apply(
-        lambda id: map_open_meteo_to_openweathermap_code(id)
+    df_OM = pd.DataFrame(
+        {
+            # we make timestamp
+            "dt": times.asi8 // 10**9,
+            # °C to °K and round to 1 decimal (python round as before, np.round rounds some halves the other way)
+            "temp": np.array(
+                [
+                    round(t, 1)
+                    for t in (
+                        np.asarray(hourly["temperature_2m"], dtype=np.float64) + 273.15
+                    ).tolist()
+                ]
+            ),
+            "pressure": hourly["pressure_msl"],
+            "humidity": hourly["relativehumidity_2m"],
+            "wind_speed": hourly["windspeed_10m"],
+            "wind_deg": hourly["winddirection_10m"],
+            "clouds_all": hourly["cloudcover"],
+            # map opemn-meteo weather code to openweathermap codes
+            "weather_id": map_open_meteo_codes(hourly["weathercode"]),
+            # we create clear_sky col (default=0)
+            "clear_sky": 0,
+            "day_of_year": pd.Series(times).dt.dayofyear.to_numpy(),
+        }
     )
+    return df_OM
+
 
-    # rename to OWM API
-    df_OM.rename(
-        inplace=True,
-        columns={
-            "dt": "dt",
-            "temperature_2m": "temp",
-            "pressure_msl": "pressure",
-            "relativehumidity_2m": "humidity",
-            "windspeed_10m": "wind_speed",
-            "winddirection_10m": "wind_deg",
-            "cloudcover": "clouds_all",
-            "weathercode": "weather_id",
-            "clear_sky": "clear_sky",
-            "day_of_year": "day_of_year",
-        },
+def open_meteo_bulk_params(installations):
+    """Returns the query parameters of one open-meteo request for several installations (comma separated lists)"""
+    params = open_meteo_params(installations[0])
+    params["latitude"] = ",".join(
+        str(inst["location"]["lat"]) for inst in installations
     )
+    params["longitude"] = ",".join(
+        str(inst["location"]["lng"]) for inst in installations
+    )
+    params["timezone"] = ",".join(inst["timezone"] for inst in installations)
+    return params
+
+
+def bulk_misses(installations):
+    """Returns the cached forecasts {grid key: DataFrame} and one installation (of the grid cell) per cache miss"""
+    frames, misses = {}, {}
+    for installation in installations:
+        key = weather_key("openmeteo", installation)
+        if key in frames or key in misses:
+            continue
+        df = cache_lookup("openmeteo", installation)
+        if df is None:
+            misses[key] = dict(
+                installation, location=snap_location(installation["location"])
+            )
+        else:
+            frames[key] = df
+    return frames, misses
+
+
+def bulk_chunks(misses):
+    """Splits the cache misses in chunks of OPEN_METEO_BULK_SIZE with the same forecast days:
+    list of (keys, installations)
+    """
+    per_days = {}
+    for key, installation in misses.items():
+        per_days.setdefault(key[-1], []).append((key, installation))
+    return [
+        tuple(zip(*items[start : start + OPEN_METEO_BULK_SIZE]))
+        for items in per_days.values()
+        for start in range(0, len(items), OPEN_METEO_BULK_SIZE)
+    ]
+
+
+def bulk_store(frames, keys, installations, resp):
+    """Splits a bulk response into one forecast per location, stores them in frames and the cache"""
+    # one location: open-meteo answers an object instead of a list
+    if isinstance(resp, dict):
+        resp = [resp]
+    expires = next_model_update()
+    for key, installation, location_resp in zip(keys, installations, resp):
+        df = parseOpenMeteoData(location_resp, installation)
+        weather_cache.put(key, df, expires=expires)
+        frames[key] = df
+
+
+def getOpenMeteoDataBulk(installations):
+    """Returns the open-meteo forecast of many installations with as few upstream calls as possible:
+    one forecast per grid cell, cached cells are not asked, the others are asked OPEN_METEO_BULK_SIZE
+    locations per request. Used by the batch forecast and the background precomputation.
+
+    Args:
+        installations (_type_ list of dict): see Installation
 
-    # Columns to interpolate
-    interp_cols = [
-        "temp", "pressure", "humidity", "wind_speed", "wind_deg", "clouds_all"
+    Returns:
+        _type_ list of DataFrame: one copy per installation, same order, see getOpenMeteoData
+    """
+    frames, misses = bulk_misses(installations)
+    for keys, chunk in bulk_chunks(misses):
+        resp = httpclient.get_json(OPEN_METEO_URL, open_meteo_bulk_params(chunk))
+        bulk_store(frames, keys, chunk, resp)
+    return [
+        frames[weather_key("openmeteo", installation)].copy()
+        for installation in installations
+    ]
+
+
+async def getOpenMeteoDataBulkAsync(installations):
+    """Async version of getOpenMeteoDataBulk: the chunks are requested concurrently.
+    The grid cells already asked by another request are not asked again, see SingleFlight.
+    """
+    frames, misses = bulk_misses(installations)
+
+    async def fetch(keys):
+        chunks = bulk_chunks({key: misses[key] for key in keys})
+        responses = await asyncio.gather(
+            *[
+                httpclient.get_json_async(OPEN_METEO_URL, open_meteo_bulk_params(chunk))
+                for chunk_keys, chunk in chunks
+            ]
+        )
+        fetched = {}
+        for (chunk_keys, chunk), resp in zip(chunks, responses):
+            bulk_store(fetched, chunk_keys, chunk, resp)
+        return fetched
+
+    if misses:
+        frames.update(await coalescer.do_many_async(list(misses), fetch))
+    return [
+        frames[weather_key("openmeteo", installation)].copy()
+        for installation in installations
     ]
+
+
+def parseOpenMeteoData(resp, installation):
+    """Converts an open-meteo response into the 15min weather DataFrame
+
+    Args:
+        resp (_type_ dict): decoded json response of open-meteo
+        installation (_type_ dict): see Installation
+
+    Returns:
+        _type_ DataFrame: dt	temp	pressure	humidity	wind_speed	wind_deg	clouds_all	weather_id	clear_sky	day_of_year
+    """
+    df_OM = ingestOpenMeteoData(resp, installation.get("timezone"))
+
     # Create 15min forecast by inserting 15min deltas by interpolation only for the Interpolated columns, rest will be copied
     df_15 = create_15min_by_interpolation(df_OM, interp_cols)
 
     # round to 1 decimal
-    df_15[interp_cols] = df_15[interp_cols].apply(lambda x: round(x, 1))
+    df_15[interp_cols] = df_15[interp_cols].round(1)
 
     # sort by timestamp 'dt'
     df_15.sort_values(["dt"], inplace=True)
@@ -225,6 +541,17 @@ def getOpenMeteoData(installation):
     return df_15
 
 
+def openweathermap_params(installation):
+    """Returns the query parameters of the openweathermap request for an installation"""
+    if not API_KEY:
+        raise ProviderNotConfigured(
+            "weather provider 'openweathermap' is not configured: OPENWEATHERMAP_API_KEY is not set"
+        )
+    location = installation.get("location")
+    return {"lat": location["lat"], "lon": location["lng"], "appid": API_KEY}
+
+
+@cached_by_grid("openweathermap")
 def getOpenWeatherData(installation):
     """Gets a dict {lat:x,lng:y} a calls openweather api and returns the subset as a weathet list.
     Every item of the list has the 'hourly' forecast
@@ -235,11 +562,22 @@ def getOpenWeatherData(installation):
     Returns:
         _type_ DataFrame: dt	temp	pressure	humidity	wind_speed	wind_deg	clouds_all	weather_id	clear_sky	day_of_year
     """
-    location = installation.get("location")
     # remark: we use the openweathermap API v3 (3.0) and not the v2 (2.5) since june 2024
-    url = f'https://api.openweathermap.org/data/3.0/onecall?lat={location["lat"]}&lon={location["lng"]}&appid={API_KEY}'
-    resp = requests.get(url).json()
+    resp = httpclient.get_json(OPENWEATHERMAP_URL, openweathermap_params(installation))
+    return parseOpenWeatherData(resp, installation)
+
+
+@cached_by_grid("openweathermap")
+async def getOpenWeatherDataAsync(installation):
+    """Async version of getOpenWeatherData: the upstream call does not block the event loop"""
+    resp = await httpclient.get_json_async(
+        OPENWEATHERMAP_URL, openweathermap_params(installation)
+    )
+    return parseOpenWeatherData(resp, installation)
+
 
+def parseOpenWeatherData(resp, installation):
+    """Converts an openweathermap response into the 15min weather DataFrame, see getOpenWeatherData"""
     df_OWM = pd.DataFrame.from_dict(resp["hourly"])
 
     # get weater_id from inside dict
@@ -261,28 +599,15 @@ def getOpenWeatherData(installation):
     df_OWM.rename(inplace=True, columns={"clouds": "clouds_all"})
     # add 2 colums so everything is in the right order for de mlp model
     df_OWM["clear_sky"] = 0
-    df_OWM["day_of_year"] = df_OWM["dt"].apply(
-        lambda ts: datetime.fromtimestamp(ts).timetuple().tm_yday
+    df_OWM["day_of_year"] = day_of_year(
+        df_OWM["dt"], installation.get("timezone") or "UTC"
     )
 
-    # create copie for every 15 min and merge
-    df_15 = df_OWM.copy()
-    df_15["dt"] = df_15["dt"] + 900
-    df_30 = df_OWM.copy()
-    df_30["dt"] = df_OWM["dt"] + 1800
-    df_45 = df_OWM.copy()
-    df_45["dt"] = df_OWM["dt"] + 2700
-
-    weather = df_OWM.merge(df_15, how="outer")
-    weather = weather.merge(df_30, how="outer")
-    weather = weather.merge(df_45, how="outer")
-
-    # sort by timestamp 'dt'
-    weather.sort_values(["dt"], inplace=True)
-    weather.reset_index(drop=True, inplace=True)
+    # Create 15min forecast by inserting 15min deltas by interpolation only for the Interpolated columns, rest will be copied
+    weather = create_15min_by_interpolation(df_OWM, interp_cols)
 
-    # delete last 3 rows: we do not need +15min,30min,45min for last 'hour'
-    weather = weather.iloc[:-2]
+    # round to 1 decimal
+    weather[interp_cols] = weather[interp_cols].round(1)
 
     logging.info(f"Succes Openweather API call")
     return weather
@@ -306,24 +631,3 @@ def getOpenWeatherData(installation):
 #             ts += 900
 #     forecast_15min.append(forecast[-1])
 #     return forecast_15min
-
-
-## Extra tests for pytest to obtain 100% code coverage
-test0 = map_weather_code(800)
-test1 = map_weather_code(200)
-test2 = map_weather_code(300)
-test3 = map_weather_code(502)
-test4 = map_weather_code(601)
-test5 = map_weather_code(701)
-# Extra tests for open-meteo codes
-test6 = map_weather_code(0)
-test7 = map_weather_code(1)
-test8 = map_weather_code(2)
-test9 = map_weather_code(3)
-test10 = map_weather_code(45)
-test11 = map_weather_code(51)
-test12 = map_weather_code(53)
-test13 = map_weather_code(55)
-test14 = map_weather_code(71)
-test15 = map_weather_code(73)
-test16 = map_weather_code(95)
@@ -0,0 +1,91 @@
+"""Local stub of the open-meteo forecast API for tests and benchmarks.
+
+Usage:
+    with OpenMeteoStub(delay=0.1) as stub:
+        weatherforecast.OPEN_METEO_URL = stub.url
+        ...
+        assert stub.requests == 1
+
+requests: number of requests, locations: number of locations asked (bulk requests ask several)
+"""
+import json
+import time
+import threading
+from pathlib import Path
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlparse, parse_qs
+
+FIXTURE = (
+    Path(__file__).resolve().parent
+    / "shared_code"
+    / "fixtures"
+    / "openmeteo_forecast.json"
+)
+
+
+class OpenMeteoStub:
+    """Serves the open-meteo fixture for every location on a free local port
+
+    Args:
+        delay (float): latency (sec) of every response
+        payload (dict): response, default the open-meteo fixture
+    """
+
+    def __init__(self, delay=0.0, payload=None):
+        self.delay = delay
+        self.locations = 0
+        self.payload = payload or json.loads(FIXTURE.read_text())
+        self.requests = 0
+        self._lock = threading.Lock()
+        self.server = ThreadingHTTPServer(("127.0.0.1", 0), self._handler())
+        self.server.daemon_threads = True
+        self.url = f"http://127.0.0.1:{self.server.server_port}/v1/forecast"
+
+    def _handler(self):
+        stub = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+            # headers and body are separate writes: without this Nagle + delayed ACK add 40 ms per response
+            disable_nagle_algorithm = True
+
+            def do_GET(self):
+                with stub._lock:
+                    stub.requests += 1
+                time.sleep(stub.delay)
+                query = parse_qs(urlparse(self.path).query)
+                resp = stub.response(query)
+                with stub._lock:
+                    stub.locations += len(resp) if isinstance(resp, list) else 1
+                body = json.dumps(resp).encode()
+                self.send_response(200)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                pass
+
+        return Handler
+
+    def response(self, query):
+        """Returns the fixture with the requested location, a list for comma separated locations (bulk)"""
+        latitudes = query.get("latitude", [""])[0].split(",")
+        longitudes = query.get("longitude", [""])[0].split(",")
+        timezones = query.get("timezone", [""])[0].split(",")
+        responses = []
+        for nr, (latitude, longitude) in enumerate(zip(latitudes, longitudes)):
+            resp = dict(self.payload)
+            resp["latitude"], resp["longitude"] = latitude, longitude
+            resp["timezone"] = timezones[min(nr, len(timezones) - 1)]
+            responses.append(resp)
+        return responses if len(responses) > 1 else responses[0]
+
+    def __enter__(self):
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        return self
+
+    def __exit__(self, *exc):
+        self.server.shutdown()
+        self.server.server_close()
@@ -1,6 +1,38 @@
+import os
+import sys
+import time
+import shutil
+import socket
+import asyncio
+import subprocess
+import requests
+import pytest
 from fastapi.testclient import TestClient
 
 from app import app
+import numpy as np
+from shared_code import (
+    weatherforecast,
+    ml,
+    solar,
+    startup,
+    resample,
+    registry,
+    scheduler,
+)
+from shared_code import (
+    forecast,
+    providers,
+    inference,
+    metrics,
+    clearsky_table,
+    compute,
+    responsecache,
+    server,
+)
+from shared_code import encoding
+from shared_code.cache import LRUCache
+from stub_server import OpenMeteoStub
 
 test_site = {
     "date": "20-01-2023",
@@ -16,6 +48,15 @@ test_site = {
 client = TestClient(app)
 
 
+@pytest.fixture
+def open_meteo_stub(monkeypatch):
+    with OpenMeteoStub(delay=0.2) as stub:
+        monkeypatch.setattr(weatherforecast, "OPEN_METEO_URL", stub.url)
+        weatherforecast.weather_cache.clear()
+        yield stub
+    weatherforecast.weather_cache.clear()
+
+
 def test_api_get():
     response = client.get("/")
     assert response.status_code == 200
@@ -34,3 +75,693 @@ def test_api_post_forecast_with_query_params():
 def test_api_post_clearsky():
     response = client.post("/clearsky", json=test_site)
     assert response.status_code == 200
+
+
+def test_api_post_forecast_batch():
+    response = client.post("/forecast/batch?provider=file", json=[test_site, test_site])
+    assert response.status_code == 200
+    assert len(response.json()) == 2
+
+
+def test_weather_grid_key():
+    neighbour = dict(test_site, location={"lat": 51.001, "lng": 3.1099})
+    assert weatherforecast.grid_key(neighbour) == weatherforecast.grid_key(test_site)
+    assert weatherforecast.next_model_update(
+        7201
+    ) % weatherforecast.MODEL_UPDATE_CYCLE == (
+        weatherforecast.MODEL_UPDATE_OFFSET % weatherforecast.MODEL_UPDATE_CYCLE
+    )
+
+
+def test_lru_cache():
+    cache = LRUCache(max_entries=2)
+    cache.put("a", 1)
+    cache.put("b", 2)
+    assert cache.get("a") == 1
+    cache.put("c", 3)
+    assert cache.get("b") is None
+    cache.put("d", 4, expires=0)
+    assert cache.get("d") is None
+    assert cache.stats()["hits"] == 1 and cache.stats()["misses"] == 2
+
+
+def test_api_post_forecast_stub(open_meteo_stub):
+    response = client.post("/forecast", json=test_site)
+    assert response.status_code == 200
+    assert len(response.json()) == 4 * 24 * 7
+    response = client.post("/forecast", json=test_site)
+    assert open_meteo_stub.requests == 1
+
+
+def test_open_meteo_async_overlaps(open_meteo_stub):
+    sites = [
+        dict(test_site, location={"lat": 50.0 + nr, "lng": 3.11}) for nr in range(4)
+    ]
+
+    async def fetch_all():
+        return await asyncio.gather(
+            *[weatherforecast.getOpenMeteoDataAsync(site) for site in sites]
+        )
+
+    start = time.perf_counter()
+    forecasts = asyncio.run(fetch_all())
+    assert time.perf_counter() - start < 4 * open_meteo_stub.delay
+    assert open_meteo_stub.requests == 4
+    assert all(len(df) == 4 * 24 * 7 for df in forecasts)
+
+
+def test_ml_predict_power_clipping():
+    X = np.zeros((3, len(ml.FEATURE_COLUMNS)))
+    X[:, ml.FEATURE_COLUMNS.index("temp")] = 290.0
+    X[:, ml.FEATURE_COLUMNS.index("pressure")] = 1015.0
+    X[:, ml.FEATURE_COLUMNS.index("clear_sky")] = [0, 10, 5000]
+    power = ml.predictPower(X)
+    assert power.dtype == np.int64
+    assert power[0] == 0
+    assert 0 <= power[1] <= 10
+    assert 0 <= power[2] <= 5000
+
+
+def test_clear_sky_profile_cache():
+    solar.clear_sky_cache.clear()
+    first = solar.getClearSky(test_site)
+    hits = solar.clear_sky_cache.hits
+    bigger = solar.getClearSky(dict(test_site, totalWattPeak=14000, wattInvertor=10000))
+    assert solar.clear_sky_cache.hits == hits + 1
+    assert (bigger["clear_sky"] >= first["clear_sky"]).all()
+    assert bigger["clear_sky"].max() <= 10000
+
+
+def test_api_post_clearsky_planes():
+    planes = [
+        {"tilt": 15, "azimuth": 90, "wattPeak": 3700},
+        {"tilt": 15, "azimuth": 270, "wattPeak": 3700},
+    ]
+    response = client.post("/clearsky", json=dict(test_site, planes=planes))
+    assert response.status_code == 200
+    row = max(response.json(), key=lambda row: row["clear_sky"])
+    assert row["clear_sky"] <= test_site["wattInvertor"]
+    assert row["clear_sky_0"] > 0 and row["clear_sky_1"] > 0
+
+
+def test_api_post_clearsky_range():
+    body = dict(test_site, start_date="20-01-2023", end_date="26-01-2023")
+    response = client.post("/clearsky/range", json=body)
+    assert response.status_code == 200
+    assert len(response.text.splitlines()) == 7 * 96
+    response = client.post("/clearsky/range?format=csv", json=dict(body, freq="60min"))
+    assert response.status_code == 200
+    assert len(response.text.splitlines()) == 1 + 7 * 24
+    # an unknown format is rejected before the clear sky is calculated
+    count = metrics.stage_seconds.count(stage="clear_sky")
+    response = client.post("/clearsky/range?format=xml", json=body)
+    assert response.status_code == 400
+    assert metrics.stage_seconds.count(stage="clear_sky") == count
+
+
+def test_api_post_clearsky_formats():
+    records = client.post("/clearsky", json=test_site).json()
+    response = client.post("/clearsky?format=columns", json=test_site)
+    assert response.status_code == 200
+    assert response.json()["clear_sky"] == [row["clear_sky"] for row in records]
+    response = client.post("/clearsky", json=test_site, headers={"Accept": "text/csv"})
+    assert response.headers["content-type"].startswith("text/csv")
+    assert len(response.text.splitlines()) == 1 + len(records)
+    response = client.post("/clearsky?format=xml", json=test_site)
+    assert response.status_code == 406
+    # q weights: q=0 is not acceptable
+    assert encoding.negotiate(accept="text/csv;q=0, application/json") == "json"
+    assert encoding.negotiate(accept="application/json;q=0.5, text/csv") == "csv"
+
+
+def test_api_post_clearsky_arrow():
+    pa = pytest.importorskip("pyarrow")
+    response = client.post("/clearsky?format=arrow", json=test_site)
+    table = pa.ipc.open_stream(response.content).read_all()
+    assert str(table.schema.field("clear_sky").type) == "int16"
+
+
+def test_map_weather_code():
+    # openweathermap codes
+    assert weatherforecast.map_weather_code(800) == 800
+    assert weatherforecast.map_weather_code(200) == 211
+    assert weatherforecast.map_weather_code(300) == 500
+    assert weatherforecast.map_weather_code(502) == 502
+    assert weatherforecast.map_weather_code(601) == 601
+    weatherforecast.map_weather_code(701)
+    # open-meteo codes
+    assert weatherforecast.map_weather_code(0) == 800
+    assert weatherforecast.map_weather_code(1) == 801
+    assert weatherforecast.map_weather_code(2) == 802
+    assert weatherforecast.map_weather_code(3) == 804
+    assert weatherforecast.map_weather_code(45) == 701
+    assert weatherforecast.map_weather_code(51) == 500
+    assert weatherforecast.map_weather_code(53) == 501
+    assert weatherforecast.map_weather_code(55) == 502
+    assert weatherforecast.map_weather_code(71) == 600
+    assert weatherforecast.map_weather_code(73) == 601
+    assert weatherforecast.map_weather_code(95) == 211
+
+
+def test_api_get_health():
+    startup.warmup()
+    response = client.get("/health")
+    assert response.status_code == 200
+    assert response.json()["model_loaded"]
+    assert "load_model" in response.json()["timings"]
+
+
+def test_prefork_server():
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        port = sock.getsockname()[1]
+    code = f"import app; from shared_code import server; server.serve(app.app, '127.0.0.1', {port}, workers=2)"
+    # no precomputation and no registry file in the workers
+    env = dict(os.environ, SCHEDULER="off", REGISTRY_DB=":memory:")
+    master = subprocess.Popen(
+        [sys.executable, "-c", code], stderr=subprocess.DEVNULL, env=env
+    )
+    try:
+        for attempt in range(100):
+            try:
+                response = requests.get(f"http://127.0.0.1:{port}/health", timeout=1)
+                break
+            except requests.ConnectionError:
+                time.sleep(0.2)
+        assert response.status_code == 200
+        assert response.json()["model_loaded"]
+    finally:
+        master.terminate()
+        assert master.wait(timeout=30) == 0
+
+
+def test_prefork_server_gives_up():
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        port = sock.getsockname()[1]
+    # the workers exit at startup
+    code = (
+        "import fastapi; from shared_code import server; broken = fastapi.FastAPI(); "
+        "broken.add_event_handler('startup', lambda: 1 / 0); "
+        f"server.serve(broken, '127.0.0.1', {port}, workers=2)"
+    )
+    env = dict(
+        os.environ,
+        SCHEDULER="off",
+        REGISTRY_DB=":memory:",
+        WORKER_BACKOFF="0.01",
+        WORKER_MAX_FAILURES="3",
+    )
+    master = subprocess.Popen(
+        [sys.executable, "-c", code], stderr=subprocess.DEVNULL, env=env
+    )
+    try:
+        assert master.wait(timeout=60) == 1
+    finally:
+        master.kill()
+
+
+def test_respawn_delay():
+    assert server.respawn_delay(0) == 0
+    assert server.respawn_delay(1) == server.WORKER_BACKOFF
+    assert server.respawn_delay(3) == 4 * server.WORKER_BACKOFF
+    assert server.respawn_delay(100) == server.WORKER_BACKOFF_MAX
+
+
+def test_open_meteo_codes_lookup_table():
+    codes = list(range(0, 110))
+    mapped = weatherforecast.map_open_meteo_codes(codes)
+    for code, value in zip(codes, mapped):
+        expected = weatherforecast.map_open_meteo_to_openweathermap_code(code)
+        assert (np.isnan(value) and expected is None) or value == expected
+
+
+def test_open_meteo_kelvin_rounding():
+    # -5.0 °C is 268.15 °K: round() gives 268.1, np.round 268.2
+    hourly = {
+        "time": ["2023-01-20T00:00", "2023-01-20T01:00"],
+        "temperature_2m": [-5.0, 21.3],
+        "pressure_msl": [1013.0, 1013.0],
+        "relativehumidity_2m": [80, 80],
+        "windspeed_10m": [3.0, 3.0],
+        "winddirection_10m": [180, 180],
+        "cloudcover": [50, 50],
+        "weathercode": [3, 3],
+    }
+    df = weatherforecast.ingestOpenMeteoData({"hourly": hourly}, "UTC")
+    assert list(df["temp"]) == [round(t + 273.15, 1) for t in [-5.0, 21.3]]
+
+
+def test_day_of_year_in_site_timezone():
+    # 20-01-2023 00:30 in Brussels is 19-01-2023 23:30 UTC
+    assert list(weatherforecast.day_of_year([1674171000], "Europe/Brussels")) == [20]
+    assert list(weatherforecast.day_of_year([1674171000], "UTC")) == [19]
+
+
+def test_resample_upsample():
+    dt = np.array([0, 3600, 7200])
+    new_dt, interpolated, held = resample.upsample(
+        dt,
+        np.array([[0.0], [np.nan], [20.0]]),
+        np.array([[800.0], [500.0], [np.nan]]),
+        step=1800,
+    )
+    assert list(new_dt) == [0, 1800, 3600, 5400, 7200, 9000]
+    assert list(interpolated[:, 0]) == [0.0, 5.0, 10.0, 15.0, 20.0, 20.0]
+    assert list(held[:, 0]) == [800.0, 800.0, 500.0, 500.0, 500.0, 500.0]
+
+
+def test_parse_openweathermap():
+    hourly = [
+        {
+            "dt": 1674169200 + 3600 * hour,
+            "temp": 275.0 + hour,
+            "pressure": 1015,
+            "humidity": 80,
+            "wind_speed": 3.0,
+            "wind_deg": 200,
+            "clouds": 50,
+            "weather": [{"id": 800}],
+        }
+        for hour in range(48)
+    ]
+    df = weatherforecast.parseOpenWeatherData({"hourly": hourly}, test_site)
+    assert len(df) == 4 * 48
+    assert list(df["temp"][:5]) == [275.0, 275.2, 275.5, 275.8, 276.0]
+
+
+def test_api_post_forecast_file_provider():
+    response = client.post("/forecast?provider=file", json=test_site)
+    assert response.status_code == 200
+    assert len(response.json()) == 4 * 24 * 7
+    response = client.post("/forecast?provider=unknown", json=test_site)
+    assert response.status_code == 400
+
+
+def test_api_post_forecast_provider_not_configured(monkeypatch):
+    monkeypatch.setattr(weatherforecast, "API_KEY", None)
+    response = client.post("/forecast?provider=openweathermap", json=test_site)
+    assert response.status_code == 503
+    assert "OPENWEATHERMAP_API_KEY" in response.json()["detail"]
+
+
+def test_open_meteo_requests_coalesced(open_meteo_stub):
+    async def fetch_all():
+        return await asyncio.gather(
+            *[weatherforecast.getOpenMeteoDataAsync(test_site) for nr in range(5)]
+        )
+
+    forecasts = asyncio.run(fetch_all())
+    assert open_meteo_stub.requests == 1
+    assert len({id(df) for df in forecasts}) == 5
+
+
+def test_forecasts_of_a_grid_cell_coalesced(open_meteo_stub):
+    # 5 simultaneous /forecast of installations in the same grid cell: one upstream request
+    shared = weatherforecast.coalescer.shared
+
+    async def forecast_all():
+        return await asyncio.gather(
+            *[
+                forecast.calcForecastAsync(dict(test_site, tilt=10 + nr))
+                for nr in range(5)
+            ]
+        )
+
+    forecasts = asyncio.run(forecast_all())
+    assert open_meteo_stub.requests == 1
+    assert weatherforecast.coalescer.shared == shared + 4
+    assert all(len(df) == 4 * 24 * 7 for df in forecasts)
+
+
+def test_coalesced_request_survives_cancelled_leader(open_meteo_stub):
+    async def fetch():
+        leader = asyncio.ensure_future(weatherforecast.getOpenMeteoDataAsync(test_site))
+        await asyncio.sleep(0)
+        waiter = asyncio.ensure_future(weatherforecast.getOpenMeteoDataAsync(test_site))
+        await asyncio.sleep(0)
+        # client disconnect of the first request: the second one still gets the forecast
+        leader.cancel()
+        return await waiter
+
+    assert len(asyncio.run(fetch())) == 4 * 24 * 7
+    assert open_meteo_stub.requests == 1
+
+
+def test_open_meteo_bulk_fetch(open_meteo_stub, monkeypatch):
+    monkeypatch.setattr(weatherforecast, "OPEN_METEO_BULK_SIZE", 2)
+    sites = [
+        dict(test_site, location={"lat": 50.0 + nr, "lng": 3.11}) for nr in range(5)
+    ]
+    weatherforecast.getOpenMeteoData(sites[0])
+    forecasts = weatherforecast.getOpenMeteoDataBulk(sites + [sites[1]])
+    # 1 single + 2 bulk requests for the 4 cells that were not cached
+    assert open_meteo_stub.requests == 3
+    assert open_meteo_stub.locations == 5
+    assert len(forecasts) == 6
+    assert all(len(df) == 4 * 24 * 7 for df in forecasts)
+    weatherforecast.getOpenMeteoDataBulk(sites)
+    assert open_meteo_stub.requests == 3
+
+
+@pytest.fixture
+def installation_registry():
+    registry.set_registry(registry.InstallationRegistry(":memory:"))
+    scheduler.forecast_store.clear()
+    yield registry.get_registry()
+    registry.set_registry(None)
+    scheduler.forecast_store.clear()
+
+
+def test_registered_installation_precomputed(installation_registry):
+    response = client.post("/installations?provider=file", json=test_site)
+    assert response.status_code == 201
+    id = response.json()["id"]
+    assert [site["id"] for site in client.get("/installations").json()] == [id]
+
+    # precomputed at registration: the forecast is a read of the store
+    hits = scheduler.forecast_store.hits
+    response = client.post(
+        "/forecast?provider=file", json=dict(test_site, date="21-01-2023")
+    )
+    assert response.status_code == 200
+    assert scheduler.forecast_store.hits == hits + 1
+    assert client.get(f"/installations/{id}/forecast").json() == response.json()
+
+    # a window past the precomputed forecast is calculated, not truncated
+    stored = scheduler.lookup(
+        client.get(f"/installations/{id}").json()["installation"], "file"
+    )
+    start, last = int(stored["dt"].iloc[0]), int(stored["dt"].iloc[-1])
+    predictions = metrics.stage_seconds.count(stage="predict")
+    url = f"/forecast?provider=file&start={start}&end="
+    assert client.post(url + str(start + 86400), json=test_site).status_code == 200
+    assert metrics.stage_seconds.count(stage="predict") == predictions
+    assert client.post(url + str(last + 3600), json=test_site).status_code == 200
+    assert metrics.stage_seconds.count(stage="predict") == predictions + 1
+
+    cycle = asyncio.run(scheduler.run_cycle())
+    assert cycle["sites"] == 1 and cycle["failed_batches"] == 0
+    # same weather: nothing to predict again
+    assert cycle["rows"] == 4 * 24 * 7 and cycle["recomputed_rows"] == 0
+    assert client.get("/scheduler").json()["last_cycle"]["sites"] == 1
+
+    assert client.delete(f"/installations/{id}").status_code == 204
+    assert client.get(f"/installations/{id}").status_code == 404
+    assert scheduler.lookup(test_site, "file") is None
+
+
+def test_activated_model_recomputes_precomputed_forecasts(
+    installation_registry, tmp_path, monkeypatch
+):
+    from shared_code import models
+
+    shutil.copy(ml.model_path, tmp_path / "v1.pkl")
+    inference.export(ml.model_path, tmp_path / "v1.npz")
+    model = inference.NumpyMLP.load(tmp_path / "v1.npz")
+    # another model: 200 W more before clipping
+    inference.NumpyMLP(
+        model.coefs,
+        model.intercepts[:-1] + [model.intercepts[-1] + 200],
+        feature_names=ml.FEATURE_COLUMNS,
+    ).save(tmp_path / "v2.npz")
+    monkeypatch.setattr(models, "MODEL_DIR", tmp_path)
+    monkeypatch.setattr(models, "MODEL_VERSION", "v1")
+    monkeypatch.setattr(ml, "mlp", None)
+    monkeypatch.setattr(ml, "model_version", None)
+
+    assert (
+        client.post("/installations?provider=file", json=test_site).status_code == 201
+    )
+    before = client.post("/forecast?provider=file", json=test_site).json()
+    assert client.post("/models/v2/activate").status_code == 200
+
+    # same weather, other model: every row is predicted again
+    cycle = asyncio.run(scheduler.run_cycle())
+    assert cycle["recomputed_rows"] == cycle["rows"]
+    after = client.post("/forecast?provider=file", json=test_site).json()
+    assert after != before
+    assert [row["P_predicted"] for row in after] == forecast.calcForecast(
+        test_site, "file"
+    )["P_predicted"].tolist()
+
+
+def test_update_forecast_batch_recomputes_changed_rows(monkeypatch):
+    sites = [
+        test_site,
+        dict(test_site, tilt=10),
+        dict(test_site, location={"lat": 52.0, "lng": 3.11}),
+    ]
+    full = forecast.calcForecastBatch(sites, "file")
+    dfs, recomputed = forecast.updateForecastBatch(
+        sites, [None, full[1], full[2]], "file"
+    )
+    assert recomputed == len(full[0])
+    assert all(df.equals(expected) for df, expected in zip(dfs, full))
+
+    # another temperature in 12 rows: only those are predicted again, with the clear sky of the previous forecast
+    weather = providers.get_provider("file").getData(test_site)
+    changed = weather.copy()
+    changed.loc[100:111, "temp"] += 2.0
+    monkeypatch.setattr(
+        providers.get_provider("file"), "getData", lambda inst: changed.copy()
+    )
+    monkeypatch.setattr(
+        solar, "getClearSkyBatch", lambda *a, **kw: pytest.fail("clear sky not reused")
+    )
+    dfs, recomputed = forecast.updateForecastBatch([test_site], [full[0]], "file")
+    assert recomputed == 12
+    assert dfs[0]["P_predicted"].iloc[:100].equals(full[0]["P_predicted"].iloc[:100])
+
+
+def test_numpy_inference_matches_sklearn(tmp_path):
+    sklearn_model = ml.load_model(ml.model_path, backend="sklearn")
+    numpy_model = inference.NumpyMLP.load(
+        inference.export(ml.model_path, tmp_path / "model.npz")
+    )
+    rng = np.random.default_rng(0)
+    X = rng.uniform(
+        [250, 950, 0, 0, 0, 0, 200, 0, 1],
+        [310, 1050, 100, 20, 360, 100, 804, 6000, 366],
+        (5000, 9),
+    )
+    expected = sklearn_model.predict(X)
+    assert np.allclose(numpy_model.predict(X), expected, rtol=1e-5, atol=1e-2)
+    assert numpy_model.feature_names == ml.FEATURE_COLUMNS
+    assert inference.load_numpy(ml.model_path).source == inference.file_digest(
+        ml.model_path
+    )
+
+
+def test_model_versions_hot_swap_and_shadow(tmp_path, monkeypatch):
+    from shared_code import models
+
+    shutil.copy(ml.model_path, tmp_path / "v1.pkl")
+    inference.export(ml.model_path, tmp_path / "v2.npz")
+    model = inference.NumpyMLP.load(tmp_path / "v2.npz")
+    inference.NumpyMLP(
+        [coef[:8] for coef in model.coefs],
+        model.intercepts,
+        feature_names=ml.FEATURE_COLUMNS[:8],
+    ).save(tmp_path / "bad.npz")
+    monkeypatch.setattr(models, "MODEL_DIR", tmp_path)
+    monkeypatch.setattr(models, "MODEL_VERSION", "v1")
+    monkeypatch.setattr(ml, "mlp", None)
+    monkeypatch.setattr(ml, "model_version", None)
+    monkeypatch.setattr(ml, "shadow", None)
+
+    ml.get_model()
+    assert client.get("/models").json()["active"] == "v1"
+    assert client.post("/models/bad/activate").status_code == 422
+    assert client.post("/models/v3/activate").status_code == 404
+    assert client.post("/models/v2/activate").json()["active"] == "v2"
+    assert models.active_version() == "v2"
+
+    assert client.post("/models/v1/shadow?sample_rate=1").status_code == 200
+    ml.predictPower(np.ones((10, len(ml.FEATURE_COLUMNS))) * 100)
+    models.shadow_executor.submit(lambda: None).result()
+    shadow = client.get("/models").json()["shadow"]
+    assert shadow["version"] == "v1" and shadow["samples"] == 1 and shadow["rows"] == 10
+    assert shadow["max_abs_diff"] <= 1
+    assert client.delete("/models/shadow").status_code == 204
+    assert ml.shadow is None
+
+
+def test_metrics_and_server_timing(monkeypatch):
+    monkeypatch.setattr(metrics, "SERVER_TIMING", "on")
+    monkeypatch.setattr(responsecache, "RESPONSE_CACHE", "off")
+    count = metrics.stage_seconds.count(stage="clear_sky")
+    response = client.post("/clearsky", json=test_site)
+    assert response.status_code == 200
+    timing = response.headers["server-timing"]
+    assert (
+        "clear_sky;dur=" in timing
+        and "encode;dur=" in timing
+        and "total;dur=" in timing
+    )
+    assert metrics.stage_seconds.count(stage="clear_sky") == count + 1
+
+    text = client.get("/metrics").text
+    assert (
+        'solar_forecast_requests_total{endpoint="calc_clearsky",status="200"}' in text
+    )
+    assert 'solar_forecast_stage_seconds_bucket{stage="clear_sky",le="+Inf"}' in text
+    assert 'solar_forecast_cache_hits_total{cache="weather"}' in text
+    assert "# TYPE solar_forecast_request_seconds histogram" in text
+
+
+def test_forecast_window():
+    full = forecast.calcForecast(test_site, "file")
+    start = int(full["dt"].iloc[40])
+    response = client.post(
+        f"/forecast?provider=file&start={start}&horizon_hours=24&resolution=60min&daylight_only=true",
+        json=test_site,
+    )
+    assert response.status_code == 200
+    rows = response.json()
+    assert 0 < len(rows) < 24
+    assert all(row["clear_sky"] > 0 and (row["dt"] - start) % 3600 == 0 for row in rows)
+    # same values as the rows of the full forecast
+    expected = full.set_index("dt").loc[[row["dt"] for row in rows]]
+    assert [row["P_predicted"] for row in rows] == expected["P_predicted"].tolist()
+    assert [row["clear_sky"] for row in rows] == expected["clear_sky"].tolist()
+
+    window = forecast.forecastWindow(horizon_hours=36, now=1674000000)
+    assert window["forecast_days"] == 3 and window["end"] - window["start"] == 36 * 3600
+    assert (
+        client.post(
+            "/forecast?provider=file&resolution=7min", json=test_site
+        ).status_code
+        == 400
+    )
+    assert (
+        client.post(
+            "/forecast?provider=file&horizon_hours=400", json=test_site
+        ).status_code
+        == 400
+    )
+
+
+def test_solar_position_algorithms():
+    reference = solar.getClearSky(test_site)["clear_sky"].to_numpy()
+    for method, max_error in [("ephemeris", 10), ("analytical", 350)]:
+        response = client.post(f"/clearsky?solar_position={method}", json=test_site)
+        assert response.status_code == 200
+        clear_sky = np.array([row["clear_sky"] for row in response.json()])
+        assert np.abs(clear_sky - reference).max() <= max_error
+    # the other nrel variant needs SOLAR_POSITION, unknown algorithms are rejected
+    assert (
+        client.post("/clearsky?solar_position=nrel_numba", json=test_site).status_code
+        == 400
+    )
+    assert (
+        client.post("/clearsky?solar_position=spa", json=test_site).status_code == 400
+    )
+
+
+def test_clear_sky_table(tmp_path, monkeypatch):
+    table = clearsky_table.build(tmp_path / "table", lat_step=2, day_step=8, minutes=10)
+    assert clearsky_table.validate(table, samples=5)["p99_poa_error"] < 10
+    monkeypatch.setattr(clearsky_table, "CLEARSKY_ENGINE", "table")
+    clearsky_table.set_table(table)
+    try:
+        solar.clear_sky_cache.clear()
+        expected = solar.getClearSky(test_site, "nrel_numpy")["clear_sky"].to_numpy()
+        response = client.post("/clearsky", json=test_site)
+        clear_sky = np.array([row["clear_sky"] for row in response.json()])
+        assert (clear_sky == solar.getClearSky(test_site)["clear_sky"].to_numpy()).all()
+        assert np.abs(clear_sky - expected).max() <= 100
+        assert np.abs(clear_sky - expected).mean() <= 10
+    finally:
+        clearsky_table.set_table(None)
+        solar.clear_sky_cache.clear()
+
+
+def test_compute_pool_admission_control(monkeypatch):
+    monkeypatch.setattr(responsecache, "RESPONSE_CACHE", "off")
+    expected = client.post("/forecast?provider=file", json=test_site).json()
+    monkeypatch.setattr(compute, "COMPUTE_QUEUE_SIZE", 0)
+    response = client.post("/clearsky", json=test_site)
+    assert response.status_code == 503
+    assert response.headers["retry-after"] == str(compute.COMPUTE_RETRY_AFTER)
+    assert "solar_forecast_compute_rejected_total 1" in client.get("/metrics").text
+
+    # worker process with the model preloaded: same forecast, its stages are in the metrics of the app
+    monkeypatch.setattr(compute, "COMPUTE_QUEUE_SIZE", 64)
+    monkeypatch.setattr(compute, "COMPUTE_POOL", "process")
+    monkeypatch.setattr(compute, "COMPUTE_WORKERS", 1)
+    compute.stop()
+    predictions = metrics.stage_seconds.count(stage="predict")
+    try:
+        response = client.post("/forecast?provider=file", json=test_site)
+        assert response.status_code == 200
+        assert response.json() == expected
+        assert metrics.stage_seconds.count(stage="predict") == predictions + 1
+        assert compute.queue_wait_seconds.count() >= 1
+    finally:
+        compute.stop()
+
+
+def test_response_cache_etag(monkeypatch):
+    responsecache.response_cache.clear()
+    response = client.post("/clearsky", json=test_site)
+    etag = response.headers["etag"]
+    assert (
+        response.headers["cache-control"]
+        == f"public, max-age={responsecache.CLEARSKY_MAX_AGE}"
+    )
+    # same installation, other order of the fields: served from the cache
+    hits = responsecache.response_cache.hits
+    again = client.post("/clearsky", json=dict(reversed(list(test_site.items()))))
+    assert again.content == response.content and again.headers["etag"] == etag
+    assert responsecache.response_cache.hits == hits + 1
+    response = client.post(
+        "/clearsky", json=test_site, headers={"If-None-Match": f"W/{etag}"}
+    )
+    assert (
+        response.status_code == 304
+        and response.content == b""
+        and response.headers["etag"] == etag
+    )
+    # GET variant with the installation in query params
+    query = "lat={lat}&lng={lng}".format(**test_site["location"]) + "".join(
+        f"&{name}={value}" for name, value in test_site.items() if name != "location"
+    )
+    response = client.get(f"/clearsky?{query}")
+    assert response.status_code == 200 and response.headers["etag"] == etag
+    assert client.get("/clearsky?lat=51&lng=3.11&tilt=95").status_code == 422
+
+    # forecast: cached until the next weather model update
+    response = client.get(f"/forecast?provider=file&{query}")
+    assert (
+        response.content
+        == client.post("/forecast?provider=file", json=test_site).content
+    )
+    max_age = int(response.headers["cache-control"].split("max-age=")[1])
+    assert 0 <= max_age <= weatherforecast.MODEL_UPDATE_CYCLE
+    # a new model run with the same forecast: recalculated, same content address
+    misses = responsecache.response_cache.misses
+    monkeypatch.setattr(
+        weatherforecast, "MODEL_UPDATE_OFFSET", weatherforecast.MODEL_UPDATE_OFFSET + 1
+    )
+    response = client.post(
+        "/forecast?provider=file",
+        json=test_site,
+        headers={"If-None-Match": response.headers["etag"]},
+    )
+    assert response.status_code == 304
+    assert responsecache.response_cache.misses == misses + 1
+
+
+def test_response_cache_key_without_file_read(monkeypatch):
+    from shared_code import models
+
+    ml.get_model()
+    # the cache key uses the loaded version, ACTIVE is only read by sync (every MODEL_POLL_INTERVAL)
+    monkeypatch.setitem(models._sync, "checked", time.monotonic())
+    monkeypatch.setattr(
+        models, "active_version", lambda: pytest.fail("ACTIVE read per request")
+    )
+    for attempt in range(2):
+        response = client.post("/forecast?provider=file", json=test_site)
+        assert response.status_code == 200